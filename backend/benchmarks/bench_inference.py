@@ -0,0 +1,107 @@
+"""
+CLIP 推理后端对比: 吞吐量、内存占用，以及与参考实现 (torch fp32) 的向量一致性。
+
+每个后端在独立的进程中加载 (便于比较内存)，对同一组图片和文本编码，
+再与 torch 后端的结果比较余弦相似度，低于 inference_backends.PARITY_THRESHOLDS 时标记为不通过。
+
+用法:
+    python -m backend.benchmarks.bench_inference --backends torch torchscript int8 onnx --images 256 --threads 4
+    python -m backend.benchmarks.bench_inference --dir /path/to/photos  # 使用真实图片
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+TEXTS = ["a photo of a beach at sunset", "snow covered mountains", "a cat sleeping on a sofa",
+         "cherry blossoms in spring", "a crowded city street at night"]
+
+def load_pixels(count: int, directory: str = None):
+    """返回 count 张 (224, 224, 3) uint8 图像: 来自目录中的图片，或随机生成。"""
+    from backend import preprocess, scanner
+
+    if directory:
+        paths = sorted(scanner.scan_files(directory))[:count]
+        return [preprocess.decode_image(path) for path in paths]
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (preprocess.CLIP_IMAGE_SIZE, preprocess.CLIP_IMAGE_SIZE, 3), dtype=np.uint8)
+            for _ in range(count)]
+
+def measure(backend: str, pixels, batch_size: int, threads: int):
+    """在子进程中执行: 加载指定的推理后端并编码所有图片与文本。"""
+    os.environ["PHOTO_INSIGHT_INFERENCE_BACKEND"] = backend
+    os.environ["PHOTO_INSIGHT_NUM_THREADS"] = str(threads)
+    from backend import clip_model
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if not clip_model.load_model():
+        return {'backend': backend, 'error': clip_model.status()['error']}
+    load_seconds = time.perf_counter() - started
+
+    clip_model.encode_pixel_batch(pixels[:batch_size])  # 预热
+    started = time.perf_counter()
+    image_features = np.concatenate([
+        clip_model.encode_pixel_batch(pixels[start:start + batch_size])
+        for start in range(0, len(pixels), batch_size)
+    ])
+    elapsed = time.perf_counter() - started
+    text_features = np.stack([clip_model.get_text_features(text) for text in TEXTS])
+    return {
+        'backend': backend,
+        'load_seconds': round(load_seconds, 2),
+        'images_per_sec': round(len(pixels) / elapsed, 2),
+        # Linux 上 ru_maxrss 的单位为 KB
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'model_rss_mb': round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1),
+        'image_features': image_features,
+        'text_features': text_features,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CLIP 推理后端对比")
+    parser.add_argument("--backends", nargs="+", default=["torch", "torchscript", "int8", "onnx"])
+    parser.add_argument("--images", type=int, default=128)
+    parser.add_argument("--dir", help="使用该目录中的图片，而不是随机生成的图像")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=0, help="推理线程数，0 表示使用默认值")
+    args = parser.parse_args(argv)
+
+    from backend import inference_backends
+
+    pixels = load_pixels(args.images, args.dir)
+    backends = ["torch"] + [name for name in args.backends if name != "torch"]
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[backend] = executor.submit(measure, backend, pixels, args.batch_size, args.threads).result()
+
+    reference = results["torch"]
+    failed = False
+    for backend in backends:
+        report = results[backend]
+        if 'error' in report or 'error' in reference:
+            failed = True
+            continue
+        image_parity = inference_backends.cosine_parity(reference['image_features'], report['image_features'])
+        text_parity = inference_backends.cosine_parity(reference['text_features'], report['text_features'])
+        threshold = inference_backends.PARITY_THRESHOLDS[backend]
+        report['image_cosine'] = {key: round(value, 5) for key, value in image_parity.items()}
+        report['text_cosine'] = {key: round(value, 5) for key, value in text_parity.items()}
+        report['parity_ok'] = min(image_parity['min'], text_parity['min']) >= threshold
+        failed = failed or not report['parity_ok']
+    for backend in backends:
+        report = {key: value for key, value in results[backend].items() if not key.endswith('_features')}
+        print(json.dumps(report, ensure_ascii=False))
+    # 一致性检查不通过时以非零状态退出，便于在 CI 中使用
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
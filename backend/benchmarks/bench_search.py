@@ -0,0 +1,119 @@
+"""
+文本搜索延迟基准测试。
+
+在临时目录中构建一个包含 N 条随机向量的向量库与对应的 SQLite 记录，
+然后测量 search_text 的端到端延迟 (向量检索 + 关联图片记录)。
+目标: CPU 上 100 万张图片时 p95 < 50 ms。
+
+用法:
+    python -m backend.benchmarks.bench_search --rows 1000000 --queries 500
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+TARGET_P95_MS = 50.0
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms)
+    return {
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p95_ms': round(float(np.percentile(samples, 95)), 3),
+        'p99_ms': round(float(np.percentile(samples, 99)), 3),
+        'max_ms': round(float(samples.max()), 3),
+    }
+
+def build_corpus(rows: int, dim: int, chunk: int = 5000):
+    """写入 rows 条图片记录与随机向量，返回构建耗时 (秒)"""
+    import datetime
+    import uuid
+    from sqlalchemy import insert
+    from backend import database, models, vector_db
+
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    db = database.SessionLocal()
+    try:
+        now = datetime.datetime.utcnow()
+        for offset in range(0, rows, chunk):
+            n = min(chunk, rows - offset)
+            vector_ids = [str(uuid.uuid4()) for _ in range(n)]
+            db.execute(insert(models.Image), [
+                {
+                    'path': f'/bench/{offset + i:08d}.jpg',
+                    'filename': f'{offset + i:08d}.jpg',
+                    'size_mb': 1.0,
+                    'created_at': now,
+                    'indexed_at': now,
+                    'vector_id': vector_id,
+                }
+                for i, vector_id in enumerate(vector_ids)
+            ])
+            db.commit()
+            vector_db.upsert_vectors(rng.standard_normal((n, dim), dtype=np.float32), vector_ids)
+    finally:
+        db.close()
+    return time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="文本搜索延迟基准测试")
+    parser.add_argument("--rows", type=int, default=100000, help="向量库中的图片数量")
+    parser.add_argument("--queries", type=int, default=500, help="测量的查询次数")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录)")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="photo_insight_bench_")
+    # 必须在导入 backend 模块之前设置数据路径
+    os.environ["PHOTO_INSIGHT_CHROMA_PATH"] = os.path.join(workdir, "chroma_db")
+    os.environ["PHOTO_INSIGHT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'photo_insight.db')}"
+
+    from backend import clip_model, database, models, search, vector_db
+    models.Base.metadata.create_all(bind=database.engine)
+
+    report = {'rows': args.rows, 'top_k': args.top_k, 'queries': args.queries}
+    existing = vector_db.get_vector_count()
+    if existing < args.rows:
+        report['build_seconds'] = round(build_corpus(args.rows - existing, clip_model.EMBEDDING_DIM), 2)
+
+    db = database.SessionLocal()
+    try:
+        rng = np.random.default_rng(1)
+        # 向量检索 + 关联图片记录 (不含文本编码)
+        latencies = []
+        for _ in range(args.queries):
+            vector = rng.standard_normal(clip_model.EMBEDDING_DIM, dtype=np.float32)
+            start = time.perf_counter()
+            search.join_images(db, vector_db.query_vectors(vector, args.top_k))
+            latencies.append((time.perf_counter() - start) * 1000)
+        report['vector_query'] = percentiles(latencies)
+
+        # 完整的 search_text 路径；查询向量来自 LRU 缓存 (重复查询与翻页的情况)
+        if clip_model.load_model():
+            queries = ["sunset on the beach", "snow covered mountains", "a cat on a sofa", "cherry blossoms"]
+            start = time.perf_counter()
+            for query in queries:
+                clip_model.get_text_features(query)
+            report['text_encode_ms'] = round((time.perf_counter() - start) * 1000 / len(queries), 3)
+            latencies = []
+            for i in range(args.queries):
+                start = time.perf_counter()
+                search.search_text(db, queries[i % len(queries)], top_k=args.top_k)
+                latencies.append((time.perf_counter() - start) * 1000)
+            report['search_text_cached'] = percentiles(latencies)
+    finally:
+        db.close()
+
+    measured = report.get('search_text_cached', report['vector_query'])
+    report['target_p95_ms'] = TARGET_P95_MS
+    report['passed'] = measured['p95_ms'] < TARGET_P95_MS
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0 if report['passed'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
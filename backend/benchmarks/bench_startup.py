@@ -0,0 +1,78 @@
+"""
+服务启动开销测试: 在全新的 Python 进程中导入 backend.main，记录导入耗时、峰值内存，
+以及是否在导入时就加载了 torch / transformers / chromadb 等重量级依赖。
+
+用法:
+    python -m backend.benchmarks.bench_startup --runs 5
+    python -m backend.benchmarks.bench_startup --load  # 额外测量第一次加载模型与向量库的耗时
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ("torch", "transformers", "chromadb")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 在子进程中执行，结果以一行 JSON 输出
+CHILD_SCRIPT = """
+import json, resource, sys, time
+started = time.perf_counter()
+import backend.main
+report = {'import_seconds': time.perf_counter() - started}
+report['heavy_modules'] = [name for name in %(heavy)r if name in sys.modules]
+if %(load)r:
+    from backend import clip_model, vector_db
+    started = time.perf_counter()
+    report['model_loaded'] = clip_model.load_model()
+    report['model_load_seconds'] = time.perf_counter() - started
+    started = time.perf_counter()
+    try:
+        vector_db.get_backend()
+        report['vector_store_loaded'] = True
+    except RuntimeError:
+        report['vector_store_loaded'] = False
+    report['vector_store_load_seconds'] = time.perf_counter() - started
+# Linux 上 ru_maxrss 的单位为 KB
+report['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps(report))
+"""
+
+def run_once(load: bool, workdir: str):
+    # 数据库、向量库和缩略图都使用临时目录中的默认相对路径
+    env = {key: value for key, value in os.environ.items() if not key.startswith("PHOTO_INSIGHT_")}
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT % {'heavy': HEAVY_MODULES, 'load': load}],
+        capture_output=True, text=True, check=True, cwd=workdir, env=env,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="服务启动开销测试")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--load", action="store_true", help="导入后再加载 CLIP 模型与向量库")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="photo_insight_startup_") as workdir:
+        runs = [run_once(args.load, workdir) for _ in range(args.runs)]
+    import_seconds = [run['import_seconds'] for run in runs]
+    report = {
+        'runs': args.runs,
+        'import_seconds_median': round(statistics.median(import_seconds), 3),
+        'import_seconds_min': round(min(import_seconds), 3),
+        'max_rss_mb': round(max(run['max_rss_mb'] for run in runs), 1),
+        'heavy_modules_at_import': runs[0]['heavy_modules'],
+    }
+    if args.load:
+        report['model_loaded'] = runs[0]['model_loaded']
+        report['model_load_seconds_median'] = round(statistics.median(run['model_load_seconds'] for run in runs), 3)
+        report['vector_store_load_seconds_median'] = round(
+            statistics.median(run['vector_store_load_seconds'] for run in runs), 3)
+    print(json.dumps(report, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
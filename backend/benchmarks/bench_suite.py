@@ -0,0 +1,482 @@
+"""
+可重复的端到端基准测试: 索引、季节分类与列表/检索。
+
+- indexing: 生成合成图片库 (见 corpus.py)，通过 JobManager 完整执行一次索引任务，
+  记录吞吐量、首张图片的可检索时间、单张图片延迟的分位数、峰值内存 (主进程与解码子进程)、
+  SQLite 与向量库的写入速率，以及无变化时重新扫描的耗时。
+- classification: 测量 CLIP 零样本分类，以及使用本地模拟的 VLM 服务 (见 fake_vlm_server.py) 的 VLM 分类。
+- scale: 在 1 万 / 10 万 / 100 万条记录的图库上测量列表分页 (首页、深翻页、按季节)、标签统计、
+  向量检索与按季节过滤的检索延迟，以及构建图库时的写入速率。
+
+每个场景在独立的进程中运行 (互不影响内存统计)。索引与分类场景共用工作目录中的数据，
+scale 场景使用其中单独的子目录；再次运行时复用已有的图片库与 scale 图库。
+结果以 JSON 保存，包含 git 提交、Python 与平台信息以及全部参数，便于比较不同版本；
+--baseline 指定上一次的结果时逐项对比，变差超过 --tolerance 时以非零状态退出。
+
+--fake-model 使用确定性的随机投影代替 CLIP (不需要 torch 与模型文件)，用于测量模型之外的开销。
+
+用法:
+    python -m backend.benchmarks.bench_suite --images 2000 --output results.json
+    python -m backend.benchmarks.bench_suite --scenarios scale --rows 10000 100000 --baseline results.json
+    python -m backend.benchmarks.bench_suite --fake-model --vector-backend mmap --formats jpg=0.5 png=0.5
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .bench_search import percentiles
+from .corpus import DEFAULT_FORMATS, generate_corpus, parse_mix, parse_sizes
+
+SCHEMA_VERSION = 1
+SCENARIOS = ("indexing", "classification", "scale")
+DEFAULT_ROWS = (10000, 100000, 1000000)
+# 对比结果时按指标名称判断方向: 这些后缀越小越好，*_per_sec 越大越好
+LOWER_IS_BETTER = ("_ms", "_seconds", "_mb")
+HIGHER_IS_BETTER = ("_per_sec",)
+SKIP_COMPARE = ("max_ms",)  # 单次最大值受偶发抖动影响，不参与对比
+
+class FakeEncoder:
+    """
+    确定性的随机投影编码器: 图像向量为 14x14 平均池化后的像素经过固定随机矩阵的投影，
+    相似的图片得到相似的向量；文本向量由 token id 决定。
+    """
+    device = "cpu"
+
+    def __init__(self, dim: int = 512, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.image_projection = rng.standard_normal((3 * 14 * 14, dim)).astype(np.float32)
+        self.dim = dim
+
+    def encode_image(self, pixel_values):
+        pixel_values = np.asarray(pixel_values, dtype=np.float32)
+        n, channels, height, width = pixel_values.shape
+        pooled = pixel_values.reshape(n, channels, 14, height // 14, 14, width // 14).mean(axis=(3, 5))
+        vectors = pooled.reshape(n, -1) @ self.image_projection
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def encode_text(self, input_ids, attention_mask=None):
+        vectors = np.stack([
+            np.random.default_rng([int(token) for token in ids]).standard_normal(self.dim).astype(np.float32)
+            for ids in np.asarray(input_ids)
+        ])
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+class FakeTokenizer:
+    """与 CLIPProcessor 的文本接口兼容的简单分词: 每个字符的编码即 token id。"""
+
+    def __call__(self, text, return_tensors="np", padding=None, max_length=77, truncation=True):
+        ids = np.zeros((len(text), max_length), dtype=np.int64)
+        for row, value in enumerate(text):
+            tokens = [ord(char) for char in value][:max_length]
+            ids[row, :len(tokens)] = tokens
+        return {'input_ids': ids, 'attention_mask': (ids > 0).astype(np.int64)}
+
+def _configure(workdir: str, config: dict):
+    """在导入 backend 模块之前设置数据路径与后端 (只能在场景子进程中调用)"""
+    # 逐张图片的日志会影响计时，场景进程只输出警告与错误 (之后导入的模块中的 basicConfig 不再生效)
+    logging.basicConfig(level=logging.WARNING)
+    os.makedirs(workdir, exist_ok=True)
+    os.environ["PHOTO_INSIGHT_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'photo_insight.db')}"
+    os.environ["PHOTO_INSIGHT_CHROMA_PATH"] = os.path.join(workdir, "chroma_db")
+    os.environ["PHOTO_INSIGHT_MMAP_PATH"] = os.path.join(workdir, "vector_index")
+    os.environ["PHOTO_INSIGHT_THUMBNAIL_DIR"] = os.path.join(workdir, "thumbnails")
+    os.environ["PHOTO_INSIGHT_EMBEDDING_CACHE"] = os.path.join(workdir, "embedding_cache.db")
+    os.environ["PHOTO_INSIGHT_PROFILE_DIR"] = os.path.join(workdir, "profiles")
+    os.environ["PHOTO_INSIGHT_VECTOR_BACKEND"] = config['vector_backend']
+    if config['decode_workers']:
+        os.environ["PHOTO_INSIGHT_DECODE_WORKERS"] = str(config['decode_workers'])
+
+    from backend import clip_model, database, migrations, models
+    models.Base.metadata.create_all(bind=database.engine)
+    migrations.run_migrations()
+    if config['fake_model']:
+        clip_model.processor = FakeTokenizer()
+        clip_model.INFERENCE_BACKEND = "fake"
+        clip_model.DEVICE = "cpu"
+        clip_model.encoder = FakeEncoder(clip_model.EMBEDDING_DIM)
+
+def _peak_rss_mb():
+    """本进程与已结束的子进程 (解码进程) 的峰值内存；Linux 上 ru_maxrss 的单位为 KB"""
+    return {
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+def _write_rates():
+    """由阶段指标计算 SQLite 与向量库的写入速率 (行/秒，只计写入本身的耗时)"""
+    from backend import metrics
+
+    rows = metrics.STAGE_ITEMS.get(stage="write")
+    rates = {}
+    for stage in ("db_write", "vector_write"):
+        count, seconds = metrics.STAGE_SECONDS.get(stage=stage)
+        rates[f'{stage}_rows_per_sec'] = round(rows / seconds, 1) if seconds else None
+        rates[f'{stage}_batches'] = count
+    return rates
+
+def run_indexing(workdir: str, config: dict):
+    """场景子进程: 对图片库执行一次完整的索引任务，再执行一次无变化的重新扫描。"""
+    _configure(workdir, config)
+    from backend import clip_model, indexer
+    from backend.jobs import JobManager
+
+    started = time.perf_counter()
+    if not clip_model.load_model():
+        return {'error': clip_model.status()['error']}
+    model_load_seconds = time.perf_counter() - started
+
+    finished = threading.Event()
+    events = {}
+
+    def emit(event, payload, room=None):
+        if event == 'new_image_found' and 'first_image_seconds' not in events:
+            events['first_image_seconds'] = time.perf_counter() - started
+        if event in ('indexing_complete', 'error'):
+            events[event] = payload
+            finished.set()
+
+    manager = JobManager()
+    manager.set_emitter(emit)
+    started = time.perf_counter()
+    manager.submit(config['corpus'])
+    finished.wait()
+    seconds = time.perf_counter() - started
+    manager.shutdown()
+    if 'error' in events:
+        return {'error': events['error']['data']}
+
+    stats = events['indexing_complete']['stats']
+    report = {
+        'model_load_seconds': round(model_load_seconds, 3),
+        'files': stats['total'],
+        'embedded': stats['stages']['inference']['items'],
+        'cache_hits': stats['cache_hits'],
+        'duplicates': stats.get('duplicates', 0),
+        'failed': stats['failed'],
+        'total_seconds': round(seconds, 3),
+        'files_per_sec': round(stats['total'] / seconds, 2),
+        'first_image_seconds': round(events['first_image_seconds'], 3) if 'first_image_seconds' in events else None,
+        'latency_ms': stats['latency_ms'],
+        'stages': stats['stages'],
+        **_write_rates(),
+    }
+
+    # 无变化的重新扫描: 只比较文件指纹
+    started = time.perf_counter()
+    indexer.index_directory(config['corpus'], lambda event, payload: None)
+    report['rescan_seconds'] = round(time.perf_counter() - started, 3)
+    report.update(_peak_rss_mb())
+    return report
+
+def run_classification(workdir: str, config: dict):
+    """场景子进程: 执行 CLIP 零样本分类，再使用模拟 VLM 服务分类整个图库。"""
+    from .fake_vlm_server import serve_in_thread
+
+    server = serve_in_thread(latency=config['vlm_latency'], error_rate=config['vlm_error_rate'],
+                             capacity=config['vlm_capacity'])
+    os.environ["PHOTO_INSIGHT_VLM_URL"] = server.url
+    os.environ["PHOTO_INSIGHT_VLM_CONCURRENCY"] = str(config['vlm_capacity'])
+    _configure(workdir, config)
+    from backend import classify_seasons, clip_model, crud, database, indexer, metrics, models
+
+    if not clip_model.load_model():
+        return {'error': clip_model.status()['error']}
+    db = database.SessionLocal()
+    try:
+        indexed = lambda: db.query(models.Image).filter(models.Image.vector_id.isnot(None)).count()
+        images = indexed()
+        if not images:
+            # 单独运行该场景时先建立索引 (不计入结果)
+            indexer.index_directory(config['corpus'], lambda event, payload: None)
+            images = indexed()
+        # 清除上一次运行的分类结果；CLIP 先运行，因为已由 VLM 判定的图片不会再参与 CLIP 分类
+        db.query(models.ImageLabel).filter(
+            models.ImageLabel.label_type.in_([crud.LABEL_SEASON, crud.LABEL_SEASON_PROB])).delete()
+        db.commit()
+
+        started = time.perf_counter()
+        scores = classify_seasons.classify_library_with_clip(db)
+        seconds = time.perf_counter() - started
+        report = {
+            'images': images,
+            'clip': {
+                'classified': len(scores),
+                'total_seconds': round(seconds, 3),
+                'images_per_sec': round(len(scores) / seconds, 2) if seconds else None,
+            },
+        }
+
+        async def emit_status(message, **extra):
+            pass
+
+        started = time.perf_counter()
+        job, _ = classify_seasons.prepare_classification_job(db, "vlm", force=True)
+        outcome = asyncio.run(classify_seasons.run_classification_job(db, job, emit_status))
+        seconds = time.perf_counter() - started
+        report['vlm'] = {
+            'classified': outcome['classified'],
+            'failed': outcome['failed'],
+            'total_seconds': round(seconds, 3),
+            'images_per_sec': round(job.total / seconds, 2) if seconds else None,
+            'request_ms': {
+                name: round(value * 1000, 1) if value is not None else None
+                for name, value in (
+                    ('p50', metrics.VLM_REQUEST_SECONDS.quantile(0.5, outcome="success")),
+                    ('p95', metrics.VLM_REQUEST_SECONDS.quantile(0.95, outcome="success")),
+                )
+            },
+            'retries': metrics.VLM_RETRIES.get(),
+            'client': outcome['metrics'],
+        }
+        report.update(_peak_rss_mb())
+        return report
+    finally:
+        db.close()
+        server.shutdown()
+
+def _grow_library(target: int, dim: int, chunk: int = 5000):
+    """
+    把图库扩充到 target 条已索引的记录 (随机向量，每张图片一个季节标签)。
+    :return: 新增的行数与 SQLite、向量库各自的写入耗时 (秒)
+    """
+    import uuid
+    from sqlalchemy import func, insert
+    from backend import crud, database, models, vector_db
+
+    db = database.SessionLocal()
+    try:
+        existing = db.query(func.count(models.Image.id)).scalar()
+        rng = np.random.default_rng(existing)
+        now = datetime.datetime.utcnow()
+        db_seconds = vector_seconds = 0.0
+        for offset in range(existing, target, chunk):
+            n = min(chunk, target - offset)
+            vector_ids = [str(uuid.uuid4()) for _ in range(n)]
+            vectors = rng.standard_normal((n, dim), dtype=np.float32)
+            started = time.perf_counter()
+            db.execute(insert(models.Image), [
+                {
+                    'path': f'/bench/{(offset + i) // 1000:04d}/{offset + i:08d}.jpg',
+                    'filename': f'{offset + i:08d}.jpg',
+                    'size_mb': 1.0 + (offset + i) % 7,
+                    'created_at': now - datetime.timedelta(minutes=offset + i),
+                    'indexed_at': now,
+                    'vector_id': vector_id,
+                }
+                for i, vector_id in enumerate(vector_ids)
+            ])
+            first_id = db.query(func.max(models.Image.id)).scalar() - n + 1
+            crud.upsert_labels(db, crud.LABEL_SEASON, [
+                (first_id + i, crud.SEASONS[int(season)], 1.0)
+                for i, season in enumerate(rng.integers(0, len(crud.SEASONS), n))
+            ], source="clip", commit=False)
+            db.commit()
+            db_seconds += time.perf_counter() - started
+            started = time.perf_counter()
+            vector_db.upsert_vectors(vectors, vector_ids)
+            vector_seconds += time.perf_counter() - started
+        return max(target - existing, 0), db_seconds, vector_seconds
+    finally:
+        db.close()
+
+def _timed(samples: int, call):
+    latencies = []
+    for i in range(samples):
+        started = time.perf_counter()
+        call(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return percentiles(latencies)
+
+def run_scale(workdir: str, config: dict):
+    """场景子进程: 依次把图库扩充到每个规模，测量列表与检索的延迟 (使用单独的数据目录，不影响其他场景)。"""
+    _configure(os.path.join(workdir, "scale"), config)
+    from backend import clip_model, crud, database, search, vector_db
+
+    results = {}
+    samples = config['queries']
+    top_k = config['top_k']
+    for rows in sorted(config['rows']):
+        added, db_seconds, vector_seconds = _grow_library(rows, clip_model.EMBEDDING_DIM)
+        report = {
+            'rows': rows,
+            'sqlite_rows_per_sec': round(added / db_seconds, 1) if db_seconds else None,
+            'vector_rows_per_sec': round(added / vector_seconds, 1) if vector_seconds else None,
+        }
+        rng = np.random.default_rng(rows)
+        cursors = rng.integers(0, rows, samples).tolist()
+        seasons = [crud.SEASONS[int(i)] for i in rng.integers(0, len(crud.SEASONS), samples)]
+        queries = rng.standard_normal((samples, clip_model.EMBEDDING_DIM), dtype=np.float32)
+        db = database.SessionLocal()
+        try:
+            report['list_first_page'] = _timed(samples, lambda i: crud.list_images(db))
+            report['list_deep_page'] = _timed(samples, lambda i: crud.list_images(db, after_id=cursors[i]))
+            report['list_season_page'] = _timed(
+                samples, lambda i: crud.list_images(db, after_id=cursors[i], season=seasons[i]))
+            report['count_labels'] = _timed(min(samples, 20), lambda i: crud.count_labels(db, crud.LABEL_SEASON))
+            report['vector_search'] = _timed(
+                samples, lambda i: search.join_images(db, vector_db.query_vectors(queries[i], top_k)))
+            report['filtered_search'] = _timed(
+                samples, lambda i: search.find_similar_to_vector(db, queries[i], top_k, seasons=[seasons[i]]))
+            # 选择性强的条件 (季节 + 最近一天，约千分之几的图片) 走预过滤
+            recent = search.SearchFilters(date_from=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+            report['selective_search'] = _timed(
+                samples, lambda i: search.find_similar_to_vector(db, queries[i], top_k, seasons=[seasons[i]],
+                                                                 filters=recent))
+        finally:
+            db.close()
+        report.update(_peak_rss_mb())
+        results[str(rows)] = report
+    return results
+
+RUNNERS = {'indexing': run_indexing, 'classification': run_classification, 'scale': run_scale}
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def environment():
+    """运行环境，随结果一起保存以便判断两次结果是否可比"""
+    return {
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+def _direction(name: str):
+    """1 表示越大越好，-1 表示越小越好，0 表示不参与对比"""
+    parts = name.split(".")
+    if parts[-1] in SKIP_COMPARE:
+        return 0
+    if parts[-1].endswith(HIGHER_IS_BETTER):
+        return 1
+    if any(part.endswith(LOWER_IS_BETTER) for part in parts):
+        return -1
+    return 0
+
+def compare(baseline: dict, current: dict, tolerance: float):
+    """
+    逐项对比两次结果中的性能指标。
+    :return: [(指标, 基线值, 当前值, 变化比例, 是否变差超过 tolerance), ...]
+    """
+    before = dict(_flatten(baseline.get('results', {})))
+    rows = []
+    for name, value in _flatten(current.get('results', {})):
+        direction = _direction(name)
+        old = before.get(name)
+        if not direction or not old:
+            continue
+        change = (value - old) / abs(old)
+        rows.append((name, old, value, change, change * direction < -tolerance))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="端到端基准测试: 索引、分类与列表/检索")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录)；已存在的图库与索引会被复用")
+    parser.add_argument("--corpus-dir", help="合成图片库的目录 (默认在 workdir 中)")
+    parser.add_argument("--images", type=int, default=1000, help="合成图片库的文件数")
+    parser.add_argument("--formats", nargs="*", help="格式比例，例如 jpg=0.7 png=0.2 webp=0.1")
+    parser.add_argument("--sizes", nargs="*", help="图片尺寸，例如 1920x1080 4032x3024")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--corrupt-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rows", type=int, nargs="+", default=list(DEFAULT_ROWS), help="scale 场景的图库规模")
+    parser.add_argument("--queries", type=int, default=200, help="每项延迟测量的次数")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--vector-backend", default="chroma", choices=["chroma", "mmap"])
+    parser.add_argument("--decode-workers", type=int, default=0, help="解码进程数，0 表示默认值")
+    parser.add_argument("--fake-model", action="store_true", help="使用确定性的随机投影代替 CLIP")
+    parser.add_argument("--vlm-latency", type=float, default=0.05, help="模拟 VLM 每个请求的处理时间 (秒)")
+    parser.add_argument("--vlm-error-rate", type=float, default=0.0)
+    parser.add_argument("--vlm-capacity", type=int, default=8, help="模拟 VLM 同时处理的请求数")
+    parser.add_argument("--output", help="结果 JSON 的路径 (默认 benchmark-<时间>.json)")
+    parser.add_argument("--baseline", help="与该结果 JSON 对比")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="变差超过该比例时以非零状态退出")
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="photo_insight_suite_"))
+    os.makedirs(workdir, exist_ok=True)
+    config = {
+        'vector_backend': args.vector_backend,
+        'decode_workers': args.decode_workers,
+        'fake_model': args.fake_model,
+        'rows': args.rows,
+        'queries': args.queries,
+        'top_k': args.top_k,
+        'vlm_latency': args.vlm_latency,
+        'vlm_error_rate': args.vlm_error_rate,
+        'vlm_capacity': args.vlm_capacity,
+        'corpus': os.path.abspath(args.corpus_dir or os.path.join(workdir, "corpus")),
+    }
+    report = {
+        'schema': SCHEMA_VERSION,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        'environment': environment(),
+        'config': dict(config, scenarios=args.scenarios, workdir=workdir),
+        'results': {},
+    }
+
+    if {"indexing", "classification"} & set(args.scenarios):
+        started = time.perf_counter()
+        report['corpus'] = generate_corpus(
+            config['corpus'], args.images, parse_mix(args.formats, DEFAULT_FORMATS), sizes=parse_sizes(args.sizes),
+            duplicate_rate=args.duplicate_rate, corrupt_rate=args.corrupt_rate, seed=args.seed)
+        print(f"合成图片库: {report['corpus']['files']} 个文件，{report['corpus']['total_mb']} MB "
+              f"({time.perf_counter() - started:.1f} 秒)", file=sys.stderr)
+
+    context = multiprocessing.get_context("spawn")
+    for scenario in SCENARIOS:
+        if scenario not in args.scenarios:
+            continue
+        print(f"运行场景: {scenario}", file=sys.stderr)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            report['results'][scenario] = executor.submit(RUNNERS[scenario], workdir, config).result()
+
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report['results'], ensure_ascii=False, indent=2))
+    print(f"结果已保存: {output}", file=sys.stderr)
+
+    failed = any('error' in result for result in report['results'].values())
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get('environment', {}).get('cpu_count') != report['environment']['cpu_count']:
+            print("注意: 基线结果来自 CPU 核数不同的机器，对比仅供参考", file=sys.stderr)
+        rows = compare(baseline, report, args.tolerance)
+        for name, old, new, change, regressed in rows:
+            print(f"{'变差' if regressed else '    '} {name}: {old} -> {new} ({change:+.1%})")
+        regressions = [row for row in rows if row[4]]
+        print(f"共对比 {len(rows)} 项指标，{len(regressions)} 项变差超过 {args.tolerance:.0%}", file=sys.stderr)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+向量存储后端对比: ChromaDB 与内存映射 NumPy 索引 (float32 / float16 / int8)。
+
+每个后端在独立的子进程中运行，分别测量构建耗时、查询延迟、峰值内存 (RSS)，
+以及与精确 float32 检索相比的 recall@k (量化会损失精度)。
+测试数据是带簇结构的随机向量: 与真实的图片向量一样，近邻之间的相似度差距很小，更能体现量化误差。
+
+用法:
+    python -m backend.benchmarks.bench_vector_backends --rows 100000 --queries 200
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .bench_search import percentiles
+
+BACKENDS = ["chroma", "mmap:float32", "mmap:float16", "mmap:int8"]
+EMBEDDING_DIM = 512
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存 (MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+def clustered_vectors(rows: int, seed: int = 0, cluster_size: int = 100, spread: float = 0.3):
+    """带簇结构的随机向量 (未归一化)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(rows // cluster_size, 1), EMBEDDING_DIM), dtype=np.float32)
+    noise = rng.standard_normal((rows, EMBEDDING_DIM), dtype=np.float32)
+    return centers[rng.integers(len(centers), size=rows)] + spread * noise
+
+def exact_top_k(unit, query, top_k: int):
+    """在归一化的 float32 向量 unit 中精确检索 (行号集合)，作为计算 recall 的基准"""
+    scores = unit @ (query / np.linalg.norm(query))
+    return set(np.argpartition(-scores, top_k - 1)[:top_k].tolist())
+
+def run_backend(spec: str, rows: int, queries: int, top_k: int, workdir: str):
+    """在当前进程中测量一个后端 (由子进程调用)"""
+    name, _, dtype = spec.partition(":")
+    os.environ["PHOTO_INSIGHT_VECTOR_BACKEND"] = name
+    os.environ["PHOTO_INSIGHT_CHROMA_PATH"] = os.path.join(workdir, "chroma_db")
+    os.environ["PHOTO_INSIGHT_MMAP_PATH"] = os.path.join(workdir, f"vector_index_{dtype}")
+    os.environ["PHOTO_INSIGHT_MMAP_DTYPE"] = dtype or "float32"
+
+    start = time.perf_counter()
+    from backend import vector_db
+    startup_seconds = time.perf_counter() - start
+
+    data = clustered_vectors(rows)
+    ids = [f"{i:012d}" for i in range(rows)]
+    start = time.perf_counter()
+    for offset in range(0, rows, 5000):
+        vector_db.upsert_vectors(data[offset:offset + 5000], ids[offset:offset + 5000])
+    build_seconds = time.perf_counter() - start
+
+    latencies = []
+    recall_hits = 0
+    recall_at_k = []
+    row_of = {vector_id: row for row, vector_id in enumerate(ids)}
+    unit = data / np.linalg.norm(data, axis=1, keepdims=True)
+    for i in range(queries):
+        target = i * (rows // max(queries, 1)) % rows
+        start = time.perf_counter()
+        hits = vector_db.query_vectors(data[target], top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        # 查询向量本身应排在第一位
+        recall_hits += bool(hits) and hits[0][0] == ids[target]
+        expected = exact_top_k(unit, data[target], top_k)
+        recall_at_k.append(len(expected & {row_of[vector_id] for vector_id, _ in hits}) / top_k)
+
+    return {
+        'backend': spec,
+        'rows': rows,
+        'startup_seconds': round(startup_seconds, 3),
+        'build_seconds': round(build_seconds, 2),
+        'query': percentiles(latencies),
+        'self_recall_at_1': round(recall_hits / max(queries, 1), 4),
+        f'recall_at_{top_k}': round(float(np.mean(recall_at_k)), 4) if recall_at_k else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="向量存储后端对比")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--backends", nargs="+", default=BACKENDS)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_backend(args.child, args.rows, args.queries, args.top_k, args.workdir)))
+        return 0
+
+    results = []
+    for spec in args.backends:
+        with tempfile.TemporaryDirectory(prefix="photo_insight_bench_") as workdir:
+            output = subprocess.run(
+                [sys.executable, "-m", "backend.benchmarks.bench_vector_backends", "--child", spec,
+                 "--rows", str(args.rows), "--queries", str(args.queries), "--top-k", str(args.top_k),
+                 "--workdir", workdir],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
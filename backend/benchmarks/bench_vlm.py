@@ -0,0 +1,49 @@
+"""
+VLM 客户端吞吐量测试: 在本地启动模拟服务，比较不同并发数下的分类速度。
+
+用法:
+    python -m backend.benchmarks.bench_vlm --images 200 --latency 0.2 --concurrency 1 4 8
+"""
+import argparse
+import asyncio
+import base64
+import json
+
+from backend.vlm_client import VLMClient
+from .fake_vlm_server import serve_in_thread
+
+FAKE_IMAGE = base64.b64encode(b"\xff\xd8" + b"\0" * 1024).decode("ascii")
+
+async def run_client(url: str, images: int, concurrency: int):
+    results = []
+
+    async def on_result(key, path, season):
+        results.append(season)
+
+    async with VLMClient(api_url=url, concurrency=concurrency, backoff_base=0.05) as client:
+        items = [(i, f"image_{i}.jpg") for i in range(images)]
+        await client.classify_all(items, lambda path: FAKE_IMAGE, on_result)
+        return client.metrics.as_dict()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VLM 客户端吞吐量测试")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟服务每个请求的处理时间 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务返回 502 的概率")
+    parser.add_argument("--capacity", type=int, default=8, help="模拟服务同时处理的请求数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args(argv)
+
+    server = serve_in_thread(latency=args.latency, error_rate=args.error_rate, capacity=args.capacity)
+    try:
+        for concurrency in args.concurrency:
+            metrics = asyncio.run(run_client(server.url, args.images, concurrency))
+            metrics['concurrency'] = concurrency
+            metrics['server_max_in_flight'] = server.max_in_flight
+            server.max_in_flight = 0
+            print(json.dumps(metrics, ensure_ascii=False))
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
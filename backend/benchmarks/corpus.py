@@ -0,0 +1,176 @@
+"""
+合成图片库，用于可重复的基准测试。
+
+按固定的随机种子生成图片: 渐变背景 + 色块 + 噪声，使 JPEG/PNG/WebP 的编码体积与解码耗时接近真实照片，
+而不是纯色图片那样几乎不需要解码。图片尺寸与格式按给定的比例混合，
+还可以混入一定比例的完全重复文件与损坏文件，覆盖去重与错误处理的路径。
+相同参数生成的图片库完全相同；目录中的 corpus.json 记录生成参数，参数一致时直接复用已有的图片库。
+
+用法:
+    python -m backend.benchmarks.corpus /tmp/corpus --count 1000 --formats jpg=0.7 png=0.2 webp=0.1
+"""
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_FORMATS = {"jpg": 0.7, "png": 0.2, "webp": 0.1}
+# 常见的相机与手机照片尺寸
+DEFAULT_SIZES = ((1600, 1200), (1920, 1080), (4032, 3024), (3000, 4000))
+MANIFEST = "corpus.json"
+FILES_PER_DIR = 1000  # 每个子目录的图片数，模拟按日期分目录的图库
+NOISE_TILE = 61  # 噪声块的边长 (素数，平铺后不容易出现与 JPEG 8x8 块对齐的规律)
+
+def parse_mix(specs, default):
+    """解析 ["jpg=0.7", "png=0.3"] 形式的比例参数，返回归一化后的 {名称: 比例}"""
+    if not specs:
+        return dict(default)
+    mix = {}
+    for spec in specs:
+        name, _, weight = spec.partition("=")
+        mix[name.lower()] = float(weight or 1)
+    total = sum(mix.values())
+    return {name: weight / total for name, weight in mix.items()}
+
+def parse_sizes(specs):
+    """解析 ["1920x1080", ...] 形式的尺寸参数"""
+    if not specs:
+        return DEFAULT_SIZES
+    return tuple(tuple(int(value) for value in spec.lower().split("x")) for spec in specs)
+
+def render_image(rng, width: int, height: int):
+    """生成一张 (height, width, 3) uint8 图像"""
+    # 在低分辨率上生成内容再放大，速度快且保留真实照片的大面积色彩变化
+    small_w, small_h = max(8, width // 16), max(8, height // 16)
+    y = np.linspace(0, 1, small_h, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 1, small_w, dtype=np.float32)[None, :, None]
+    start, end = rng.random((2, 1, 1, 3), dtype=np.float32)
+    base = start + (end - start) * (x * rng.random() + y * rng.random())
+    for _ in range(rng.integers(3, 8)):
+        x0, y0 = rng.integers(0, small_w), rng.integers(0, small_h)
+        base[y0:y0 + rng.integers(2, small_h // 2 + 3), x0:x0 + rng.integers(2, small_w // 2 + 3)] = rng.random(3)
+    small = Image.fromarray((np.clip(base, 0, 1) * 255).astype(np.uint8))
+    pixels = np.array(small.resize((width, height), Image.BILINEAR))
+    # 平铺一小块噪声，代替逐像素生成随机数；先把像素值限制在 [12, 243]，加减噪声后不会溢出
+    tile = rng.integers(-12, 13, size=(NOISE_TILE, NOISE_TILE, 1)).astype(np.uint8)
+    strip = np.tile(tile, (1, -(-width // NOISE_TILE), 3))[:, :width]
+    np.clip(pixels, 12, 243, out=pixels)
+    for top in range(0, height, NOISE_TILE):
+        rows = pixels[top:top + NOISE_TILE]
+        rows += strip[:len(rows)]
+    return pixels
+
+def _save(pixels, path: str, fmt: str):
+    img = Image.fromarray(pixels)
+    if fmt == "jpg":
+        img.save(path, "JPEG", quality=90)
+    elif fmt == "png":
+        img.save(path, "PNG", compress_level=1)
+    elif fmt == "webp":
+        img.save(path, "WEBP", quality=85, method=0)
+    else:
+        raise ValueError(f"不支持的图片格式: {fmt}")
+
+def _write_image(task):
+    """在进程池中生成一个文件: task = (路径, 格式, 宽, 高, 是否损坏, 种子)"""
+    path, fmt, width, height, corrupt, seed = task
+    _save(render_image(np.random.default_rng(seed), width, height), path, fmt)
+    if corrupt:
+        with open(path, "r+b") as f:
+            f.truncate(max(64, os.path.getsize(path) // 3))
+    return os.path.getsize(path)
+
+def generate_corpus(directory: str, count: int, formats=None, sizes=DEFAULT_SIZES, duplicate_rate: float = 0.0,
+                    corrupt_rate: float = 0.0, seed: int = 0, workers: int = 0):
+    """
+    在 directory 中生成 count 个图片文件 (已存在且参数相同的图片库直接复用)。
+    每张图片使用独立的种子 (seed, 序号)，因此多进程生成的结果与单进程相同。
+    :param formats: {格式: 比例}，格式为 jpg / png / webp。
+    :param duplicate_rate: 完全重复文件 (复制此前生成的某张图片) 的比例。
+    :param corrupt_rate: 损坏文件 (截断的图片) 的比例。
+    :param workers: 生成图片的进程数，0 表示 CPU 核数。
+    :return: 生成参数与统计 (文件数、总大小、各格式数量)。
+    """
+    formats = dict(formats or DEFAULT_FORMATS)
+    params = {
+        'count': count, 'formats': formats, 'sizes': [list(size) for size in sizes],
+        'duplicate_rate': duplicate_rate, 'corrupt_rate': corrupt_rate, 'seed': seed,
+    }
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get('params') == params:
+            return manifest
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    # 先确定每个文件的类型、格式与尺寸，再并行生成
+    rng = np.random.default_rng(seed)
+    names = list(formats)
+    weights = np.array([formats[name] for name in names])
+    kinds = rng.choice(["image", "duplicate", "corrupt"], size=count,
+                       p=[1 - duplicate_rate - corrupt_rate, duplicate_rate, corrupt_rate])
+    kinds[0] = "image"  # 第一个文件必须是可复制的原图
+    by_format = {name: 0 for name in names}
+    tasks = []
+    copies = []  # [(原图路径, 副本路径), ...]
+    originals = []
+    for i in range(count):
+        subdir = os.path.join(directory, f"{i // FILES_PER_DIR:04d}")
+        os.makedirs(subdir, exist_ok=True)
+        if kinds[i] == "duplicate":
+            source = originals[rng.integers(len(originals))]
+            copies.append((source, os.path.join(subdir, f"img_{i:07d}{os.path.splitext(source)[1]}")))
+            continue
+        fmt = names[rng.choice(len(names), p=weights)]
+        width, height = sizes[rng.integers(len(sizes))]
+        path = os.path.join(subdir, f"img_{i:07d}.{fmt}")
+        tasks.append((path, fmt, width, height, kinds[i] == "corrupt", (seed, i)))
+        if kinds[i] == "image":
+            originals.append(path)
+            by_format[fmt] += 1
+
+    total_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for size in executor.map(_write_image, tasks, chunksize=4):
+            total_bytes += size
+    for source, path in copies:
+        shutil.copyfile(source, path)
+        total_bytes += os.path.getsize(path)
+
+    manifest = {
+        'params': params,
+        'files': count,
+        'images': len(originals),
+        'duplicates': len(copies),
+        'corrupt': len(tasks) - len(originals),
+        'by_format': by_format,
+        'total_mb': round(total_bytes / (1024 * 1024), 1),
+    }
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成图片库")
+    parser.add_argument("directory")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--formats", nargs="*", help="格式比例，例如 jpg=0.7 png=0.2 webp=0.1")
+    parser.add_argument("--sizes", nargs="*", help="图片尺寸，例如 1920x1080 4032x3024")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0, help="生成图片的进程数，0 表示 CPU 核数")
+    args = parser.parse_args(argv)
+    manifest = generate_corpus(args.directory, args.count, parse_mix(args.formats, DEFAULT_FORMATS),
+                               sizes=parse_sizes(args.sizes), duplicate_rate=args.duplicate_rate,
+                               corrupt_rate=args.corrupt_rate, seed=args.seed, workers=args.workers)
+    print(json.dumps(manifest, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+模拟 OpenAI chat-completions 接口的本地 VLM 服务，用于在没有 GPU 的环境中测试和压测 VLM 客户端。
+
+可以设置每个请求的延迟、返回 502 的概率，以及服务端同时处理的请求数 (模拟 GPU 的批处理能力)。
+
+用法:
+    python -m backend.benchmarks.fake_vlm_server --port 1234 --latency 0.5 --error-rate 0.05
+    PHOTO_INSIGHT_VLM_URL=http://127.0.0.1:1234/v1/chat/completions python -m backend.classify_seasons
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEASONS = ["Spring", "Summer", "Autumn", "Winter"]
+
+class FakeVLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency: float = 0.2, error_rate: float = 0.0, capacity: int = 8):
+        super().__init__(address, FakeVLMHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slots = threading.Semaphore(capacity)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+class FakeVLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive，以便测试客户端的连接复用
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path != "/v1/chat/completions" or "messages" not in payload:
+            self._send_json(404, {"error": "not found"})
+            return
+
+        with server.lock:
+            server.requests += 1
+            server._in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server._in_flight)
+        try:
+            with server.slots:
+                time.sleep(server.latency)
+            if random.random() < server.error_rate:
+                self._send_json(502, {"error": "model crashed"})
+                return
+            self._send_json(200, {
+                "id": f"chatcmpl-{server.requests}",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": random.choice(SEASONS)},
+                    "finish_reason": "stop",
+                }],
+            })
+        finally:
+            with server.lock:
+                server._in_flight -= 1
+
+def serve_in_thread(host: str = "127.0.0.1", port: int = 0, **kwargs):
+    """在后台线程中启动服务 (port=0 表示随机端口)，返回 server，调用 server.shutdown() 停止。"""
+    server = FakeVLMServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模拟 OpenAI chat-completions 接口的 VLM 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的处理时间 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 502 的概率")
+    parser.add_argument("--capacity", type=int, default=8, help="同时处理的请求数")
+    args = parser.parse_args(argv)
+
+    server = FakeVLMServer((args.host, args.port), latency=args.latency,
+                           error_rate=args.error_rate, capacity=args.capacity)
+    print(f"模拟 VLM 服务已启动: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
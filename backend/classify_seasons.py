@@ -2,20 +2,26 @@ import base64
 import logging
 import os
 import asyncio
-import requests
-import json
+import numpy as np
 from PIL import Image
 import io
 
-from . import crud, models, database
+from . import crud, models, database, metrics, migrations, clip_model, vector_db, thumbnails
+from .vlm_client import VLMClient, VLMError, CircuitOpenError
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def image_to_base64(image_path: str, max_size=1024):
+def image_to_base64(image_path: str, max_size=1024, content_hash: str = None):
     """
     将图片文件转换为 Base64 编码, 并在转换前将其等比缩小。
+    如果缩略图缓存中已有该图片的 1024px JPEG，则直接使用，不再重新解码和编码原图。
     """
+    if content_hash and max_size == thumbnails.VLM_THUMBNAIL_SIZE:
+        thumbnail = thumbnails.get_thumbnail(content_hash, max_size, image_path=image_path)
+        if thumbnail:
+            with open(thumbnail, "rb") as f:
+                return base64.b64encode(f.read()).decode('utf-8')
     try:
         with Image.open(image_path) as img:
             # 维持宽高比进行缩小
@@ -38,126 +44,313 @@ def image_to_base64(image_path: str, max_size=1024):
         logging.error(f"转换和缩放图片 '{os.path.basename(image_path)}' 时出错: {e}")
         return None
 
-
-import requests
-import json
-
-# ... (其他导入)
-
 def classify_image_season(image_path: str):
-    """使用本地 VLM 模型判断图片所属的季节。"""
+    """使用本地 VLM 模型判断单张图片所属的季节 (同步调用，批量分类请使用 classification_task)。"""
     base64_image = image_to_base64(image_path)
     if not base64_image:
         return None
 
-    headers = {
-        "Content-Type": "application/json",
-        # 模拟 curl 的 User-Agent，排除任何可能由 python-requests 引入的变量
-        "User-Agent": "curl/7.81.0" 
-    }
-    payload = {
-        "model": "gemma/gemma2-9b-it", # 请确保这里的模型名称与您在 LM Studio 中加载的一致
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Analyze the following image and determine which of the four seasons it best represents: Spring, Summer, Autumn, or Winter. Respond with only one word from the list: [Spring, Summer, Autumn, Winter]."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                ]
-            }
-        ],
-        "max_tokens": 10,
-    }
-    
-    api_url = "http://localhost:1234/v1/chat/completions"
+    async def classify():
+        async with VLMClient(concurrency=1) as client:
+            return await client.classify(base64_image)
 
     try:
-        # 手动将 payload 编码为 UTF-8 字符串，并使用 data 参数发送
-        # 这与 curl -d '...' 的行为完全一致
-        response = requests.post(api_url, headers=headers, data=json.dumps(payload).encode('utf-8'), timeout=60)
-        
-        # 检查 HTTP 状态码
-        if response.status_code == 200:
-            season = response.json()['choices'][0]['message']['content'].strip().capitalize()
-            return season
-        elif response.status_code == 502:
-            logging.error(f"接收到来自 VLM 服务的 502 Bad Gateway 错误。这通常意味着模型本身在处理图片 '{os.path.basename(image_path)}' 时崩溃或失败。请检查 LM Studio 的日志。")
-            return None
-        else:
-            logging.error(f"调用 VLM API 时收到非预期的状态码 {response.status_code}: {response.text}")
-            return None
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"使用 requests 调用 VLM API 时发生网络错误: {e}")
+        return asyncio.run(classify())
+    except VLMError as e:
+        logging.error(f"调用 VLM API 时出错: {e}")
         return None
-    except Exception as e:
-        logging.error(f"处理 API 响应时发生未知错误: {e}")
+
+# CLIP 零样本分类: 每个季节使用多条提示词，取平均后的文本向量
+SEASONS = ["Spring", "Summer", "Autumn", "Winter"]
+SEASON_PROMPTS = {
+    "Spring": ["a photo taken in spring", "a spring scene with blooming flowers and fresh green leaves"],
+    "Summer": ["a photo taken in summer", "a bright summer day with lush green trees and strong sunlight"],
+    "Autumn": ["a photo taken in autumn", "an autumn scene with red, orange and yellow fall leaves"],
+    "Winter": ["a photo taken in winter", "a winter scene with snow, ice and bare trees"],
+}
+CLIP_LOGIT_SCALE = 100.0  # 与 CLIP 训练时的 logit_scale 一致
+CLIP_BATCH_SIZE = 50000  # 每次矩阵乘法处理的向量数
+
+def season_text_embeddings():
+    """
+    计算四个季节的文本向量 (4, 512)。文本向量来自 clip_model 的 LRU 缓存，只会计算一次。
+    """
+    rows = []
+    for season in SEASONS:
+        prompts = np.stack([clip_model.get_text_features(prompt) for prompt in SEASON_PROMPTS[season]])
+        rows.append(vector_db.normalize(prompts).mean(axis=0))
+    return vector_db.normalize(np.stack(rows))
+
+def clip_season_probabilities(vectors, text_embeddings):
+    """
+    用一次矩阵乘法计算一批图片向量属于各季节的概率。
+    :return: (N, 4) float32 数组，列顺序与 SEASONS 一致。
+    """
+    logits = CLIP_LOGIT_SCALE * (vector_db.normalize(vectors) @ text_embeddings.T)
+    logits -= logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+def classify_library_with_clip(db):
+    """
+    使用已存储的 CLIP 向量对整个图库进行零样本季节分类，并保存各季节分数与置信度。
+    已由 VLM 判定过的图片保持不变。
+    :return: {image_id: {'spring', 'summer', 'autumn', 'winter', 'confidence'}}
+    """
+    text_embeddings = season_text_embeddings()
+    images_of_vector = crud.get_vector_image_map(db)
+    reviewed = crud.get_vlm_reviewed_image_ids(db)
+
+    seasons = {}
+    scores = {}
+    for vector_ids, vectors in vector_db.iter_vectors(CLIP_BATCH_SIZE):
+        probabilities = clip_season_probabilities(vectors, text_embeddings)
+        best = probabilities.argmax(axis=1)
+        for vector_id, row, best_index in zip(vector_ids, probabilities.tolist(), best.tolist()):
+            for image_id in images_of_vector.get(vector_id, ()):
+                if image_id in reviewed:
+                    continue
+                seasons[image_id] = SEASONS[best_index]
+                scores[image_id] = {
+                    'spring': row[0], 'summer': row[1], 'autumn': row[2], 'winter': row[3],
+                    'confidence': row[best_index],
+                }
+    crud.save_season_results(db, seasons, scores, source="clip")
+    logging.info(f"CLIP 零样本分类完成，共分类 {len(seasons)} 张图片")
+    return scores
+
+def _status_emitter(sio, sid):
+    async def emit_status(message, **extra):
+        logging.info(message)
+        if sio and sid:
+            await sio.emit('classification_status', dict(extra, data=message), room=sid)
+    return emit_status
+
+# 持久化工作队列的配置
+CLASSIFY_BATCH_SIZE = int(os.environ.get("PHOTO_INSIGHT_CLASSIFY_BATCH", "64"))  # 每个事务提交的分类结果数
+CLASSIFY_MAX_ATTEMPTS = int(os.environ.get("PHOTO_INSIGHT_CLASSIFY_MAX_ATTEMPTS", "3"))  # 每张图片最多尝试的次数
+
+# 正在运行的分类任务 (同一时间只运行一个): {'job_id': ..., 'cancel': asyncio.Event}
+_active = None
+
+def is_running():
+    return _active is not None
+
+def cancel_classification():
+    """请求取消正在运行的分类任务 (进行中的请求完成、结果提交后停止)，返回任务 ID；没有任务时返回 None。"""
+    if _active is None:
         return None
+    _active['cancel'].set()
+    return _active['job_id']
+
+def prepare_classification_job(db, kind: str, force: bool = False, vlm_threshold: float = None):
+    """
+    准备一个分类任务: 没有 force 时继续同类型中最近一个未完成的任务 (review 任务要求阈值相同)，
+    否则放弃旧任务并新建；然后把需要分类的图片加入工作队列 (已在队列中的保持原状态)。
+    :return: (job, 新加入队列的图片数)
+    """
+    job = None if force else crud.get_unfinished_classification_job(db, kind)
+    if job is not None and kind == "review" and job.vlm_threshold != vlm_threshold:
+        job = None
+    if job is None:
+        previous = crud.get_unfinished_classification_job(db, kind)
+        if previous is not None:
+            crud.discard_classification_job(db, previous.id)
+        job = crud.create_classification_job(db, kind, force=force, vlm_threshold=vlm_threshold)
+    else:
+        logging.info(f"继续未完成的分类任务 {job.id} (已完成 {job.processed}/{job.total})")
+    added = crud.enqueue_classification_items(db, job)
+    orphaned = crud.delete_orphaned_classification_items(db, job.id)
+    if orphaned:
+        logging.info(f"已从分类任务 {job.id} 的工作队列中移除 {orphaned} 张已删除的图片")
+    counts = crud.count_classification_items(db, job.id)
+    crud.update_classification_job(db, job.id, status="running", error=None,
+                                   total=sum(counts.values()), processed=counts['done'] + counts['failed'],
+                                   failed=counts['failed'])
+    db.refresh(job)
+    return job, added
 
-async def classification_task(sio=None, sid=None):
+async def run_classification_job(db, job, emit_status, should_stop=None):
     """
-    ���行分类的核心任务。
+    按批次处理分类任务的工作队列，直到队列为空或被取消。
+    每批的分类结果与队列状态在同一个事务中提交，中断后最多损失一个批次的结果。
+    失败的图片留在队列中，排在未尝试的图片之后重试，达到 CLASSIFY_MAX_ATTEMPTS 次后不再重试。
+    :return: {'job_id', 'classified', 'failed', 'cancelled', 'metrics'}
+    :raises CircuitOpenError: VLM 服务不可用；已提交的结果保留，任务可以稍后继续。
+    """
+    total = job.total
+    done = job.processed
+    failed = job.failed
+    classified = 0
+    estimator = metrics.RateEstimator(total, done=done)
+
+    async with VLMClient() as client:
+        async def report(message):
+            rate = estimator.update(done)
+            await emit_status(f"({done}/{total}) {message}，{rate['throughput']} 张/秒，"
+                              f"预计剩余 {metrics.format_eta(rate['eta_seconds'])}",
+                              job_id=job.id, metrics=client.metrics.as_dict(), **rate)
+
+        while not (should_stop and should_stop()):
+            batch = crud.next_classification_batch(db, job.id, CLASSIFY_BATCH_SIZE)
+            if not batch:
+                break
+            attempts = {row.image_id: row.attempts for row in batch}
+            content_hashes = {row.path: row.content_hash for row in batch}
+            seasons = {}
+            failures = {}
+
+            async def on_result(image_id, path, season):
+                nonlocal done, classified
+                if season in SEASONS:
+                    seasons[image_id] = season
+                    done += 1
+                    classified += 1
+                    await report(f"已分类: {os.path.basename(path)}")
+                else:
+                    await on_error(image_id, path, f"模型返回未知分类: '{season}'")
+
+            async def on_error(image_id, path, reason):
+                nonlocal done, failed
+                logging.warning(f"未能确定图片 '{path}' 的季节 (第 {attempts[image_id] + 1} 次尝试): {reason}")
+                failures[image_id] = reason
+                if attempts[image_id] + 1 >= CLASSIFY_MAX_ATTEMPTS:
+                    done += 1
+                    failed += 1
+                await report(f"分类失败: {os.path.basename(path)}")
+
+            # 优先使用缩略图缓存中的 1024px JPEG
+            load_image = lambda path: image_to_base64(path, content_hash=content_hashes.get(path))
+            try:
+                await client.classify_all([(row.image_id, row.path) for row in batch], load_image,
+                                          on_result, on_error, should_stop=should_stop)
+            finally:
+                # 熔断或取消时同样提交已得到的结果；未处理的图片仍在队列中
+                crud.complete_classification_batch(db, job.id, seasons, failures, CLASSIFY_MAX_ATTEMPTS)
+                crud.update_classification_job(db, job.id, processed=done, failed=failed)
+
+        cancelled = bool(should_stop and should_stop())
+        if not cancelled:
+            # 运行期间删除的图片已从队列中移除 (见 crud.delete_images)，按队列的实际条目更新总数
+            counts = crud.count_classification_items(db, job.id)
+            crud.update_classification_job(db, job.id, total=sum(counts.values()),
+                                           processed=counts['done'] + counts['failed'], failed=counts['failed'])
+            crud.finish_classification_job(db, job.id)
+        return {'job_id': job.id, 'classified': classified, 'failed': failed, 'cancelled': cancelled,
+                'metrics': client.metrics.as_dict()}
+
+async def classification_task(sio=None, sid=None, mode: str = "vlm", vlm_threshold: float = None,
+                              force: bool = False, should_stop=None):
+    """
+    执行分类的核心任务。
     如果提供了 sio 和 sid，则通过 Socket.IO 发送进度更新。
+    :param mode: "vlm" 并发调用 VLM 逐张分类尚未由 VLM 判定的图片; "clip" 使用已存储的 CLIP 向量一次性完成整个图库的零样本分类。
+    :param vlm_threshold: 仅在 clip 模式下有效，置信度低于该值的图片再交给 VLM 复核。
+    :param force: 重新分类所有图片，不继续未完成的任务。
+    :param should_stop: 可选的取消检查回调 (工作进程中由任务队列的取消请求触发)，与 cancel_classification() 等效。
+    VLM 分类通过持久化的工作队列进行 (见 prepare_classification_job)，中断或取消后再次启动会从上次的进度继续。
     """
-    logging.info("开始季节分类任务...")
-    if sio and sid:
-        await sio.emit('classification_status', {'data': '分类任务已开始...'}, room=sid)
+    global _active
+    emit_status = _status_emitter(sio, sid)
+    if _active is not None:
+        await emit_status(f"已有分类任务正在运行 ({_active['job_id']})")
+        return
+    cancel = asyncio.Event()
+    _active = {'job_id': None, 'cancel': cancel}
+    await emit_status('CLIP 零样本分类任务已开始...' if mode == "clip" else '分类任务已开始...')
 
     db = database.SessionLocal()
+    job = None
     try:
-        images = crud.get_all_images(db)
-        images_to_classify = [img for img in images if img.vector_id]
-        total_images = len(images_to_classify)
-        
-        logging.info(f"发现 {total_images} 张需要分类的图片。")
-        if sio and sid:
-            await sio.emit('classification_status', {'data': f'发现 {total_images} 张需要分类的图片。'}, room=sid)
-            await asyncio.sleep(1)
-
-        season_map = {
-            "Spring": crud.add_photo_to_spring,
-            "Summer": crud.add_photo_to_summer,
-            "Autumn": crud.add_photo_to_autumn,
-            "Winter": crud.add_photo_to_winter,
-        }
-
-        for i, image in enumerate(images_to_classify):
-            status_msg = f"({i+1}/{total_images}) 正在分类: {os.path.basename(image.path)}"
-            logging.info(status_msg)
-            if sio and sid:
-                await sio.emit('classification_status', {'data': status_msg}, room=sid)
+        result = {}
+        if mode == "clip":
+            loop = asyncio.get_running_loop()
+            scores = await loop.run_in_executor(None, classify_library_with_clip, db)
+            confidences = [score['confidence'] for score in scores.values()]
+            mean_confidence = float(np.mean(confidences)) if confidences else 0.0
+            await emit_status(f'CLIP 已分类 {len(scores)} 张图片，平均置信度 {mean_confidence:.2f}')
+            result['classified'] = len(scores)
+            if vlm_threshold is not None:
+                job, added = prepare_classification_job(db, "review", force=force, vlm_threshold=vlm_threshold)
+        else:
+            job, added = prepare_classification_job(db, "vlm", force=force)
 
-            # 在循环内部调用，以避免阻塞事件循环太久
-            loop = asyncio.get_event_loop()
-            season = await loop.run_in_executor(None, classify_image_season, image.path)
-            
-            if season and season in season_map:
-                try:
-                    season_map[season](db, image_id=image.id)
-                    logging.info(f"成功将图片 ID {image.id} 添加到 {season} 表中。")
-                except Exception as e:
-                    if "UNIQUE constraint failed" in str(e):
-                        logging.warning(f"图片 ID {image.id} 已在 {season} 表中，跳过。")
-                    else:
-                        logging.error(f"添加图片 ID {image.id} 到数据库时出错: {e}")
-            elif season:
-                logging.warning(f"模型返回未知分类: '{season}'，跳过图片。")
+        if job is not None:
+            _active['job_id'] = job.id
+            pending = job.total - job.processed
+            await emit_status(f'分类任务 {job.id[:8]}: 共 {job.total} 张图片，待处理 {pending} 张 (新加入 {added} 张)',
+                              job_id=job.id)
+            stop = lambda: cancel.is_set() or bool(should_stop and should_stop())
+            outcome = await run_classification_job(db, job, emit_status, should_stop=stop)
+            if mode == "clip":
+                result['vlm_reviewed'], result['metrics'] = outcome['classified'], outcome['metrics']
+                result.update(job_id=outcome['job_id'], failed=outcome['failed'], cancelled=outcome['cancelled'])
             else:
-                logging.warning(f"未能确定图片 '{image.path}' 的季节，跳过。")
-            
-            await asyncio.sleep(0.05)
+                result.update(outcome)
+            if outcome['cancelled']:
+                crud.update_classification_job(db, job.id, status="cancelled")
 
-        logging.info("所有图片季节分类任务完成。")
+        logging.info(f"所有图片季节分类任务完成: {result}")
         if sio and sid:
-            await sio.emit('classification_complete', {'data': '所有图片季节分类完成！'}, room=sid)
-
+            message = '分类已取消，再次启动会从当前进度继续' if result.get('cancelled') else '所有图片季节分类完成！'
+            await sio.emit('classification_complete', dict(result, data=message), room=sid)
+    except CircuitOpenError as e:
+        logging.error(f"VLM 服务不可用，分类任务已停止: {e}")
+        _mark_failed(db, job, e)
+        if sio and sid:
+            await sio.emit('error', {'data': f'VLM 服务不可用，分类已停止 (再次启动会从当前进度继续): {str(e)}'}, room=sid)
     except Exception as e:
         logging.error(f"分类过程中发生严重错误: {e}")
+        _mark_failed(db, job, e)
         if sio and sid:
             await sio.emit('error', {'data': f'分类出错: {str(e)}'}, room=sid)
+    finally:
+        _active = None
+        db.close()
+
+def _mark_failed(db, job, error):
+    if job is None:
+        return
+    try:
+        db.rollback()
+        crud.update_classification_job(db, job.id, status="failed", error=str(error))
+    except Exception as e:
+        logging.error(f"保存分类任务 {job.id} 状态时出错: {e}")
+
+def classification_status():
+    """最近一个分类任务的状态与队列统计，没有任务时返回 None。"""
+    db = database.SessionLocal()
+    try:
+        job = crud.get_latest_classification_job(db)
+        if job is None:
+            return None
+        running = _active is not None and _active['job_id'] == job.id
+        if not running and job.status == "running":
+            # 多进程部署时分类任务在工作进程中运行 (见 worker.py)
+            running = any(task.status == "running" for task in crud.get_active_worker_tasks(db, "classification"))
+        return {
+            'job_id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'running': running,
+            'force': bool(job.force),
+            'total': job.total,
+            'processed': job.processed,
+            'failed': job.failed,
+            'error': job.error,
+            'queue': crud.count_classification_items(db, job.id),
+        }
     finally:
         db.close()
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="季节分类 (未完成的任务会从上次的进度继续)")
+    parser.add_argument("--mode", choices=["vlm", "clip"], default="vlm")
+    parser.add_argument("--vlm-threshold", type=float, help="clip 模式下交给 VLM 复核的置信度阈值")
+    parser.add_argument("--force", action="store_true", help="重新分类所有图片")
+    args = parser.parse_args()
     models.Base.metadata.create_all(bind=database.engine)
-    asyncio.run(classification_task())
+    migrations.run_migrations()
+    asyncio.run(classification_task(mode=args.mode, vlm_threshold=args.vlm_threshold, force=args.force))
@@ -1,23 +1,171 @@
-from transformers import CLIPProcessor, CLIPModel
-from PIL import Image
-import torch
+"""
+CLIP 模型。
+
+torch 与 transformers 在第一次需要推理时才导入并加载模型 (load_model)，
+导入本模块本身很快，服务启动后可以立即处理不需要模型的请求 (例如加载图片列表)。
+也可以通过 warmup() 在后台线程中提前加载。
+推理由可选的后端完成 (见 inference_backends.py)，通过 PHOTO_INSIGHT_INFERENCE_BACKEND 选择。
+"""
+import functools
 import logging
+import os
+import threading
+import time
+import numpy as np
+
+from . import preprocess
 
 # 配置
 MODEL_NAME = "openai/clip-vit-base-patch32"
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+EMBEDDING_DIM = 512
+BATCH_SIZE = 32  # 每次前向推理的图片数量
+TEXT_CACHE_SIZE = 1024  # 缓存的文本查询向量数量
+INFERENCE_BACKEND = os.environ.get("PHOTO_INSIGHT_INFERENCE_BACKEND", "torch")  # torch / torchscript / int8 / onnx
+NUM_THREADS = int(os.environ.get("PHOTO_INSIGHT_NUM_THREADS", "0"))  # 推理线程数，0 表示使用默认值
+LOAD_RETRY_SECONDS = float(os.environ.get("PHOTO_INSIGHT_MODEL_RETRY_SECONDS", "30"))  # 加载失败后多久允许重试
+LOAD_RETRY_MAX_SECONDS = 600.0  # 连续失败时重试间隔逐次加倍，最长不超过该值
+
+class ModelUnavailableError(RuntimeError):
+    """CLIP 模型无法加载 (失败原因见 status())"""
+
+# 以下全局变量由 load_model() 在第一次调用时设置
+encoder = None
+processor = None
+DEVICE = None
+_load_lock = threading.Lock()
+_load_error = None
+_load_seconds = None
+_load_failures = 0  # 连续加载失败的次数
+_retry_at = 0.0  # time.monotonic() 达到该值之前不再尝试加载
+
+def load_model():
+    """
+    加载 CLIP 模型与处理器，并创建所选的推理后端 (线程安全，只加载一次)。
+    加载失败 (例如下载模型时网络中断、内存暂时不足) 后的 LOAD_RETRY_SECONDS 秒内直接返回 False，
+    之后的调用会重新尝试加载；连续失败时间隔逐次加倍。失败原因见 status()。
+    :return: 模型可用时返回 True。
+    """
+    global encoder, processor, DEVICE, _load_error, _load_seconds, _load_failures, _retry_at
+    if encoder is not None:
+        return True
+    with _load_lock:
+        if encoder is not None:
+            return True
+        if _load_error is not None and time.monotonic() < _retry_at:
+            return False
+        started = time.perf_counter()
+        try:
+            import torch
+            from transformers import CLIPProcessor, CLIPModel
+            from . import inference_backends
+
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            logging.info(f"CLIP 模型正在使用设备: {device}，推理后端: {INFERENCE_BACKEND}")
+            model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
+            model.eval()
+            processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+            created = inference_backends.create_encoder(INFERENCE_BACKEND, torch, model, device, MODEL_NAME,
+                                                        num_threads=NUM_THREADS)
+            DEVICE = getattr(created, "device", "cpu")
+            # 最后设置 encoder，其他线程看到 encoder 不为 None 时其余字段均已就绪
+            encoder = created
+            _load_error = None
+            _load_failures = 0
+            _load_seconds = time.perf_counter() - started
+            logging.info(f"CLIP 模型 '{MODEL_NAME}' 加载成功，耗时 {_load_seconds:.1f} 秒")
+            return True
+        except Exception as e:
+            _load_failures += 1
+            delay = min(LOAD_RETRY_SECONDS * 2 ** (_load_failures - 1), LOAD_RETRY_MAX_SECONDS)
+            _retry_at = time.monotonic() + delay
+            logging.error(f"加载 CLIP 模型失败 (第 {_load_failures} 次，{delay:.0f} 秒后可重试): {e}")
+            _load_error = str(e)
+            return False
 
-logging.info(f"CLIP 模型正在使用设备: {DEVICE}")
+def is_loaded():
+    return encoder is not None
 
-# 全局加载模型和处理器，避免重复加载
-try:
-    model = CLIPModel.from_pretrained(MODEL_NAME).to(DEVICE)
-    processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-    logging.info(f"CLIP 模型 '{MODEL_NAME}' 加载成功")
-except Exception as e:
-    logging.error(f"加载 CLIP 模型失败: {e}")
-    model = None
-    processor = None
+def status():
+    """模型的加载状态，用于健康检查。"""
+    return {
+        'loaded': encoder is not None,
+        'loading': _load_lock.locked(),
+        'device': DEVICE,
+        'inference_backend': INFERENCE_BACKEND,
+        'load_seconds': round(_load_seconds, 2) if _load_seconds is not None else None,
+        'error': _load_error,
+        'retry_in_seconds': round(max(_retry_at - time.monotonic(), 0.0), 1) if _load_error is not None else None,
+    }
+
+def embedding_source():
+    """产生向量的模型与推理后端，写入向量库时记录 (见 vector_db.check_embedding_source)。"""
+    return {'model': MODEL_NAME, 'inference_backend': INFERENCE_BACKEND}
+
+def warmup():
+    """在后台线程中加载模型，不阻塞调用方。"""
+    threading.Thread(target=load_model, name="clip-warmup", daemon=True).start()
+
+def encode_pixel_batch(pixel_batch):
+    """
+    对一批已解码的图片 (见 preprocess.decode_image) 执行一次前向推理。
+    :param pixel_batch: (224, 224, 3) uint8 数组的列表。
+    :return: (N, 512) float32 numpy 数组。
+    :raises ModelUnavailableError: 模型无法加载时。
+    """
+    if not load_model():
+        raise ModelUnavailableError(f"CLIP 模型未加载: {_load_error}")
+    return encoder.encode_image(preprocess.to_pixel_values(pixel_batch))
+
+def get_image_features_batch(image_paths, batch_size: int = BATCH_SIZE):
+    """
+    批量为图片生成特征向量。
+    每个微批次内的图片会被解码、堆叠成一个张量，并在一次 torch.no_grad() 前向推理中完成。
+    无法读取的图片会被逐个记录，不影响同批次的其他图片。
+    :param image_paths: 图片文件绝对路径的列表。
+    :param batch_size: 每次前向推理的图片数量。
+    :return: (paths, features, failed) 三元组:
+             paths 为成功提取特征的路径列表;
+             features 为与 paths 一一对应的 (N, 512) float32 numpy 数组;
+             failed 为 {路径: 错误信息} 字典。
+    """
+    image_paths = list(image_paths)
+    if not load_model():
+        logging.error("CLIP 模型未正确加载，无法提取特征。")
+        return [], np.empty((0, EMBEDDING_DIM), dtype=np.float32), {p: "CLIP 模型未加载" for p in image_paths}
+
+    ok_paths = []
+    chunks = []
+    failed = {}
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = []
+        pixels = []
+        for path in image_paths[start:start + batch_size]:
+            try:
+                pixels.append(preprocess.decode_image(path))
+                batch_paths.append(path)
+            except FileNotFoundError:
+                logging.error(f"图片文件未找到: {path}")
+                failed[path] = "文件未找到"
+            except Exception as e:
+                logging.error(f"读取图片时发生错误 ({path}): {e}")
+                failed[path] = str(e)
+
+        if not pixels:
+            continue
+
+        try:
+            chunks.append(encode_pixel_batch(pixels))
+            ok_paths.extend(batch_paths)
+        except Exception as e:
+            logging.error(f"批量提取图片特征时发生错误 ({len(batch_paths)} 张): {e}")
+            for path in batch_paths:
+                failed[path] = str(e)
+
+    if chunks:
+        features = np.concatenate(chunks, axis=0)
+    else:
+        features = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return ok_paths, features, failed
 
 def get_image_features(image_path: str):
     """
@@ -25,21 +173,37 @@ def get_image_features(image_path: str):
     :param image_path: 图片文件的绝对路径。
     :return: 图片的特征向量 (numpy array) 或在失败时返回 None。
     """
-    if not model or not processor:
-        logging.error("CLIP 模型未正确加载，无法提取特征。")
+    paths, features, _ = get_image_features_batch([image_path], batch_size=1)
+    if not paths:
         return None
+    return features[0]
 
-    try:
-        image = Image.open(image_path).convert("RGB")
-        inputs = processor(images=image, return_tensors="pt", padding=True, truncation=True).to(DEVICE)
-        with torch.no_grad():
-            image_features = model.get_image_features(**inputs)
-        
-        # 将向量移动到 CPU 并转换为 numpy 数组
-        return image_features.cpu().numpy().flatten()
-    except FileNotFoundError:
-        logging.error(f"图片文件未找到: {image_path}")
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _encode_text(text: str):
+    from .inference_backends import TEXT_MAX_LENGTH
+
+    # 补齐到固定长度: CLIP 文本编码器使用因果注意力并取 EOS 位置的输出，补齐不影响结果
+    inputs = processor(text=[text], return_tensors="np", padding="max_length",
+                       max_length=TEXT_MAX_LENGTH, truncation=True)
+    features = encoder.encode_text(inputs["input_ids"], inputs["attention_mask"]).flatten()
+    # 缓存中的数组被多个请求共享，设为只读防止被意外修改
+    features.setflags(write=False)
+    return features
+
+def get_text_features(text: str):
+    """
+    使用 CLIP 文本编码器为查询文本生成特征向量。
+    结果按规范化后的文本缓存 (LRU)，重复查询和翻页不会再次运行模型。
+    :return: (512,) float32 只读 numpy 数组，或在失败时返回 None。
+    """
+    if not load_model():
+        logging.error("CLIP 模型未正确加载，无法提取文本特征。")
+        return None
+    text = " ".join(text.split())
+    if not text:
         return None
+    try:
+        return _encode_text(text)
     except Exception as e:
-        logging.error(f"提取图片特征时发生错误 ({image_path}): {e}")
+        logging.error(f"提取文本特征时发生错误 ('{text}'): {e}")
         return None
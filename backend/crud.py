@@ -1,107 +1,791 @@
+from sqlalchemy import and_, exists, func, insert, literal, or_, select, text
 from sqlalchemy.orm import Session
-from . import models, clip_model, vector_db
+from . import models, clip_model, embedding_cache, metrics, thumbnails, vector_db
 import os
 import datetime
+import json
 import uuid
 import logging
+import time
+import numpy as np
+
+SQL_CHUNK_SIZE = 500  # IN (...) 查询每次携带的参数数量
+IMAGE_PAGE_SIZE = 500  # 图片列表每页的默认条数
+MAX_IMAGE_PAGE_SIZE = 5000
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 def get_image_by_path(db: Session, path: str):
     """根据路径查询图片"""
     return db.query(models.Image).filter(models.Image.path == path).first()
 
+def _fingerprint_fields(file_stat):
+    """从 os.stat 结果中提取用于增量扫描的文件指纹字段"""
+    return {
+        'mtime': file_stat.st_mtime,
+        'size_bytes': file_stat.st_size,
+        'inode': file_stat.st_ino or None,
+    }
+
+def _get_images_by_paths(db: Session, paths):
+    """一次查询 (按块) 获取多条路径对应的图片记录: {path: Image}"""
+    images = {}
+    for chunk in _chunks(list(paths), SQL_CHUNK_SIZE):
+        for db_image in db.query(models.Image).filter(models.Image.path.in_(chunk)):
+            images[db_image.path] = db_image
+    return images
+
 def create_image_record(db: Session, path: str):
     """创建新的图片记录, 包括生成和存储特征向量。"""
+    results, _ = create_image_records(db, [path])
+    return results[0] if results else None
+
+def create_image_records(db: Session, paths, batch_size: int = clip_model.BATCH_SIZE):
+    """
+    批量创建图片记录。特征向量以微批次的方式生成，单个文件失败不会影响同批次的其他文件。
+    :return: (created, failed) —— created 为成功索引的 Image 列表，failed 为 {路径: 错误信息}。
+    """
     # 检查记录是否已存在且已向量化
-    db_image = get_image_by_path(db, path)
-    if db_image and db_image.vector_id:
-        logging.info(f"图片已完整索引，跳过: {path}")
-        return None
+    existing = _get_images_by_paths(db, paths)
+    pending = []
+    for path in paths:
+        db_image = existing.get(path)
+        if db_image and db_image.vector_id:
+            logging.info(f"图片已完整索引，跳过: {path}")
+        else:
+            pending.append(path)
+
+    if not pending:
+        return [], {}
+
+    # 内容相同的图片若已在向量缓存中，直接使用缓存的向量
+    failed = {}
+    content_hashes = {}
+    for path in pending:
+        try:
+            content_hashes[path] = thumbnails.hash_file(path)
+        except OSError as e:
+            failed[path] = "文件未找到" if isinstance(e, FileNotFoundError) else str(e)
+    cache = embedding_cache.get_cache()
+    cache_key = embedding_cache.cache_key() if cache is not None else None
+    cached = cache.get_many(cache_key, content_hashes.values()) if cache is not None else {}
+    hit_paths = [path for path, content_hash in content_hashes.items() if content_hash in cached]
+    miss_paths = [path for path, content_hash in content_hashes.items() if content_hash not in cached]
+    if cache is not None:
+        cache.record(len(hit_paths), len(miss_paths))
+
+    # 为其余图片生成并存储特征向量
+    logging.info(f"正在为 {len(miss_paths)} 张图片批量生成特征向量 (缓存命中 {len(hit_paths)} 张)")
+    ok_paths, features, inference_failed = clip_model.get_image_features_batch(miss_paths, batch_size=batch_size)
+    for path in inference_failed:
+        logging.error(f"为图片生成特征向量失败: {path}")
+    failed.update(inference_failed)
+    if cache is not None:
+        cache.put_many(cache_key, [content_hashes[path] for path in ok_paths], features)
+
+    paths = hit_paths + ok_paths
+    if hit_paths:
+        features = np.concatenate([np.stack([cached[content_hashes[path]] for path in hit_paths]), features])
+    created, store_failures = save_image_features(db, paths, features, [content_hashes[path] for path in paths])
+    failed.update(store_failures)
+    return created, failed
+
+def save_image_features(db: Session, paths, features, content_hashes=None):
+    """
+    批量为已提取特征向量的图片创建 (或更新) 记录并存储向量。
+
+    N 条记录在同一个 SQLite 事务中写入，N 个向量在一次 ChromaDB upsert 中写入:
+    先 flush 记录 (不提交)，再写入向量，最后提交事务。
+    向量写入失败时回滚事务；事务提交失败时删除本次新建的向量。
+    因此两个存储之间不会出现没有记录的孤立向量，也不会出现没有向量的记录。
+    已有向量的记录 (文件内容被修改) 沿用原 vector_id 覆盖向量，并刷新文件指纹；
+    但与其他重复图片共用的向量不能被覆盖，此时改用新的 vector_id。
+
+    :param paths: 图片路径列表。
+    :param features: 与 paths 一一对应的 (N, 512) 特征矩阵。
+    :param content_hashes: 可选，与 paths 一一对应的图片内容哈希 (缩略图的键)。
+    :return: (images, failed) —— images 为成功写入的 Image 列表，failed 为 {路径: 错误信息}。
+    """
+    failed = {}
+    existing = _get_images_by_paths(db, paths)
+    shared = _shared_vector_ids(db, [img.vector_id for img in existing.values() if img.vector_id])
+    now = datetime.datetime.utcnow()
 
-    # 如果记录不存在，先创建基础元数据记录
-    if not db_image:
+    images = []
+    rows = []
+    new_vector_ids = []
+    for i, path in enumerate(paths):
         try:
             file_stat = os.stat(path)
+        except OSError as e:
+            logging.error(f"创建记录时无法读取文件: {path} ({e})")
+            failed[path] = "文件未找到" if isinstance(e, FileNotFoundError) else str(e)
+            continue
+
+        db_image = existing.get(path)
+        if db_image is None:
             db_image = models.Image(
                 path=path,
                 filename=os.path.basename(path),
-                size_mb=round(file_stat.st_size / (1024 * 1024), 2),
                 created_at=datetime.datetime.fromtimestamp(file_stat.st_ctime),
-                indexed_at=datetime.datetime.utcnow()
             )
             db.add(db_image)
-            db.commit()
-            db.refresh(db_image)
-        except FileNotFoundError:
-            logging.error(f"创建记录时文件未找到: {path}")
-            db.rollback()
-            return None
-        except Exception as e:
-            logging.error(f"创建初始数据库记录时出错 ({path}): {e}")
-            db.rollback()
-            return None
+        db_image.size_mb = round(file_stat.st_size / (1024 * 1024), 2)
+        db_image.indexed_at = now
+        for field, value in _fingerprint_fields(file_stat).items():
+            setattr(db_image, field, value)
+        if content_hashes is not None:
+            db_image.content_hash = content_hashes[i]
+        if not db_image.vector_id or db_image.vector_id in shared:
+            db_image.vector_id = str(uuid.uuid4())
+            new_vector_ids.append(db_image.vector_id)
+        images.append(db_image)
+        rows.append(i)
 
-    # 为图片生成并存储特征向量
+    if not images:
+        return [], failed
+
+    vector_ids = [db_image.vector_id for db_image in images]
     try:
-        logging.info(f"正在为图片生成特征向量: {path}")
-        features = clip_model.get_image_features(path)
-        if features is None:
-            logging.error(f"为图片生成特征向量失败: {path}")
-            return None
+        started = time.perf_counter()
+        db.flush()
+        flushed = time.perf_counter()
+        stored = vector_db.upsert_vectors(features[rows], vector_ids, source=clip_model.embedding_source())
+        upserted = time.perf_counter()
+        if not stored:
+            raise RuntimeError("向量存储失败")
+        db.commit()
+        metrics.STAGE_SECONDS.observe(flushed - started + time.perf_counter() - upserted, stage="db_write")
+        metrics.STAGE_SECONDS.observe(upserted - flushed, stage="vector_write")
+    except Exception as e:
+        logging.error(f"批量写入 {len(images)} 张图片时出错，已回滚: {e}")
+        db.rollback()
+        # 数据库事务未能提交，清理本次新建的向量 (被覆盖的旧向量仍与原记录对应)
+        vector_db.delete_vectors(new_vector_ids)
+        for path in (paths[i] for i in rows):
+            failed[path] = str(e)
+        return [], failed
 
-        vector_id = str(uuid.uuid4())
-        if not vector_db.add_vector(features, vector_id):
-            logging.error(f"无法将向量存入 ChromaDB: {path}")
-            return None
-        
-        # 更新 SQLite 记录以包含 vector_id
+    logging.info(f"成功批量写入 {len(images)} 张图片的记录与向量")
+    return images, failed
+
+def _shared_vector_ids(db: Session, vector_ids):
+    """返回其中被多条图片记录共用的 vector_id (完全相同的重复图片共用同一个向量)"""
+    shared = set()
+    for chunk in _chunks(list(set(vector_ids)), SQL_CHUNK_SIZE):
+        shared.update(vector_id for vector_id, count in
+                      db.query(models.Image.vector_id, func.count(models.Image.id))
+                      .filter(models.Image.vector_id.in_(chunk))
+                      .group_by(models.Image.vector_id)
+                      if count > 1)
+    return shared
+
+def _unreferenced_vector_ids(db: Session, vector_ids):
+    """返回其中已没有任何图片记录引用的 vector_id"""
+    vector_ids = set(vector_ids)
+    for chunk in _chunks(list(vector_ids), SQL_CHUNK_SIZE):
+        vector_ids.difference_update(vector_id for (vector_id,) in
+                                     db.query(models.Image.vector_id).filter(models.Image.vector_id.in_(chunk)))
+    return list(vector_ids)
+
+def save_duplicate_records(db: Session, duplicates):
+    """
+    为与已索引图片内容完全相同的文件创建 (或更新) 记录，直接共用原图片的向量与内容哈希，不需要模型推理。
+    :param duplicates: {路径: (vector_id, content_hash)}
+    :return: (images, failed) —— 与 save_image_features 相同。
+    """
+    failed = {}
+    existing = _get_images_by_paths(db, list(duplicates))
+    now = datetime.datetime.utcnow()
+    images = []
+    replaced_vector_ids = []
+    for path, (vector_id, content_hash) in duplicates.items():
+        try:
+            file_stat = os.stat(path)
+        except OSError as e:
+            failed[path] = "文件未找到" if isinstance(e, FileNotFoundError) else str(e)
+            continue
+        db_image = existing.get(path)
+        if db_image is None:
+            db_image = models.Image(
+                path=path,
+                filename=os.path.basename(path),
+                created_at=datetime.datetime.fromtimestamp(file_stat.st_ctime),
+            )
+            db.add(db_image)
+        elif db_image.vector_id and db_image.vector_id != vector_id:
+            replaced_vector_ids.append(db_image.vector_id)
+        db_image.size_mb = round(file_stat.st_size / (1024 * 1024), 2)
+        db_image.indexed_at = now
+        for field, value in _fingerprint_fields(file_stat).items():
+            setattr(db_image, field, value)
         db_image.vector_id = vector_id
-        db.commit()
-        db.refresh(db_image)
-        logging.info(f"成功为图片创建向量并更新记录: {path}")
-        return db_image
+        db_image.content_hash = content_hash
+        images.append(db_image)
 
+    if not images:
+        return [], failed
+    try:
+        db.flush()
+        # 被修改后与其他图片重复的文件，原来的向量不再被引用
+        if not vector_db.delete_vectors(_unreferenced_vector_ids(db, replaced_vector_ids)):
+            raise RuntimeError("删除旧向量失败")
+        db.commit()
     except Exception as e:
-        logging.error(f"向量化或数据库更新过程中出错 ({path}): {e}")
+        logging.error(f"写入 {len(images)} 条重复图片记录时出错，已回滚: {e}")
         db.rollback()
-        return None
+        for db_image in images:
+            failed[db_image.path] = str(e)
+        return [], failed
+    logging.info(f"{len(images)} 张重复图片共用已有向量，跳过推理")
+    return images, failed
+
+def get_fingerprints(db: Session, directory: str):
+    """
+    一次性查询目录下所有图片的指纹，用于增量扫描。
+    使用路径范围条件而不是 LIKE，以便命中 path 索引且区分大小写。
+    :return: [(id, path, mtime, size_bytes, inode, vector_id), ...]
+    """
+    prefix = os.path.join(directory, "")
+    # 紧随路径分隔符之后的字符作为上界，例如 "/photos/" -> "/photos0"
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (db.query(models.Image.id, models.Image.path, models.Image.mtime, models.Image.size_bytes,
+                     models.Image.inode, models.Image.vector_id)
+            .filter(models.Image.path >= prefix, models.Image.path < upper)
+            .all())
+
+def get_fingerprints_by_paths(db: Session, paths):
+    """
+    查询一组路径对应的图片指纹 (文件监视的增量扫描)。
+    :return: [(id, path, mtime, size_bytes, inode, vector_id), ...]
+    """
+    rows = []
+    for chunk in _chunks(list(paths), SQL_CHUNK_SIZE):
+        rows.extend(db.query(models.Image.id, models.Image.path, models.Image.mtime, models.Image.size_bytes,
+                             models.Image.inode, models.Image.vector_id)
+                    .filter(models.Image.path.in_(chunk)))
+    return rows
+
+def update_image_paths(db: Session, moves):
+    """
+    批量更新已移动/重命名图片的路径，向量保持不变。
+    :param moves: [(image_id, new_path), ...]
+    """
+    if not moves:
+        return
+    db.bulk_update_mappings(models.Image, [
+        {'id': image_id, 'path': new_path, 'filename': os.path.basename(new_path)}
+        for image_id, new_path in moves
+    ])
+    db.commit()
+
+def update_fingerprints(db: Session, fingerprints):
+    """
+    批量补全旧记录的文件指纹。
+    :param fingerprints: [(image_id, mtime, size_bytes, inode), ...]
+    """
+    if not fingerprints:
+        return
+    db.bulk_update_mappings(models.Image, [
+        {'id': image_id, 'mtime': mtime, 'size_bytes': size_bytes, 'inode': inode}
+        for image_id, mtime, size_bytes, inode in fingerprints
+    ])
+    db.commit()
+
+def delete_images(db: Session, image_ids):
+    """
+    在同一个事务中删除图片记录、标签及分类工作队列中待处理的条目，并从 ChromaDB 中移除对应的向量。
+    :return: 被删除的记录数。
+    """
+    image_ids = list(image_ids)
+    if not image_ids:
+        return 0
+    vector_ids = []
+    deleted = 0
+    # 分块执行，避免超过 SQLite 的参数数量上限
+    for chunk in _chunks(image_ids, SQL_CHUNK_SIZE):
+        vector_ids.extend(vid for (vid,) in db.query(models.Image.vector_id).filter(models.Image.id.in_(chunk)) if vid)
+        db.query(models.ImageLabel).filter(models.ImageLabel.image_id.in_(chunk)).delete(synchronize_session=False)
+        # 图片删除后这些条目不会再被领取，留在队列中会使任务的进度永远达不到总数
+        (db.query(models.ClassificationItem)
+         .filter(models.ClassificationItem.image_id.in_(chunk), models.ClassificationItem.status == "pending")
+         .delete(synchronize_session=False))
+        deleted += db.query(models.Image).filter(models.Image.id.in_(chunk)).delete(synchronize_session=False)
+    # 仍被其他重复图片引用的向量需要保留
+    vector_ids = _unreferenced_vector_ids(db, vector_ids)
+    # 向量删除失败时回滚，记录与向量保持一致
+    if not vector_db.delete_vectors(vector_ids):
+        db.rollback()
+        logging.error(f"删除向量失败，已回滚 {len(image_ids)} 条图片记录的删除")
+        return 0
+    db.commit()
+    return deleted
+
+def reconcile_vector_store(db: Session):
+    """
+    修复进程异常退出造成的不一致:
+    删除没有任何记录引用的孤立向量，并清空指向不存在向量的 vector_id (下次扫描时会重新生成)。
+    向量库不可用、为空 (而 SQLite 中仍有引用) 或没有完整遍历时放弃修复，
+    避免把向量库打开失败误判为向量全部丢失而清空所有 vector_id。
+    :return: (删除的孤立向量数, 清空的 vector_id 数)
+    """
+    known = {vid for (vid,) in db.query(models.Image.vector_id).filter(models.Image.vector_id.isnot(None))}
+    try:
+        store = vector_db.get_backend()
+        if not store.is_ready():
+            logging.warning("向量库未能正常打开，跳过一致性修复")
+            return 0, 0
+        total = store.count()
+        if total == 0 and known:
+            logging.warning(f"向量库为空，但 SQLite 中仍有 {len(known)} 个 vector_id，"
+                            f"可能打开了错误的向量库，跳过一致性修复")
+            return 0, 0
+        stored = set(store.iter_ids())
+    except Exception as e:
+        logging.warning(f"读取向量库失败，跳过一致性修复: {e}")
+        return 0, 0
+    if len(stored) < total:
+        logging.warning(f"只读取到 {len(stored)}/{total} 个向量 ID，跳过一致性修复")
+        return 0, 0
+    orphans = list(stored - known)
+    missing = list(known - stored)
+    if orphans:
+        vector_db.delete_vectors(orphans)
+    for chunk in _chunks(missing, SQL_CHUNK_SIZE):
+        db.query(models.Image).filter(models.Image.vector_id.in_(chunk)).update(
+            {models.Image.vector_id: None}, synchronize_session=False)
+    db.commit()
+    if orphans or missing:
+        logging.warning(f"已修复向量库不一致: 删除 {len(orphans)} 个孤立向量，清空 {len(missing)} 个失效的 vector_id")
+    return len(orphans), len(missing)
 
 def get_all_images(db: Session):
     """获取所有已索引的图片"""
     return db.query(models.Image).all()
 
-def add_photo_to_season(db: Session, image_id: int, season_model):
-    """将照片添加进指定的季节表"""
-    # 检查是否已存在
-    existing_entry = db.query(season_model).filter(season_model.image_id == image_id).first()
-    if existing_entry:
-        return existing_entry
-    
-    db_season_photo = season_model(image_id=image_id)
-    db.add(db_season_photo)
+# 标签类型
+LABEL_SEASON = "season"  # 每张图片最多一个季节，score 为置信度
+LABEL_SEASON_PROB = "season_prob"  # CLIP 给出的各季节概率
+SEASONS = ("Spring", "Summer", "Autumn", "Winter")
+
+def upsert_labels(db: Session, label_type: str, rows, source: str = None, exclusive: bool = False, commit: bool = True):
+    """
+    批量写入标签 (SQLite 的 INSERT ... ON CONFLICT DO UPDATE)，已有的 (image_id, label_type, label) 只更新分数与来源。
+    :param rows: [(image_id, label, score), ...]
+    :param exclusive: 每张图片在该类型下只保留一个标签 (例如季节)，写入前移除这些图片在该类型下的其他标签。
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    if exclusive:
+        by_label = {}
+        for image_id, label, _ in rows:
+            by_label.setdefault(label, []).append(image_id)
+        for label, image_ids in by_label.items():
+            for chunk in _chunks(image_ids, SQL_CHUNK_SIZE):
+                (db.query(models.ImageLabel)
+                 .filter(models.ImageLabel.label_type == label_type,
+                         models.ImageLabel.image_id.in_(chunk),
+                         models.ImageLabel.label != label)
+                 .delete(synchronize_session=False))
+
+    # 写入量可达每张图片数行，直接交给驱动以 executemany 执行，跳过 ORM 逐行处理参数的开销
+    now = str(datetime.datetime.utcnow())  # 与 SQLAlchemy 在 SQLite 中存储 DateTime 的格式一致
+    db.connection().exec_driver_sql(
+        "INSERT INTO image_labels (image_id, label_type, label, score, source, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (image_id, label_type, label) DO UPDATE SET "
+        "score = excluded.score, source = excluded.source, updated_at = excluded.updated_at",
+        [(image_id, label_type, label, score, source, now) for image_id, label, score in rows],
+    )
+    if commit:
+        db.commit()
+
+def count_labels(db: Session, label_type: str, indexed_only: bool = True):
+    """
+    分面计数: 一次 GROUP BY 查询得到该类型下每个标签的图片数。
+    :param indexed_only: 只统计已生成向量的图片。
+    :return: {label: count}
+    """
+    query = db.query(models.ImageLabel.label, func.count(models.ImageLabel.image_id)) \
+        .filter(models.ImageLabel.label_type == label_type)
+    if indexed_only:
+        query = query.join(models.Image, models.Image.id == models.ImageLabel.image_id) \
+            .filter(models.Image.vector_id.isnot(None))
+    return dict(query.group_by(models.ImageLabel.label).all())
+
+def get_vector_image_map(db: Session):
+    """一次查询所有已向量化图片的 vector_id -> [image_id, ...] 映射 (重复图片共用一个向量)"""
+    images_of_vector = {}
+    for image_id, vector_id in db.query(models.Image.id, models.Image.vector_id).filter(models.Image.vector_id.isnot(None)):
+        images_of_vector.setdefault(vector_id, []).append(image_id)
+    return images_of_vector
+
+def get_indexed_images_by_sizes(db: Session, sizes):
+    """
+    查询文件大小在 sizes 中的已索引图片，用于查找完全重复的文件。
+    :return: {size_bytes: [(path, vector_id, content_hash), ...]}
+    """
+    images_of_size = {}
+    for chunk in _chunks(list(set(sizes)), SQL_CHUNK_SIZE):
+        rows = (db.query(models.Image.size_bytes, models.Image.path, models.Image.vector_id, models.Image.content_hash)
+                .filter(models.Image.size_bytes.in_(chunk), models.Image.vector_id.isnot(None)))
+        for size_bytes, path, vector_id, content_hash in rows:
+            images_of_size.setdefault(size_bytes, []).append((path, vector_id, content_hash))
+    return images_of_size
+
+def get_duplicate_content_groups(db: Session):
+    """
+    按内容哈希分组，返回内容完全相同的图片组。
+    :return: [[(id, path, content_hash), ...], ...]
+    """
+    duplicated = (db.query(models.Image.content_hash)
+                  .filter(models.Image.content_hash.isnot(None), models.Image.vector_id.isnot(None))
+                  .group_by(models.Image.content_hash)
+                  .having(func.count(models.Image.id) > 1)
+                  .subquery())
+    groups = {}
+    rows = (db.query(models.Image.id, models.Image.path, models.Image.content_hash)
+            .filter(models.Image.content_hash.in_(duplicated.select()), models.Image.vector_id.isnot(None))
+            .order_by(models.Image.content_hash, models.Image.id))
+    for row in rows:
+        groups.setdefault(row.content_hash, []).append(row)
+    return list(groups.values())
+
+def get_image_fingerprint(db: Session):
+    """图片表的变化标记 (图片数, 最大 ID, 最近的索引时间)，图片新增、删除或重新索引后会改变"""
+    return tuple(db.query(func.count(models.Image.id), func.max(models.Image.id), func.max(models.Image.indexed_at)).one())
+
+def get_images_by_vector_ids(db: Session, vector_ids):
+    """:return: {vector_id: [(id, path, content_hash), ...]}"""
+    images_of_vector = {}
+    for chunk in _chunks(list(vector_ids), SQL_CHUNK_SIZE):
+        rows = (db.query(models.Image.id, models.Image.path, models.Image.content_hash, models.Image.vector_id)
+                .filter(models.Image.vector_id.in_(chunk)).order_by(models.Image.id))
+        for image_id, path, content_hash, vector_id in rows:
+            images_of_vector.setdefault(vector_id, []).append((image_id, path, content_hash))
+    return images_of_vector
+
+def get_vlm_reviewed_image_ids(db: Session):
+    """已由 VLM 判定季节的图片 ID (CLIP 批量分类不会覆盖它们)"""
+    return {image_id for (image_id,) in db.query(models.ImageLabel.image_id).filter(
+        models.ImageLabel.label_type == LABEL_SEASON, models.ImageLabel.source == "vlm")}
+
+def save_season_results(db: Session, seasons, scores=None, source: str = "clip", commit: bool = True):
+    """
+    批量保存季节分类结果 (一个事务)。每张图片只保留一个季节标签。
+    :param seasons: {image_id: "Spring" | "Summer" | "Autumn" | "Winter"}
+    :param scores: 可选的 {image_id: {'spring', 'summer', 'autumn', 'winter', 'confidence'}}
+    """
+    scores = scores or {}
+    upsert_labels(db, LABEL_SEASON, [
+        (image_id, season, scores[image_id]['confidence'] if image_id in scores else None)
+        for image_id, season in seasons.items()
+    ], source=source, exclusive=True, commit=False)
+    upsert_labels(db, LABEL_SEASON_PROB, [
+        (image_id, season, scores[image_id][season.lower()])
+        for image_id in seasons if image_id in scores for season in SEASONS
+    ], source="clip", commit=False)
+    if commit:
+        db.commit()
+
+def list_images(db: Session, after_id: int = 0, limit: int = IMAGE_PAGE_SIZE, season: str = None):
+    """
+    按 id 游标 (keyset) 分页列出已生成向量的图片，只查询列表需要的列。
+    WHERE id > after_id ORDER BY id LIMIT n 直接利用主键索引定位，翻到第几页耗时都相同，不会像 OFFSET 那样越翻越慢。
+    :param after_id: 上一页最后一条记录的 id (游标)，首页为 0。
+    :param season: 可选，只列出该季节的图片。
+    :return: (rows, next_cursor) —— rows 含 id、path、filename、content_hash；没有下一页时 next_cursor 为 None。
+    """
+    limit = max(1, min(limit, MAX_IMAGE_PAGE_SIZE))
+    query = db.query(models.Image.id, models.Image.path, models.Image.filename, models.Image.content_hash)
+    if season is not None:
+        query = query.join(models.ImageLabel, models.ImageLabel.image_id == models.Image.id) \
+            .filter(models.ImageLabel.label_type == LABEL_SEASON, models.ImageLabel.label == season)
+    rows = (query.filter(models.Image.id > after_id, models.Image.vector_id.isnot(None))
+            .order_by(models.Image.id)
+            .limit(limit)
+            .all())
+    next_cursor = rows[-1].id if len(rows) == limit else None
+    return rows, next_cursor
+
+def iter_image_pages(db: Session, after_id: int = 0, page_size: int = IMAGE_PAGE_SIZE, season: str = None):
+    """逐页读取 list_images 的结果，产出 (rows, next_cursor)，每次只在内存中保留一页。"""
+    while True:
+        rows, next_cursor = list_images(db, after_id=after_id, limit=page_size, season=season)
+        if rows:
+            yield rows, next_cursor
+        if next_cursor is None:
+            return
+        after_id = next_cursor
+
+def create_indexing_job(db: Session, job_id: str, directory: str):
+    db_job = models.IndexingJob(id=job_id, directory=directory, status="queued")
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def update_indexing_job(db: Session, job_id: str, **fields):
+    """更新任务的状态、进度或检查点。"""
+    db.query(models.IndexingJob).filter(models.IndexingJob.id == job_id).update(fields)
+    db.commit()
+
+def get_indexing_job(db: Session, job_id: str):
+    return db.query(models.IndexingJob).filter(models.IndexingJob.id == job_id).first()
+
+def get_indexing_job_statuses(db: Session, job_ids):
+    """:return: {job_id: status}"""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    return dict(db.query(models.IndexingJob.id, models.IndexingJob.status).filter(models.IndexingJob.id.in_(job_ids)))
+
+def count_indexing_jobs(db: Session):
+    """:return: {status: 任务数}"""
+    return dict(db.query(models.IndexingJob.status, func.count()).group_by(models.IndexingJob.status).all())
+
+def get_unfinished_jobs(db: Session):
+    """获取服务重启前未完成的索引任务 (按创建时间排序)"""
+    return (db.query(models.IndexingJob)
+            .filter(models.IndexingJob.status.in_(("queued", "running", "paused")))
+            .order_by(models.IndexingJob.created_at)
+            .all())
+
+def list_indexing_jobs(db: Session, limit: int = 100):
+    """最近创建的索引任务 (按创建时间从新到旧)"""
+    return db.query(models.IndexingJob).order_by(models.IndexingJob.created_at.desc()).limit(limit).all()
+
+# 季节分类任务与工作队列
+CLASSIFICATION_KINDS = ("vlm", "review")
+
+def create_classification_job(db: Session, kind: str, force: bool = False, vlm_threshold: float = None):
+    db_job = models.ClassificationJob(id=uuid.uuid4().hex, kind=kind, status="running", force=int(force),
+                                      vlm_threshold=vlm_threshold)
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def update_classification_job(db: Session, job_id: str, **fields):
+    db.query(models.ClassificationJob).filter(models.ClassificationJob.id == job_id).update(fields)
     db.commit()
-    db.refresh(db_season_photo)
-    return db_season_photo
 
-def add_photo_to_spring(db: Session, image_id: int):
-    return add_photo_to_season(db, image_id, models.SpringPhoto)
+def get_unfinished_classification_job(db: Session, kind: str):
+    """最近一个未完成 (运行中断、被取消或失败) 的分类任务，没有时返回 None"""
+    return (db.query(models.ClassificationJob)
+            .filter(models.ClassificationJob.kind == kind,
+                    models.ClassificationJob.status.in_(("running", "cancelled", "failed")))
+            .order_by(models.ClassificationJob.created_at.desc())
+            .first())
 
-def add_photo_to_summer(db: Session, image_id: int):
-    return add_photo_to_season(db, image_id, models.SummerPhoto)
+def get_latest_classification_job(db: Session):
+    return db.query(models.ClassificationJob).order_by(models.ClassificationJob.created_at.desc()).first()
 
-def add_photo_to_autumn(db: Session, image_id: int):
-    return add_photo_to_season(db, image_id, models.AutumnPhoto)
+def discard_classification_job(db: Session, job_id: str):
+    """放弃一个未完成的任务 (被新任务取代): 标记为已取消并清空其工作队列"""
+    db.query(models.ClassificationItem).filter(models.ClassificationItem.job_id == job_id) \
+        .delete(synchronize_session=False)
+    db.query(models.ClassificationJob).filter(models.ClassificationJob.id == job_id).update({'status': "cancelled"})
+    db.commit()
 
-def add_photo_to_winter(db: Session, image_id: int):
-    return add_photo_to_season(db, image_id, models.WinterPhoto)
+def enqueue_classification_items(db: Session, job):
+    """
+    用一条 INSERT ... SELECT 把需要分类的图片加入任务的工作队列 (已在队列中的图片保持不变，可以重复调用)。
+    - vlm 任务: 所有已生成向量、且尚未由 VLM 判定季节的图片 (force 时为所有已生成向量的图片)；
+    - review 任务: CLIP 分类置信度低于 vlm_threshold 的图片。
+    :return: 新加入队列的图片数。
+    """
+    if job.kind == "review":
+        select = ("SELECT l.image_id FROM image_labels l JOIN images i ON i.id = l.image_id "
+                  "WHERE l.label_type = :season AND l.source = 'clip' AND l.score < :threshold "
+                  "AND i.vector_id IS NOT NULL")
+    elif job.force:
+        select = "SELECT id FROM images WHERE vector_id IS NOT NULL"
+    else:
+        select = ("SELECT id FROM images WHERE vector_id IS NOT NULL AND id NOT IN "
+                  "(SELECT image_id FROM image_labels WHERE label_type = :season AND source = 'vlm')")
+    result = db.execute(
+        text(f"INSERT OR IGNORE INTO classification_items (job_id, image_id, status, attempts) "
+             f"SELECT :job_id, candidates.*, 'pending', 0 FROM ({select}) AS candidates"),
+        {'job_id': job.id, 'season': LABEL_SEASON, 'threshold': job.vlm_threshold})
+    db.commit()
+    return result.rowcount
 
-def get_spring_photos(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Image).join(models.SpringPhoto).offset(skip).limit(limit).all()
+def delete_orphaned_classification_items(db: Session, job_id: str):
+    """
+    删除工作队列中图片已不存在的待处理条目 (例如在 delete_images 同时清理队列之前删除的图片)。
+    :return: 删除的条目数。
+    """
+    result = db.execute(
+        text("DELETE FROM classification_items WHERE job_id = :job_id AND status = 'pending' "
+             "AND NOT EXISTS (SELECT 1 FROM images WHERE images.id = classification_items.image_id)"),
+        {'job_id': job_id})
+    db.commit()
+    return result.rowcount
 
-def get_summer_photos(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Image).join(models.SummerPhoto).offset(skip).limit(limit).all()
+def count_classification_items(db: Session, job_id: str):
+    """:return: {'pending': n, 'done': n, 'failed': n}"""
+    counts = dict.fromkeys(("pending", "done", "failed"), 0)
+    counts.update(db.query(models.ClassificationItem.status, func.count())
+                  .filter(models.ClassificationItem.job_id == job_id)
+                  .group_by(models.ClassificationItem.status).all())
+    return counts
 
-def get_autumn_photos(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Image).join(models.AutumnPhoto).offset(skip).limit(limit).all()
+def next_classification_batch(db: Session, job_id: str, limit: int):
+    """
+    工作队列中的下一批图片: 先处理从未尝试过的，再处理需要重试的。
+    已被删除的图片不会出现在结果中。
+    :return: [(image_id, path, content_hash, attempts), ...]
+    """
+    return (db.query(models.ClassificationItem.image_id, models.Image.path, models.Image.content_hash,
+                     models.ClassificationItem.attempts)
+            .join(models.Image, models.Image.id == models.ClassificationItem.image_id)
+            .filter(models.ClassificationItem.job_id == job_id, models.ClassificationItem.status == "pending")
+            .order_by(models.ClassificationItem.attempts, models.ClassificationItem.image_id)
+            .limit(limit)
+            .all())
 
-def get_winter_photos(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Image).join(models.WinterPhoto).offset(skip).limit(limit).all()
+def complete_classification_batch(db: Session, job_id: str, seasons, failures, max_attempts: int):
+    """
+    在一个事务中保存一批分类结果并更新工作队列。
+    :param seasons: {image_id: season}，成功分类的图片。
+    :param failures: {image_id: 失败原因}；尝试次数达到 max_attempts 的图片标记为 failed，其余留在队列中等待重试。
+    """
+    save_season_results(db, seasons, source="vlm", commit=False)
+    items = models.ClassificationItem
+    for chunk in _chunks(list(seasons), SQL_CHUNK_SIZE):
+        (db.query(items).filter(items.job_id == job_id, items.image_id.in_(chunk))
+         .update({'status': "done", 'attempts': items.attempts + 1, 'error': None}, synchronize_session=False))
+    if failures:
+        db.connection().exec_driver_sql(
+            "UPDATE classification_items SET attempts = attempts + 1, error = ?, "
+            "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+            "WHERE job_id = ? AND image_id = ?",
+            [(reason, max_attempts, job_id, image_id) for image_id, reason in failures.items()],
+        )
+    db.commit()
+
+def finish_classification_job(db: Session, job_id: str):
+    """任务完成: 删除队列中已完成的条目 (保留达到重试上限的条目以便查看原因)"""
+    db.query(models.ClassificationItem).filter(models.ClassificationItem.job_id == job_id,
+                                               models.ClassificationItem.status == "done") \
+        .delete(synchronize_session=False)
+    db.query(models.ClassificationJob).filter(models.ClassificationJob.id == job_id).update({'status': "completed"})
+    db.commit()
+
+# 工作进程的任务队列 (PHOTO_INSIGHT_JOB_QUEUE=sqlite，见 worker.py)
+def create_worker_task(db: Session, kind: str, params=None, sid: str = None):
+    task = models.WorkerTask(id=uuid.uuid4().hex, kind=kind, params=json.dumps(params or {}), sid=sid,
+                             status="queued")
+    db.add(task)
+    db.commit()
+    db.refresh(task)
+    return task
+
+def ensure_indexing_task(db: Session, job_id: str, params=None, sid: str = None):
+    """
+    为索引任务加入一个工作进程任务，已有排队或运行中的任务时不重复加入。
+    检查与插入在同一条 INSERT ... SELECT 语句中完成，多个进程同时调用也只会加入一个。
+    :return: 是否加入了新任务。
+    """
+    tasks = models.WorkerTask
+    now = datetime.datetime.utcnow()
+    columns = (tasks.id, tasks.kind, tasks.job_id, tasks.params, tasks.sid, tasks.status, tasks.created_at,
+               tasks.updated_at)
+    values = (uuid.uuid4().hex, "indexing", job_id, json.dumps(params or {}), sid, "queued", now, now)
+    active = exists().where(tasks.job_id == job_id, tasks.status.in_(("queued", "running")))
+    statement = insert(tasks).from_select(
+        [column.name for column in columns],
+        select(*[literal(value, column.type) for value, column in zip(values, columns)]).where(~active))
+    result = db.execute(statement)
+    db.commit()
+    return result.rowcount == 1
+
+def claim_worker_task(db: Session, worker_id: str, kinds, lease_seconds: float):
+    """
+    领取一个任务: 最早排队的任务，或心跳已超时 (工作进程已退出) 的运行中任务。
+    索引任务已暂停的任务不会被领取 (恢复后才可领取)，暂停的任务不占用工作进程。
+    领取用带条件的 UPDATE 完成，多个工作进程同时领取时只有一个会成功。
+    :return: WorkerTask；没有可领取的任务时返回 None。
+    """
+    tasks = models.WorkerTask
+    paused = exists().where(models.IndexingJob.id == tasks.job_id, models.IndexingJob.status == "paused")
+    for _ in range(3):
+        now = time.time()
+        claimable = and_(or_(tasks.status == "queued",
+                             and_(tasks.status == "running", tasks.heartbeat_at < now - lease_seconds)),
+                         ~paused)
+        candidate = (db.query(tasks.id).filter(tasks.kind.in_(list(kinds)), claimable)
+                     .order_by(tasks.created_at).first())
+        if candidate is None:
+            db.commit()
+            return None
+        claimed = (db.query(tasks).filter(tasks.id == candidate.id, claimable)
+                   .update({'status': "running", 'worker_id': worker_id, 'heartbeat_at': now},
+                           synchronize_session=False))
+        db.commit()
+        if claimed:
+            return db.query(tasks).filter(tasks.id == candidate.id).first()
+    return None
+
+def heartbeat_worker_tasks(db: Session, worker_id: str, task_ids, touch: bool = True):
+    """
+    更新本工作进程持有的任务的心跳 (touch=False 时只读取状态)。
+    :return: {task_id: status}；任务已被取消时为 cancelled，被其他工作进程接管时为 lost。
+    """
+    tasks = models.WorkerTask
+    task_ids = list(task_ids)
+    if not task_ids:
+        return {}
+    if touch:
+        (db.query(tasks).filter(tasks.id.in_(task_ids), tasks.worker_id == worker_id, tasks.status == "running")
+         .update({'heartbeat_at': time.time()}, synchronize_session=False))
+        db.commit()
+    states = {}
+    for task_id, status, owner in db.query(tasks.id, tasks.status, tasks.worker_id).filter(tasks.id.in_(task_ids)):
+        states[task_id] = status if owner == worker_id else "lost"
+    return states
+
+def get_indexing_task_sid(db: Session, job_id: str):
+    """发起索引任务的客户端 (最近一个工作进程任务的 sid)，没有时返回 None"""
+    row = (db.query(models.WorkerTask.sid).filter(models.WorkerTask.job_id == job_id)
+           .order_by(models.WorkerTask.created_at.desc()).first())
+    return row.sid if row else None
+
+def finish_worker_task(db: Session, task_id: str, worker_id: str, status: str, error: str = None):
+    """结束任务 (只有仍持有该任务的工作进程可以结束它)"""
+    tasks = models.WorkerTask
+    (db.query(tasks).filter(tasks.id == task_id, tasks.worker_id == worker_id)
+     .update({'status': status, 'error': error}, synchronize_session=False))
+    db.commit()
+
+def release_worker_task(db: Session, task_id: str, worker_id: str):
+    """工作进程退出时把未完成的任务放回队列，由其他工作进程继续"""
+    tasks = models.WorkerTask
+    (db.query(tasks).filter(tasks.id == task_id, tasks.worker_id == worker_id, tasks.status == "running")
+     .update({'status': "queued", 'worker_id': None, 'heartbeat_at': None}, synchronize_session=False))
+    db.commit()
+
+def get_active_worker_tasks(db: Session, kind: str = None):
+    """排队或运行中的任务 (按创建时间排序)"""
+    query = db.query(models.WorkerTask).filter(models.WorkerTask.status.in_(("queued", "running")))
+    if kind is not None:
+        query = query.filter(models.WorkerTask.kind == kind)
+    return query.order_by(models.WorkerTask.created_at).all()
+
+def cancel_worker_tasks(db: Session, kind: str = None, job_id: str = None):
+    """
+    取消排队或运行中的任务 (运行中的任务由工作进程在下一次心跳时发现并停止)。
+    :return: 被取消的任务数。
+    """
+    query = db.query(models.WorkerTask).filter(models.WorkerTask.status.in_(("queued", "running")))
+    if kind is not None:
+        query = query.filter(models.WorkerTask.kind == kind)
+    if job_id is not None:
+        query = query.filter(models.WorkerTask.job_id == job_id)
+    cancelled = query.update({'status': "cancelled"}, synchronize_session=False)
+    db.commit()
+    return cancelled
@@ -1,9 +1,10 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 # 数据库文件路径
-SQLALCHEMY_DATABASE_URL = "sqlite:///./photo_insight.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("PHOTO_INSIGHT_DATABASE_URL", "sqlite:///./photo_insight.db")
 
 # 创建数据库引擎
 # connect_args={"check_same_thread": False} 是 SQLite 的特殊要求，允许在多线程中使用
@@ -11,6 +12,19 @@ engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """为每个新连接设置 SQLite 参数"""
+    cursor = dbapi_connection.cursor()
+    # WAL 模式下读写互不阻塞，批量写入时只需同步 WAL 文件
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB 页缓存
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB 内存映射读取
+    cursor.execute("PRAGMA busy_timeout=5000")  # 多线程写入时等待锁而不是立即报错
+    cursor.close()
+
 # 创建数据库会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -0,0 +1,272 @@
+"""
+重复图片检测。
+
+- 完全重复: 索引前先按文件大小筛选，只有大小与已索引图片 (或其他待处理文件) 相同的文件
+  才读取首尾两块计算快速哈希，快速哈希相同时再用完整内容哈希确认。
+  确认重复的文件直接共用已有的向量，不再经过模型推理。
+- 近似重复: 基于已存储的 CLIP 向量分块计算余弦相似度，用并查集合并相似度超过阈值的图片。
+  全部向量 (float32，超过一半预算时为 float16) 与最小的计算分块需要装入 DEDUP_MEMORY_BUDGET_MB，
+  装不下时在读取向量之前抛出 DedupMemoryError，而不是超出预算运行。
+  计算量为 O(N²)，聚类结果按阈值缓存，图片或向量变化后才重新计算。
+此模块不依赖 torch。
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from . import crud, thumbnails, vector_db
+
+# 配置
+EXACT_DEDUP = os.environ.get("PHOTO_INSIGHT_DEDUP", "1") != "0"  # 索引时跳过完全重复的文件
+QUICK_HASH_BLOCK = 64 * 1024  # 快速哈希读取文件开头和结尾各多少字节
+NEAR_DUPLICATE_THRESHOLD = 0.95  # 余弦相似度不低于该值视为近似重复
+DEDUP_MEMORY_BUDGET_MB = int(os.environ.get("PHOTO_INSIGHT_DEDUP_MEMORY_MB", "512"))
+MIN_BLOCK_SIZE = 256
+MAX_BLOCK_SIZE = 8192
+CLUSTER_CACHE_SIZE = 4  # 缓存最近几个阈值的近似重复聚类结果
+
+class DedupMemoryError(RuntimeError):
+    """向量数过多，近似重复检测无法在 DEDUP_MEMORY_BUDGET_MB 内完成"""
+
+_cluster_cache = OrderedDict()  # (阈值, 图片与向量库的变化标记) -> [[vector_id, ...], ...]
+_cluster_cache_lock = threading.Lock()
+
+def quick_hash(path: str, size: int):
+    """文件大小 + 开头与结尾各 QUICK_HASH_BLOCK 字节的哈希，只用于筛选候选，不能单独确认重复。"""
+    digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(QUICK_HASH_BLOCK))
+        if size > 2 * QUICK_HASH_BLOCK:
+            f.seek(-QUICK_HASH_BLOCK, os.SEEK_END)
+            digest.update(f.read(QUICK_HASH_BLOCK))
+    return digest.hexdigest()
+
+class _HashCache:
+    """按需计算并缓存文件的快速哈希与完整哈希，无法读取的文件返回 None。"""
+
+    def __init__(self):
+        self.quick = {}
+        self.full = {}
+
+    def quick_hash(self, path: str, size: int):
+        if path not in self.quick:
+            try:
+                self.quick[path] = quick_hash(path, size)
+            except OSError:
+                self.quick[path] = None
+        return self.quick[path]
+
+    def full_hash(self, path: str):
+        if path not in self.full:
+            try:
+                self.full[path] = thumbnails.hash_file(path)
+            except OSError:
+                self.full[path] = None
+        return self.full[path]
+
+def find_exact_duplicates(db, paths, fingerprints):
+    """
+    在待索引文件中查找完全重复的文件。
+    :param paths: 待索引的文件路径。
+    :param fingerprints: {路径: (mtime, size, inode)}，来自增量扫描。
+    :return: (reuse, deferred)
+        reuse: {路径: (vector_id, content_hash)} —— 与已索引图片内容相同，直接共用其向量；
+        deferred: {主文件路径: [(路径, content_hash), ...]} —— 待索引文件之间相互重复，
+                  只推理路径最小的主文件，其余文件在主文件写入后共用其向量。
+    """
+    size_of = {path: fingerprints[path][1] for path in paths if path in fingerprints}
+    pending_by_size = {}
+    for path in sorted(size_of):
+        pending_by_size.setdefault(size_of[path], []).append(path)
+    indexed_by_size = crud.get_indexed_images_by_sizes(db, list(pending_by_size))
+
+    hashes = _HashCache()
+    reuse = {}
+    deferred = {}
+    candidates = 0
+    for size, group in pending_by_size.items():
+        indexed = [row for row in indexed_by_size.get(size, ()) if row[2] or row[0] not in size_of]
+        if len(group) < 2 and not indexed:
+            continue
+        candidates += len(group)
+
+        # 已索引的一侧: 快速哈希 -> (path, vector_id, content_hash)
+        indexed_by_quick = {}
+        for indexed_path, vector_id, content_hash in indexed:
+            quick = hashes.quick_hash(indexed_path, size)
+            if quick is not None:
+                indexed_by_quick.setdefault(quick, []).append((indexed_path, vector_id, content_hash))
+
+        quick_counts = {}
+        for path in group:
+            quick = hashes.quick_hash(path, size)
+            quick_counts[quick] = quick_counts.get(quick, 0) + 1
+
+        primaries = {}  # 完整哈希 -> 待索引主文件路径
+        for path in group:
+            quick = hashes.quick_hash(path, size)
+            if quick is None:
+                continue
+            matches = indexed_by_quick.get(quick, ())
+            if not matches and quick_counts[quick] < 2:
+                continue
+            content_hash = hashes.full_hash(path)
+            if content_hash is None:
+                continue
+            source = next((
+                (vector_id, content_hash) for indexed_path, vector_id, indexed_hash in matches
+                if (indexed_hash or hashes.full_hash(indexed_path)) == content_hash
+            ), None)
+            if source is not None:
+                reuse[path] = source
+            elif content_hash in primaries:
+                deferred.setdefault(primaries[content_hash], []).append((path, content_hash))
+            else:
+                primaries[content_hash] = path
+
+    duplicates = len(reuse) + sum(len(dups) for dups in deferred.values())
+    if candidates:
+        logging.info(f"重复检测: {candidates} 个文件大小与其他图片相同，确认 {duplicates} 个完全重复的文件")
+    return reuse, deferred
+
+def _image_entry(image_id, path, content_hash):
+    return {'id': image_id, 'path': path, 'thumbnail_url': thumbnails.thumbnail_url(image_id, content_hash)}
+
+def exact_duplicate_groups(db):
+    """
+    内容完全相同的图片组 (按内容哈希分组)。
+    :return: [[{id, path, thumbnail_url}, ...], ...]，按组大小从大到小排序。
+    """
+    groups = [[_image_entry(*row) for row in group] for group in crud.get_duplicate_content_groups(db)]
+    return sorted(groups, key=len, reverse=True)
+
+def _working_set_bytes(block: int, dim: int):
+    """一次分块计算的内存: 相似度分块 (block x block float32) 与参与计算的两块 float32 向量"""
+    return 4 * block * block + 2 * 4 * block * dim
+
+def _check_budget(count: int, dim: int, memory_budget_bytes: int):
+    needed = count * dim * 2 + _working_set_bytes(MIN_BLOCK_SIZE, dim)
+    if needed > memory_budget_bytes:
+        raise DedupMemoryError(
+            f"近似重复检测需要约 {math.ceil(needed / 1024 / 1024)} MB 内存 ({count} 个 {dim} 维向量)，"
+            f"超过预算 {memory_budget_bytes // 1024 // 1024} MB，请调高 PHOTO_INSIGHT_DEDUP_MEMORY_MB")
+
+def _load_vectors(memory_budget_bytes: int):
+    """
+    读取向量库中的全部向量。全部以 float32 存放会占用超过一半预算时改用 float16。
+    :raises DedupMemoryError: 以 float16 存放仍装不下时。
+    """
+    count = vector_db.get_vector_count()
+    ids = []
+    matrix = None
+    offset = 0
+    for batch_ids, vectors in vector_db.iter_vectors():
+        if matrix is None:
+            _check_budget(count, vectors.shape[1], memory_budget_bytes)
+            dtype = np.float32 if count * vectors.shape[1] * 4 <= memory_budget_bytes // 2 else np.float16
+            matrix = np.empty((count, vectors.shape[1]), dtype=dtype)
+        # 迭代过程中向量数可能变化 (例如并发的索引任务)，超出部分丢弃
+        take = min(len(batch_ids), count - offset)
+        matrix[offset:offset + take] = vectors[:take]
+        ids.extend(batch_ids[:take])
+        offset += take
+        if offset >= count:
+            break
+    if matrix is None:
+        return [], np.empty((0, 0), dtype=np.float32)
+    return ids, matrix[:offset]
+
+def _block_size(matrix, memory_budget_bytes: int):
+    """
+    分块大小: 相似度分块 (block x block float32) 与参与计算的两块 float32 向量共同不超过剩余预算。
+    """
+    remaining = max(memory_budget_bytes - matrix.nbytes, 0)
+    dim = matrix.shape[1]
+    # _working_set_bytes(block, dim) = 4 * block^2 + 2 * 4 * block * dim <= remaining
+    block = int(math.sqrt(dim * dim + remaining / 4) - dim)
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+
+def _find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
+
+def _cluster_vectors(threshold: float, memory_budget_mb: int, on_progress=None):
+    """
+    只计算相似度矩阵的上三角分块，每个分块用完即释放；相似度不低于阈值的向量对通过并查集合并。
+    :return: [[vector_id, ...], ...]，只包含至少两个向量的簇。
+    """
+    budget = memory_budget_mb * 1024 * 1024
+    vector_ids, matrix = _load_vectors(budget)
+    total = len(vector_ids)
+    if total < 2:
+        return []
+    block = _block_size(matrix, budget)
+    logging.info(f"近似重复检测: {total} 个向量 ({matrix.dtype})，分块大小 {block}，阈值 {threshold}")
+
+    parent = list(range(total))
+    for row_start in range(0, total, block):
+        rows = matrix[row_start:row_start + block].astype(np.float32, copy=False)
+        for col_start in range(row_start, total, block):
+            cols = matrix[col_start:col_start + block].astype(np.float32, copy=False)
+            similarity = rows @ cols.T
+            row_index, col_index = np.nonzero(similarity >= threshold)
+            del similarity
+            for i, j in zip((row_index + row_start).tolist(), (col_index + col_start).tolist()):
+                if i < j:
+                    root_i, root_j = _find(parent, i), _find(parent, j)
+                    if root_i != root_j:
+                        parent[root_j] = root_i
+        if on_progress:
+            on_progress(min(row_start + block, total), total)
+
+    clusters = {}
+    for i in range(total):
+        clusters.setdefault(_find(parent, i), []).append(vector_ids[i])
+    return [members for members in clusters.values() if len(members) > 1]
+
+def cluster_near_duplicates(db, threshold: float = NEAR_DUPLICATE_THRESHOLD,
+                            memory_budget_mb: int = DEDUP_MEMORY_BUDGET_MB, on_progress=None):
+    """
+    按向量的余弦相似度聚类近似重复的图片。
+    聚类结果 (向量 ID) 按阈值缓存，图片或向量库没有变化时直接使用；图片信息每次从数据库读取。
+    :param on_progress: 可选回调 on_progress(done, total)，每完成一行分块调用一次。
+    :return: [[{id, path, thumbnail_url}, ...], ...]，只包含至少两个不同向量的组，按组大小从大到小排序。
+    :raises DedupMemoryError: 向量装不下内存预算时。
+    """
+    # 在计算之前读取变化标记: 计算期间发生的变化会使下一次请求重新计算
+    key = (threshold, vector_db.get_vector_count(), crud.get_image_fingerprint(db))
+    with _cluster_cache_lock:
+        clusters = _cluster_cache.get(key)
+        if clusters is not None:
+            _cluster_cache.move_to_end(key)
+    if clusters is None:
+        clusters = _cluster_vectors(threshold, memory_budget_mb, on_progress)
+        with _cluster_cache_lock:
+            _cluster_cache[key] = clusters
+            while len(_cluster_cache) > CLUSTER_CACHE_SIZE:
+                _cluster_cache.popitem(last=False)
+    else:
+        logging.info(f"近似重复检测: 图片没有变化，使用缓存的聚类结果 (阈值 {threshold})")
+    images_of_vector = crud.get_images_by_vector_ids(db, [vid for members in clusters for vid in members])
+
+    groups = []
+    for members in clusters:
+        group = [_image_entry(*row) for vector_id in members for row in images_of_vector.get(vector_id, ())]
+        if len(group) > 1:
+            groups.append(group)
+    return sorted(groups, key=len, reverse=True)
+
+def find_duplicates(db, threshold: float = NEAR_DUPLICATE_THRESHOLD, on_progress=None):
+    """:return: {'exact_groups': [...], 'near_groups': [...]}"""
+    return {
+        'exact_groups': exact_duplicate_groups(db),
+        'near_groups': cluster_near_duplicates(db, threshold, on_progress=on_progress),
+    }
@@ -0,0 +1,226 @@
+"""
+持久化的图片向量缓存。
+
+以 (图片内容哈希, 模型, 预处理版本) 为键，将 CLIP 向量以 float32 BLOB 保存在独立的 SQLite 文件中。
+重建向量库、切换向量存储后端或图片换了路径时，内容相同的图片直接使用缓存的向量，不再解码和推理。
+模型键包含推理后端 (例如 "openai/clip-vit-base-patch32@int8")，不同后端的向量不会混用；
+修改预处理逻辑时应增加 preprocess.PREPROCESS_VERSION，使旧的缓存失效。
+缓存条目数超过磁盘预算时按最近使用时间淘汰。
+索引流水线的解码进程以只读方式 (mode=ro) 打开缓存，不会创建或写入数据库文件，
+写入与命中统计都在主进程中完成。
+此模块不依赖 torch，可以在解码进程中导入。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+import numpy as np
+
+# 配置
+EMBEDDING_CACHE_PATH = os.environ.get("PHOTO_INSIGHT_EMBEDDING_CACHE", "./embedding_cache.db")
+EMBEDDING_CACHE_BUDGET_MB = int(os.environ.get("PHOTO_INSIGHT_EMBEDDING_CACHE_MB", "1024"))  # 0 表示关闭缓存
+ENTRY_OVERHEAD_BYTES = 96  # 每个条目除向量外的大致开销 (键与索引)，用于估算缓存大小
+TOUCH_INTERVAL_SECONDS = 3600  # 命中时刷新最近使用时间的最小间隔
+BUDGET_CHECK_INTERVAL = 5000  # 每写入多少条检查一次预算
+SQL_CHUNK_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    content_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    preprocess_version INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (content_hash, model, preprocess_version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used);
+"""
+
+def cache_key():
+    """当前模型、推理后端与预处理版本对应的缓存键 (model, preprocess_version)。"""
+    from . import clip_model, preprocess
+
+    source = clip_model.embedding_source()
+    return f"{source['model']}@{source['inference_backend']}", preprocess.PREPROCESS_VERSION
+
+class EmbeddingCache:
+    """线程安全的向量缓存 (单个 SQLite 连接 + 锁)。"""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, budget_mb: int = EMBEDDING_CACHE_BUDGET_MB,
+                 readonly: bool = False):
+        self.path = path
+        self.budget_mb = budget_mb
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._conn = None
+        if not readonly:
+            self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._writes_since_check = 0
+
+    def get_many(self, key, content_hashes, touch: bool = True):
+        """
+        批量读取缓存。
+        :param key: cache_key() 的返回值。
+        :param touch: 是否刷新命中条目的最近使用时间 (只读的解码进程不刷新)。
+        :return: {content_hash: (D,) float32 数组}
+        """
+        model, version = key
+        content_hashes = list(dict.fromkeys(h for h in content_hashes if h))
+        found = {}
+        with self._lock:
+            if self._conn is None and not self._connect_readonly():
+                return {}
+            for start in range(0, len(content_hashes), SQL_CHUNK_SIZE):
+                chunk = content_hashes[start:start + SQL_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                try:
+                    rows = self._conn.execute(
+                        f"SELECT content_hash, vector FROM embeddings WHERE model = ? AND preprocess_version = ? "
+                        f"AND content_hash IN ({placeholders})", [model, version, *chunk]).fetchall()
+                except sqlite3.OperationalError as e:
+                    # 只读进程可能在主进程建表之前查询
+                    logging.debug(f"读取向量缓存失败: {e}")
+                    return {}
+                for content_hash, blob in rows:
+                    found[content_hash] = np.frombuffer(blob, dtype=np.float32)
+        if touch and found:
+            self.touch(key, found)
+        return found
+
+    def _connect_readonly(self):
+        """只读连接在第一次查询时建立；数据库文件还不存在 (主进程尚未创建) 时返回 False，下次查询再试"""
+        uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+        try:
+            self._conn = sqlite3.connect(uri, uri=True, timeout=5, check_same_thread=False)
+        except sqlite3.OperationalError as e:
+            logging.debug(f"打开向量缓存失败: {e}")
+            return False
+        return True
+
+    def put_many(self, key, content_hashes, vectors):
+        """写入一批向量 (与 content_hashes 一一对应)，没有内容哈希的条目会被忽略。"""
+        if self.readonly:
+            return
+        model, version = key
+        now = time.time()
+        rows = [
+            (content_hash, model, version, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for content_hash, vector in zip(content_hashes, vectors) if content_hash
+        ]
+        if not rows:
+            return
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (content_hash, model, preprocess_version, vector, last_used) "
+                        "VALUES (?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                # 缓存只是加速手段，写入失败不影响索引
+                logging.warning(f"写入向量缓存失败: {e}")
+                return
+            self.writes += len(rows)
+            self._writes_since_check += len(rows)
+            check_budget = self._writes_since_check >= BUDGET_CHECK_INTERVAL
+        if check_budget:
+            self.enforce_budget()
+
+    def touch(self, key, content_hashes):
+        """刷新条目的最近使用时间 (距上次刷新超过 TOUCH_INTERVAL_SECONDS 的才会写入)。"""
+        if self.readonly:
+            return
+        model, version = key
+        now = time.time()
+        rows = [(now, content_hash, model, version, now - TOUCH_INTERVAL_SECONDS) for content_hash in content_hashes]
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE content_hash = ? AND model = ? "
+                        "AND preprocess_version = ? AND last_used < ?", rows)
+            except sqlite3.Error as e:
+                logging.warning(f"更新向量缓存失败: {e}")
+
+    def record(self, hits: int, misses: int):
+        """累计命中统计 (解码进程中的查询结果由主进程汇总)。"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _entry_bytes(self):
+        row = self._conn.execute("SELECT length(vector) FROM embeddings LIMIT 1").fetchone()
+        return (row[0] if row else 0) + ENTRY_OVERHEAD_BYTES
+
+    def enforce_budget(self, budget_mb: int = None):
+        """
+        条目总大小超过预算时，按最近使用时间从旧到新删除，直到低于预算的 90%。
+        :return: 删除的条目数。
+        """
+        budget = (self.budget_mb if budget_mb is None else budget_mb) * 1024 * 1024
+        with self._lock:
+            self._writes_since_check = 0
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            entry_bytes = self._entry_bytes()
+            if count * entry_bytes <= budget:
+                return 0
+            remove = count - int(budget * 0.9 // entry_bytes)
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE (content_hash, model, preprocess_version) IN "
+                    "(SELECT content_hash, model, preprocess_version FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (remove,))
+            self.evictions += remove
+        logging.info(f"向量缓存超出预算 {self.budget_mb} MB，已淘汰 {remove} 个条目")
+        return remove
+
+    def stats(self):
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            size_mb = count * self._entry_bytes() / (1024 * 1024) if count else 0.0
+            lookups = self.hits + self.misses
+            return {
+                'entries': count,
+                'size_mb': round(size_mb, 2),
+                'budget_mb': self.budget_mb,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+
+_cache = None
+_readers = {}
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """主进程中共用的缓存实例；缓存被关闭 (预算为 0) 时返回 None。"""
+    global _cache
+    if EMBEDDING_CACHE_BUDGET_MB <= 0:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
+
+def get_reader(path: str):
+    """解码进程中使用的只读缓存实例 (每个进程、每个路径一个)。"""
+    reader = _readers.get(path)
+    if reader is None:
+        reader = _readers[path] = EmbeddingCache(path, readonly=True)
+    return reader
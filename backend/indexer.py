@@ -0,0 +1,157 @@
+import logging
+import time
+
+from . import crud, database, dedup, metrics, scanner, thumbnails
+from .pipeline import DECODE_CHUNK_SIZE, DECODE_WORKERS, IndexingPipeline
+
+def format_stage_stats(stats):
+    """将流水线统计格式化为一行便于阅读的日志。"""
+    parts = [
+        f"{name}: {stage['items_per_sec']}/s (满载 {stage['busy_items_per_sec']}/s)"
+        for name, stage in stats['stages'].items()
+    ]
+    cache = f"向量缓存命中 {stats['cache_hits']}/{stats['cache_hits'] + stats['cache_misses']}"
+    return f"队列深度 {stats['queue_depth']} | {cache} | " + " | ".join(parts)
+
+def _record_scan(scan, seconds: float):
+    metrics.STAGE_SECONDS.observe(seconds, stage="scan")
+    for result, count in scan.summary().items():
+        if result != 'total' and count:
+            metrics.FILES_SCANNED.inc(count, result=result)
+
+def index_directory(directory: str, emit, should_stop=None, checkpoint: str = None, on_checkpoint=None):
+    """
+    增量扫描目录，并通过解码/推理流水线为新增或修改过的图片建立索引。
+    移动和删除的文件只更新数据库与向量库，不会重新推理；
+    与已有图片内容完全相同的文件直接共用已有向量 (见 dedup.find_exact_duplicates)。
+    这是一个阻塞调用，应在线程池中执行。
+    待处理文件按路径排序，因此 "最后一个已处理的路径" 即可作为恢复任务的检查点。
+    :param directory: 要扫描的目录。
+    :param emit: 线程安全的回调 emit(event, data)，用于向客户端发送进度。
+    :param should_stop: 返回 True 时提前结束索引。
+    :param checkpoint: 上次中断时的检查点，不大于该路径的文件将被跳过。
+    :param on_checkpoint: 回调 on_checkpoint(path, done, total)，每个批次写入完成后调用。
+    :return: 流水线的统计信息。
+    """
+    db = database.SessionLocal()
+    try:
+        started = time.perf_counter()
+        scan = scanner.diff_directory(db, directory)
+        scanner.apply_changes(db, scan)
+        _record_scan(scan, time.perf_counter() - started)
+        summary = scan.summary()
+        logging.info(f"目录 {directory} 增量扫描结果: {summary}")
+        emit('indexing_status', {
+            'data': f"发现 {scan.total} 张图片: 新增 {summary['new']}，修改 {summary['modified']}，"
+                    f"移动 {summary['moved']}，删除 {summary['deleted']}，准备开始处理...",
+            'scan': summary,
+        })
+        stats = _index_scan(db, scan, emit, should_stop=should_stop, checkpoint=checkpoint,
+                            on_checkpoint=on_checkpoint)
+        logging.info(f"目录 {directory} 索引统计: {format_stage_stats(stats)}")
+        return stats
+    finally:
+        db.close()
+
+def index_paths(paths, emit, should_stop=None):
+    """
+    只为给定的一组路径建立索引 (文件监视收集到的变化)，规则与 index_directory 相同:
+    已删除的路径删除记录，inode 相同的删除/新增视为移动 (只更新路径)，新增与修改的文件经过流水线推理。
+    这是一个阻塞调用，应在线程中执行。
+    :return: (scan, stats) —— scan 为 ScanResult；没有需要推理的文件时 stats 为 None。
+    """
+    db = database.SessionLocal()
+    try:
+        started = time.perf_counter()
+        scan = scanner.diff_paths(db, paths)
+        scanner.apply_changes(db, scan)
+        _record_scan(scan, time.perf_counter() - started)
+        if not scan.to_embed:
+            return scan, None
+        # 批次通常很小，不需要启动全部解码进程
+        workers = min(DECODE_WORKERS, -(-len(scan.to_embed) // DECODE_CHUNK_SIZE))
+        return scan, _index_scan(db, scan, emit, should_stop=should_stop, decode_workers=workers)
+    finally:
+        db.close()
+
+def _index_scan(db, scan, emit, should_stop=None, checkpoint: str = None, on_checkpoint=None,
+                decode_workers: int = DECODE_WORKERS):
+    """为扫描结果中新增与修改的文件建立索引 (跳过完全重复的文件)，返回流水线的统计信息。"""
+    summary = scan.summary()
+    total_files = scan.total
+    # 只有新增和修改的文件需要推理；跳过检查点之前已处理的部分
+    pending_files = [path for path in scan.to_embed if not (checkpoint and path <= checkpoint)]
+
+    def on_batch(paths, features, content_hashes):
+        nonlocal deferred_left, duplicates_saved
+        new_images, failed = crud.save_image_features(db, paths, features, content_hashes)
+        emit_images(new_images, failed)
+        # 主文件的向量已写入，与其内容相同的文件共用该向量
+        duplicates = {
+            path: (new_image.vector_id, content_hash)
+            for new_image in new_images
+            for path, content_hash in deferred.pop(new_image.path, ())
+        }
+        if duplicates:
+            deferred_left -= len(duplicates)
+            saved, failed = crud.save_duplicate_records(db, duplicates)
+            duplicates_saved += len(saved)
+            emit_images(saved, failed, status='Duplicate')
+        if on_checkpoint:
+            on_checkpoint(paths[-1], done_count(pipeline.stats()), total_files)
+
+    def emit_images(images, failed, status='Indexed'):
+        for image in images:
+            logging.info(f"成功索引新图片: {image.path}" + (" (重复图片)" if status == 'Duplicate' else ""))
+            emit('new_image_found', {
+                'id': image.id,
+                'path': image.path,
+                'thumbnail_url': thumbnails.thumbnail_url(image.id, image.content_hash),
+                'status': status,
+            })
+        for file_path, reason in failed.items():
+            on_failure(file_path, reason)
+
+    def on_failure(file_path, reason):
+        # 逐个报告无法处理的文件，不影响其他图片；内容相同的文件同样无法处理
+        nonlocal deferred_left
+        logging.warning(f"未能为图片创建索引记录: {file_path} ({reason})")
+        emit('image_failed', {'path': file_path, 'error': reason})
+        for path, _ in deferred.pop(file_path, ()):
+            deferred_left -= 1
+            on_failure(path, reason)
+
+    def done_count(stats):
+        return (skipped - deferred_left + stats['stages']['inference']['items'] + stats['cache_hits']
+                + stats['failed'])
+
+    def on_progress(stats):
+        done = done_count(stats)
+        rate = estimator.update(done)
+        emit('indexing_status', dict(rate, stats=stats, data=(
+            f"({done}/{total_files}) 正在处理... {rate['throughput']} 张/秒，"
+            f"预计剩余 {metrics.format_eta(rate['eta_seconds'])}")))
+
+    # 完全重复的文件不需要推理: 与已索引图片重复的立即写入，待处理文件之间的重复等主文件写入后再写入
+    deferred = {}
+    duplicates_saved = 0
+    if dedup.EXACT_DEDUP:
+        reuse, deferred = dedup.find_exact_duplicates(db, pending_files, scan.fingerprints)
+        saved, failed = crud.save_duplicate_records(db, reuse)
+        duplicates_saved = len(saved)
+        emit_images(saved, failed, status='Duplicate')
+        deferred_paths = {path for duplicates in deferred.values() for path, _ in duplicates}
+        pending_files = [path for path in pending_files if path not in reuse and path not in deferred_paths]
+    skipped = total_files - len(pending_files)
+    deferred_left = sum(len(duplicates) for duplicates in deferred.values())
+
+    pipeline = IndexingPipeline(decode_workers=decode_workers)
+    estimator = metrics.RateEstimator(total_files, done=skipped - deferred_left)
+    stats = pipeline.run(pending_files, on_batch, on_failure=on_failure, on_progress=on_progress,
+                         should_stop=should_stop)
+    stats['total'] = total_files
+    stats['scan'] = summary
+    stats['duplicates'] = duplicates_saved
+    # 本次索引新增了缩略图，检查缓存是否超出磁盘预算
+    thumbnails.enforce_budget()
+    return stats
@@ -0,0 +1,226 @@
+"""
+CLIP 推理后端，通过环境变量 PHOTO_INSIGHT_INFERENCE_BACKEND 选择:
+- torch: PyTorch eager fp32 (参考实现，默认)
+- torchscript: torch.jit.trace 并 freeze 后的图像/文本编码器
+- int8: 对线性层做动态 int8 量化 (torch.ao.quantization.quantize_dynamic)，只在 CPU 上运行
+- onnx: 导出为 ONNX 后由 ONNX Runtime 推理 (需要安装 onnxruntime)
+
+所有后端都以 numpy 数组作为输入输出，产生的向量与参考实现位于同一向量空间，可以与已存储的向量混合检索。
+与参考实现的余弦相似度下限见 PARITY_THRESHOLDS: torchscript 后端在加载时自动校验，
+backend/tests/test_inference_backends.py 在不同批次大小下校验，benchmarks/bench_inference.py 可对比所有后端。
+本模块只在模型加载时 (clip_model.load_model) 导入，torch 由调用方传入。
+"""
+import logging
+import os
+import numpy as np
+
+INFERENCE_BACKENDS = ("torch", "torchscript", "int8", "onnx")
+# 各后端与参考实现 (torch fp32) 的向量余弦相似度应不低于此值
+PARITY_THRESHOLDS = {"torch": 0.9999, "torchscript": 0.999, "onnx": 0.999, "int8": 0.98}
+ONNX_DIR = os.environ.get("PHOTO_INSIGHT_ONNX_DIR", "./onnx_models")
+ONNX_OPSET = 17
+IMAGE_SIZE = 224
+TEXT_MAX_LENGTH = 77  # CLIP 文本编码器的最大长度，文本输入统一补齐到该长度，便于导出固定形状的图
+CLIP_BOS_TOKEN = 49406  # CLIP 分词器的 <|startoftext|>
+CLIP_EOS_TOKEN = 49407  # <|endoftext|>，同时用于补齐
+
+def configure_threads(torch, num_threads: int):
+    """num_threads > 0 时设置 torch 的算子内线程数 (默认使用所有核心，与解码进程争抢 CPU)。"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+        logging.info(f"torch 推理线程数: {num_threads}")
+
+def _towers(torch, model):
+    """将 CLIP 的图像与文本编码器包装为只接收张量参数的模块，便于 trace 与导出。"""
+
+    class ImageTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model.get_image_features(pixel_values=pixel_values)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    return ImageTower().eval(), TextTower().eval()
+
+def example_arrays(batch_size: int = 2, seed: int = 0):
+    """
+    trace、导出与校验使用的示例输入 (numpy): 随机图像，以及长度各不相同、EOS 之后补齐的文本。
+    批次大于 1 且各行长度不同，避免把批次大小或 "没有补齐" 的分支固化到图中。
+    :return: (pixel_values, input_ids, attention_mask)
+    """
+    rng = np.random.default_rng(seed)
+    pixel_values = rng.standard_normal((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)).astype(np.float32)
+    input_ids = np.full((batch_size, TEXT_MAX_LENGTH), CLIP_EOS_TOKEN, dtype=np.int64)
+    attention_mask = np.zeros((batch_size, TEXT_MAX_LENGTH), dtype=np.int64)
+    for row in range(batch_size):
+        length = min(TEXT_MAX_LENGTH, 4 + 7 * row + 3 * seed)
+        input_ids[row, 0] = CLIP_BOS_TOKEN
+        input_ids[row, 1:length - 1] = rng.integers(400, 40000, length - 2)
+        attention_mask[row, :length] = 1
+    return pixel_values, input_ids, attention_mask
+
+def _example_inputs(torch, device, batch_size: int = 2):
+    return tuple(torch.from_numpy(array).to(device) for array in example_arrays(batch_size))
+
+class TorchEncoder:
+    """PyTorch eager 推理 (参考实现)"""
+    name = "torch"
+
+    def __init__(self, torch, model, device: str):
+        self.torch = torch
+        self.device = device
+        self.image_tower, self.text_tower = _towers(torch, model)
+
+    def _run(self, module, *arrays):
+        tensors = [self.torch.from_numpy(np.ascontiguousarray(array)).to(self.device) for array in arrays]
+        with self.torch.inference_mode():
+            features = module(*tensors)
+        return features.float().cpu().numpy().astype(np.float32, copy=False)
+
+    def encode_image(self, pixel_values):
+        """:param pixel_values: (N, 3, 224, 224) float32。:return: (N, 512) float32。"""
+        return self._run(self.image_tower, pixel_values)
+
+    def encode_text(self, input_ids, attention_mask):
+        """:param input_ids / attention_mask: (N, 77) int64。:return: (N, 512) float32。"""
+        return self._run(self.text_tower, input_ids.astype(np.int64, copy=False),
+                         attention_mask.astype(np.int64, copy=False))
+
+class Int8Encoder(TorchEncoder):
+    """线性层动态 int8 量化 (权重 int8，激活在运行时量化)，只支持 CPU。"""
+    name = "int8"
+
+    def __init__(self, torch, model, device: str):
+        if device != "cpu":
+            logging.warning("int8 动态量化只支持 CPU，已改为在 CPU 上推理")
+        quantized = torch.ao.quantization.quantize_dynamic(model.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(torch, quantized, "cpu")
+
+class TorchScriptEncoder(TorchEncoder):
+    """
+    trace 后 freeze 的 TorchScript 编码器，省去 Python 层的调度开销。
+    trace 只记录示例输入走过的路径，创建后会用不同的批次大小与文本长度与 eager 结果比较，
+    不一致时记录错误并改用 eager 推理 (name 变为 torch)。
+    """
+    name = "torchscript"
+    VERIFY_BATCH_SIZES = (1, 3)  # 与 trace 时的批次大小 (2) 不同
+
+    def __init__(self, torch, model, device: str):
+        super().__init__(torch, model, device)
+        eager_image, eager_text = self.image_tower, self.text_tower
+        pixel_values, input_ids, attention_mask = _example_inputs(torch, device)
+        with torch.no_grad():
+            # check_trace 只会用同一组示例输入重新运行，校验见 _verify
+            self.image_tower = self._freeze(torch.jit.trace(eager_image, pixel_values, check_trace=False))
+            self.text_tower = self._freeze(
+                torch.jit.trace(eager_text, (input_ids, attention_mask), check_trace=False))
+        parity = self._verify(eager_image, eager_text)
+        if parity < PARITY_THRESHOLDS[self.name]:
+            logging.error(f"TorchScript 编码器与 eager 结果不一致 (最小余弦相似度 {parity:.5f})，改用 eager 推理")
+            self.image_tower, self.text_tower = eager_image, eager_text
+            self.name = TorchEncoder.name
+
+    def _freeze(self, traced):
+        frozen = self.torch.jit.freeze(traced.eval())
+        return self.torch.jit.optimize_for_inference(frozen)
+
+    def _verify(self, eager_image, eager_text):
+        """在 VERIFY_BATCH_SIZES 下比较 trace 结果与 eager 结果，返回最小余弦相似度。"""
+        worst = 1.0
+        for batch_size in self.VERIFY_BATCH_SIZES:
+            pixel_values, input_ids, attention_mask = example_arrays(batch_size, seed=batch_size)
+            for eager, traced, arrays in ((eager_image, self.image_tower, (pixel_values,)),
+                                          (eager_text, self.text_tower, (input_ids, attention_mask))):
+                parity = cosine_parity(self._run(eager, *arrays), self._run(traced, *arrays))
+                worst = min(worst, parity['min'])
+        return worst
+
+class OnnxEncoder:
+    """ONNX Runtime 推理。第一次使用时将模型导出到 ONNX_DIR，之后直接加载导出的文件。"""
+    name = "onnx"
+
+    def __init__(self, torch, model, model_name: str, num_threads: int = 0, root: str = ONNX_DIR):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError("使用 onnx 推理后端需要安装 onnxruntime") from e
+
+        directory = os.path.join(root, model_name.replace("/", "--"))
+        image_path = os.path.join(directory, "image_encoder.onnx")
+        text_path = os.path.join(directory, "text_encoder.onnx")
+        if not (os.path.exists(image_path) and os.path.exists(text_path)):
+            export_onnx(torch, model, directory)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.image_session = onnxruntime.InferenceSession(image_path, options, providers=providers)
+        self.text_session = onnxruntime.InferenceSession(text_path, options, providers=providers)
+
+    def encode_image(self, pixel_values):
+        (features,) = self.image_session.run(
+            None, {"pixel_values": np.ascontiguousarray(pixel_values, dtype=np.float32)})
+        return features.astype(np.float32, copy=False)
+
+    def encode_text(self, input_ids, attention_mask):
+        (features,) = self.text_session.run(None, {
+            "input_ids": input_ids.astype(np.int64, copy=False),
+            "attention_mask": attention_mask.astype(np.int64, copy=False),
+        })
+        return features.astype(np.float32, copy=False)
+
+def export_onnx(torch, model, directory: str):
+    """将图像与文本编码器导出为 ONNX (批次维度可变)。先写临时文件再替换，避免留下不完整的模型。"""
+    os.makedirs(directory, exist_ok=True)
+    image_tower, text_tower = _towers(torch, model.to("cpu"))
+    pixel_values, input_ids, attention_mask = _example_inputs(torch, "cpu")
+    exports = [
+        ("image_encoder.onnx", image_tower, (pixel_values,), ["pixel_values"]),
+        ("text_encoder.onnx", text_tower, (input_ids, attention_mask), ["input_ids", "attention_mask"]),
+    ]
+    for filename, module, args, input_names in exports:
+        path = os.path.join(directory, filename)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        logging.info(f"正在导出 ONNX 模型: {path}")
+        torch.onnx.export(
+            module, args, tmp_path,
+            input_names=input_names,
+            output_names=["features"],
+            dynamic_axes={name: {0: "batch"} for name in input_names + ["features"]},
+            opset_version=ONNX_OPSET,
+        )
+        os.replace(tmp_path, path)
+
+def create_encoder(name: str, torch, model, device: str, model_name: str, num_threads: int = 0):
+    """按名称创建推理后端"""
+    configure_threads(torch, num_threads)
+    if name == "torch":
+        return TorchEncoder(torch, model, device)
+    if name == "torchscript":
+        return TorchScriptEncoder(torch, model, device)
+    if name == "int8":
+        return Int8Encoder(torch, model, device)
+    if name == "onnx":
+        return OnnxEncoder(torch, model, model_name, num_threads)
+    raise ValueError(f"未知的推理后端: {name} (可选: {', '.join(INFERENCE_BACKENDS)})")
+
+def cosine_parity(reference, candidate):
+    """
+    逐行比较两组向量的余弦相似度。
+    :return: {'min': 最小值, 'mean': 平均值}
+    """
+    reference = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    candidate = candidate / np.maximum(np.linalg.norm(candidate, axis=1, keepdims=True), 1e-12)
+    similarity = np.sum(reference * candidate, axis=1)
+    return {'min': float(similarity.min()), 'mean': float(similarity.mean())}
@@ -0,0 +1,136 @@
+"""
+多进程部署的进程间通信 (见 store_service.py)。
+
+基于标准库 multiprocessing.connection: TCP 连接 + 共享密钥 (HMAC 握手) 认证，消息为 pickle 序列化的元组。
+
+安全: 服务端会反序列化 (unpickle) 收到的每条消息，持有密钥的一方可以在服务进程中执行任意代码，
+因此密钥必须保密，没有密钥时服务端与客户端都拒绝启动:
+- 优先使用 PHOTO_INSIGHT_SERVICE_KEY；
+- 未设置时使用密钥文件 PHOTO_INSIGHT_SERVICE_KEY_FILE (默认 ~/.config/photo-insight/service.key，
+  位于工作目录之外，不会随代码仓库一起提交): 存储服务第一次启动时生成随机密钥并写入
+  (权限 0600，仅所有者可读写)，同一用户运行的其他进程从中读取；可被其他用户读取的密钥文件会被拒绝。
+密钥只用于认证而不加密，服务地址不应暴露在不可信的网络中。
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+# 配置
+SERVICE_ADDRESS = os.environ.get("PHOTO_INSIGHT_SERVICE_ADDRESS", "127.0.0.1:8765")
+SERVICE_KEY_FILE = os.environ.get("PHOTO_INSIGHT_SERVICE_KEY_FILE") or os.path.join(
+    os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"), "photo-insight", "service.key")
+CONNECT_RETRIES = int(os.environ.get("PHOTO_INSIGHT_SERVICE_RETRIES", "5"))  # 连接失败时的重试次数 (间隔逐次加倍)
+
+class ServiceError(RuntimeError):
+    """服务端执行请求时出错，或服务不可用"""
+
+def service_authkey(create: bool = False):
+    """
+    连接存储服务的密钥: PHOTO_INSIGHT_SERVICE_KEY，未设置时读取密钥文件。
+    :param create: 密钥文件不存在时生成随机密钥 (存储服务启动时使用)。
+    :raises ServiceError: 没有可用的密钥，或密钥文件可被其他用户访问时。
+    """
+    key = os.environ.get("PHOTO_INSIGHT_SERVICE_KEY")
+    if key:
+        return key.encode("utf-8")
+    path = SERVICE_KEY_FILE
+    if create and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+            logging.info(f"已生成存储服务密钥: {path}")
+    if not os.path.exists(path):
+        raise ServiceError(f"未设置 PHOTO_INSIGHT_SERVICE_KEY，密钥文件 {path} 也不存在 (请先启动存储服务)")
+    if os.name == "posix" and os.stat(path).st_mode & 0o077:
+        raise ServiceError(f"密钥文件 {path} 可被其他用户访问，请执行 chmod 600 {path}")
+    with open(path, encoding="utf-8") as f:
+        key = f.read().strip()
+    if not key:
+        raise ServiceError(f"密钥文件 {path} 为空")
+    return key.encode("utf-8")
+
+def parse_address(address: str):
+    """"host:port" -> (host, port)"""
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"无效的服务地址: {address} (格式为 host:port)")
+    return host, int(port)
+
+def connect(address: str = SERVICE_ADDRESS, authkey: bytes = None, retries: int = CONNECT_RETRIES):
+    """
+    连接服务，失败时按 0.2、0.4、0.8... 秒的间隔重试 (服务可能正在启动)。
+    :param authkey: 为 None 时使用 service_authkey()。
+    :raises ServiceError: 没有密钥，或重试后仍无法连接时。
+    """
+    delay = 0.2
+    for attempt in range(retries + 1):
+        try:
+            # 存储服务第一次启动时才生成密钥文件，与连接一起重试
+            return Client(parse_address(address), authkey=authkey if authkey is not None else service_authkey())
+        except AuthenticationError as e:
+            raise ServiceError(f"服务 {address} 拒绝了密钥: {e}") from e
+        except (OSError, EOFError, ServiceError) as e:
+            if attempt == retries:
+                raise ServiceError(f"无法连接服务 {address}: {e}") from e
+            time.sleep(delay)
+            delay *= 2
+
+class RpcClient:
+    """
+    请求-响应式的服务客户端。每个线程使用自己的连接，连接断开 (例如服务重启) 后自动重连一次。
+    authkey 为 None 时在第一次连接时读取密钥 (见 service_authkey)，没有密钥时请求失败。
+    请求: ("call", 方法名, args, kwargs)；响应: ("ok", 结果) 或 ("error", 错误信息)。
+    """
+
+    def __init__(self, address: str = SERVICE_ADDRESS, authkey: bytes = None):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.address, self.authkey)
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def request(self, message):
+        """发送一个请求并等待响应，返回 ("ok", ...) 中的结果。"""
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send(message)
+                reply = conn.recv()
+                break
+            except (OSError, EOFError) as e:
+                self._reset()
+                if attempt == 1:
+                    raise ServiceError(f"与服务 {self.address} 的连接中断: {e}") from e
+                logging.warning(f"与服务 {self.address} 的连接中断，正在重连: {e}")
+        status, result = reply
+        if status != "ok":
+            raise ServiceError(result)
+        return result
+
+    def call(self, method: str, *args, **kwargs):
+        return self.request(("call", method, args, kwargs))
+
+    def close(self):
+        self._reset()
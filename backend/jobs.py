@@ -0,0 +1,468 @@
+"""
+后台索引任务管理。
+
+索引任务在独立的工作线程中运行，不会阻塞 Socket.IO 的事件循环。
+每个任务都有一个 ID，可以通过 Socket.IO 事件暂停、恢复或取消；
+任务进度与检查点保存在 SQLite 的 indexing_jobs 表中，服务重启后会从检查点继续。
+暂停的任务在下一个批次处退出、不占用线程池，恢复时重新提交并从检查点继续。
+提交任务时可以要求对其开启性能分析 (见 metrics.profile)，结果文件路径随 indexing_complete 一起发送。
+
+设置 PHOTO_INSIGHT_JOB_QUEUE=sqlite 后，任务不在本进程中运行，而是写入 SQLite 的任务队列 (worker_tasks)，
+由独立的工作进程 (python -m backend.worker) 领取执行，见 QueuedJobManager。
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import crud, database, indexer, metrics
+
+# 配置
+MAX_CONCURRENT_JOBS = int(os.environ.get("PHOTO_INSIGHT_MAX_JOBS", "1"))  # 同时运行的索引任务上限
+JOB_STATUSES = ("queued", "running", "paused", "completed", "cancelled", "failed")
+JOB_QUEUE = os.environ.get("PHOTO_INSIGHT_JOB_QUEUE", "local")  # local: 在本进程中运行; sqlite: 交给工作进程
+WORKER_LEASE_SECONDS = float(os.environ.get("PHOTO_INSIGHT_WORKER_LEASE", "60"))  # 工作进程的心跳超时
+
+class Job:
+    """一个索引任务的运行时状态。"""
+
+    def __init__(self, job_id: str, directory: str, sid: str = None, checkpoint: str = None,
+                 status: str = "queued", processed: int = 0, total: int = 0, profiler: str = None):
+        self.id = job_id
+        self.directory = directory
+        self.sid = sid
+        self.profiler = profiler  # 性能分析器 (metrics.PROFILERS)，None 表示不分析；不会随检查点保存
+        self.checkpoint = checkpoint
+        self.status = status
+        self.processed = processed
+        self.total = total
+        self.error = None
+        self.started = False
+        self.scheduled = False  # 已提交到线程池 (排队或运行中)，由 JobManager 在持有锁时维护
+        self._cancelled = threading.Event()
+        self._interrupted = threading.Event()  # 服务关闭时中断，数据库状态保持不变
+        self._running = threading.Event()  # 未设置时表示已暂停
+        self._running.set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def interrupt(self):
+        self._interrupted.set()
+
+    @property
+    def interrupted(self):
+        return self._interrupted.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def should_stop(self):
+        """在批次之间调用: 暂停、取消或中断时返回 True (不会阻塞，暂停的任务在检查点处退出)。"""
+        return self.paused or self.cancelled or self.interrupted
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'directory': self.directory,
+            'status': self.status,
+            'processed': self.processed,
+            'total': self.total,
+            'error': self.error,
+        }
+
+class JobManager:
+    """
+    管理索引任务的提交、暂停、恢复、取消与断点续跑。
+    线程池的大小即并发任务上限，超出的任务会以 queued 状态排队。
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_JOBS):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="indexing-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._emit = None
+        metrics.register_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        for status in JOB_STATUSES:
+            metrics.INDEXING_JOBS.set(statuses.count(status), status=status)
+
+    def set_emitter(self, emit):
+        """设置线程安全的消息发送回调 emit(event, data, room)。"""
+        self._emit = emit
+
+    def _send(self, job: Job, event: str, payload: dict):
+        if self._emit is None:
+            return
+        payload = dict(payload, job_id=job.id)
+        # 服务重启后恢复的任务没有对应的客户端，此时广播给所有客户端
+        self._emit(event, payload, job.sid)
+
+    def _save(self, job: Job, **fields):
+        db = database.SessionLocal()
+        try:
+            crud.update_indexing_job(db, job.id, **fields)
+        except Exception as e:
+            logging.error(f"保存索引任务 {job.id} 状态时出错: {e}")
+        finally:
+            db.close()
+
+    def _set_status(self, job: Job, status: str, **fields):
+        job.status = status
+        self._save(job, status=status, **fields)
+        self._send(job, 'job_status', {'job': job.to_dict()})
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._lock:
+            return [job.to_dict() for job in self._jobs.values()]
+
+    def active_directories(self):
+        """正在排队或运行的索引任务的目录"""
+        with self._lock:
+            return [job.directory for job in self._jobs.values() if job.status in ("queued", "running")]
+
+    def submit(self, directory: str, sid: str = None, profiler: str = None):
+        """
+        提交一个索引任务。如果同一目录已有未结束的任务，则直接返回该任务。
+        :param profiler: 可选，对该任务开启性能分析 ("cprofile" 或 "pyinstrument")。
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if job.directory == directory and job.status in ("queued", "running", "paused"):
+                    job.sid = sid or job.sid
+                    return job
+
+            job = Job(uuid.uuid4().hex, directory, sid=sid, profiler=profiler)
+            db = database.SessionLocal()
+            try:
+                crud.create_indexing_job(db, job.id, directory)
+            finally:
+                db.close()
+            self._jobs[job.id] = job
+            self._schedule(job)
+        logging.info(f"索引任务 {job.id} 已提交: {directory}")
+        return job
+
+    def adopt(self, job: Job):
+        """
+        在本管理器的线程池中运行一次已存在于数据库中的任务 (工作进程领取任务后使用)。
+        任务暂停时同样在检查点处结束，由调用方决定之后如何继续。
+        :return: concurrent.futures.Future，任务结束 (完成、失败、取消、中断或暂停) 时完成。
+        """
+        with self._lock:
+            self._jobs[job.id] = job
+        return self._executor.submit(self._execute, job)
+
+    def resume_unfinished(self):
+        """服务启动时恢复上次未完成的任务，已暂停的任务保持暂停状态。"""
+        db = database.SessionLocal()
+        try:
+            # 在会话关闭前读出任务 (修复不一致时的提交会使已加载的记录过期)
+            restored = [Job(db_job.id, db_job.directory, checkpoint=db_job.checkpoint, status=db_job.status,
+                            processed=db_job.processed, total=db_job.total) for db_job in crud.get_unfinished_jobs(db)]
+            if restored:
+                # 存在未完成的任务说明上次可能异常退出，先修复 SQLite 与向量库之间的不一致
+                crud.reconcile_vector_store(db)
+        except Exception as e:
+            logging.error(f"检查未完成的索引任务时出错: {e}")
+            restored = []
+        finally:
+            db.close()
+
+        for job in restored:
+            if job.status == "paused":
+                # 保持暂停，恢复时才提交到线程池
+                job.pause()
+            else:
+                job.status = "queued"
+            with self._lock:
+                self._jobs[job.id] = job
+                self._schedule(job)
+            logging.info(f"从检查点恢复索引任务 {job.id}: {job.directory} (检查点: {job.checkpoint})")
+        return len(restored)
+
+    def pause(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job.status not in ("queued", "running"):
+            return None
+        job.pause()
+        self._set_status(job, "paused")
+        return job
+
+    def resume(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job.status != "paused":
+            return None
+        job.resume()
+        # 回到排队状态，开始运行时再变为 running
+        self._set_status(job, "queued")
+        with self._lock:
+            self._schedule(job)
+        return job
+
+    def cancel(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job.status in ("completed", "cancelled", "failed"):
+            return None
+        job.cancel()
+        self._set_status(job, "cancelled")
+        return job
+
+    def shutdown(self):
+        """中断所有任务。任务在数据库中的状态与检查点保持不变，以便下次启动时恢复。"""
+        with self._lock:
+            for job in self._jobs.values():
+                job.interrupt()
+        self._executor.shutdown(wait=True)
+
+    def _schedule(self, job: Job):
+        """把任务提交到线程池 (调用方持有 self._lock)。暂停的任务与已提交的任务不会重复提交。"""
+        if job.scheduled or job.should_stop():
+            return
+        job.scheduled = True
+        self._executor.submit(self._run, job)
+
+    def _run(self, job: Job):
+        """线程池中的入口: 执行一次任务；退出前已被恢复的任务 (暂停后很快恢复) 重新提交。"""
+        try:
+            self._execute(job)
+        finally:
+            with self._lock:
+                job.scheduled = False
+                if job.status in ("queued", "running"):
+                    self._schedule(job)
+
+    def _execute(self, job: Job):
+        """在工作线程中执行索引任务，暂停、取消或中断时在检查点处返回。"""
+        # 排队期间被暂停或取消的任务直接返回
+        if job.should_stop():
+            return
+        job.started = True
+        self._set_status(job, "running")
+
+        def emit(event, payload):
+            self._send(job, event, payload)
+
+        def on_checkpoint(path, done, total):
+            job.checkpoint = path
+            job.processed = done
+            job.total = total
+            self._save(job, checkpoint=path, processed=done, total=total)
+
+        stopped = []
+
+        def should_stop():
+            # 记录是否提前结束，之后据此区分 "全部完成" 与 "暂停后退出"
+            if job.should_stop():
+                stopped.append(True)
+                return True
+            return False
+
+        def run():
+            return indexer.index_directory(job.directory, emit, should_stop=should_stop,
+                                           checkpoint=job.checkpoint, on_checkpoint=on_checkpoint)
+
+        try:
+            if job.profiler:
+                with metrics.profile(f"indexing-{job.id}", job.profiler) as profile:
+                    stats = run()
+                stats['profile'] = profile['path']
+            else:
+                stats = run()
+            if job.interrupted:
+                logging.info(f"索引任务 {job.id} 已中断，将在下次启动时从检查点恢复")
+                return
+            if job.cancelled:
+                logging.info(f"索引任务 {job.id} 已取消")
+                return
+            if stopped:
+                logging.info(f"索引任务 {job.id} 已暂停，恢复后从检查点 {job.checkpoint} 继续")
+                return
+            job.processed = job.total = stats['total']
+            self._set_status(job, "completed", processed=job.processed, total=job.total)
+            logging.info(f"索引任务 {job.id} 完成: {job.directory}")
+            self._send(job, 'indexing_complete', {'data': '所有图片处理完成!', 'stats': stats})
+        except Exception as e:
+            logging.error(f"索引任务 {job.id} 失败: {e}")
+            job.error = str(e)
+            self._set_status(job, "failed", error=str(e))
+            self._send(job, 'error', {'data': f'扫描出错: {str(e)}'})
+
+
+class QueuedJobManager:
+    """
+    PHOTO_INSIGHT_JOB_QUEUE=sqlite 时 Web 进程使用的任务管理器，接口与 JobManager 相同。
+    任务写入 SQLite 的任务队列，由工作进程执行；暂停、恢复与取消只修改数据库中的状态，
+    工作进程在每次心跳时读取并执行。多个 Web 进程可以同时使用。
+    """
+
+    def __init__(self):
+        self._emit = None
+        metrics.register_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        db = database.SessionLocal()
+        try:
+            counts = crud.count_indexing_jobs(db)
+        finally:
+            db.close()
+        for status in JOB_STATUSES:
+            metrics.INDEXING_JOBS.set(counts.get(status, 0), status=status)
+
+    def set_emitter(self, emit):
+        self._emit = emit
+
+    @staticmethod
+    def _job(db_job, sid=None):
+        job = Job(db_job.id, db_job.directory, sid=sid, checkpoint=db_job.checkpoint, status=db_job.status,
+                  processed=db_job.processed, total=db_job.total)
+        job.error = db_job.error
+        return job
+
+    def _set_status(self, job_id: str, status: str):
+        db = database.SessionLocal()
+        try:
+            crud.update_indexing_job(db, job_id, status=status)
+            job = self._job(crud.get_indexing_job(db, job_id), sid=crud.get_indexing_task_sid(db, job_id))
+        finally:
+            db.close()
+        if self._emit is not None:
+            self._emit('job_status', {'job': job.to_dict(), 'job_id': job.id}, job.sid)
+        return job
+
+    def get(self, job_id: str):
+        db = database.SessionLocal()
+        try:
+            db_job = crud.get_indexing_job(db, job_id)
+            return self._job(db_job) if db_job is not None else None
+        finally:
+            db.close()
+
+    def list_jobs(self):
+        db = database.SessionLocal()
+        try:
+            return [self._job(db_job).to_dict() for db_job in reversed(crud.list_indexing_jobs(db))]
+        finally:
+            db.close()
+
+    def active_directories(self):
+        db = database.SessionLocal()
+        try:
+            return [db_job.directory for db_job in crud.get_unfinished_jobs(db) if db_job.status in ("queued", "running")]
+        finally:
+            db.close()
+
+    def submit(self, directory: str, sid: str = None, profiler: str = None):
+        """提交一个索引任务 (同一目录已有未结束的任务时直接返回该任务)。"""
+        db = database.SessionLocal()
+        try:
+            for db_job in crud.get_unfinished_jobs(db):
+                if db_job.directory == directory:
+                    return self._job(db_job, sid=sid)
+            db_job = crud.create_indexing_job(db, uuid.uuid4().hex, directory)
+            crud.ensure_indexing_task(db, db_job.id, params={'profiler': profiler}, sid=sid)
+            job = self._job(crud.get_indexing_job(db, db_job.id), sid=sid)
+        finally:
+            db.close()
+        logging.info(f"索引任务 {job.id} 已加入任务队列: {directory}")
+        return job
+
+    def resume_unfinished(self):
+        """为上次未完成、且没有排队或运行中任务的索引任务重新加入任务队列 (由工作进程从检查点继续)。"""
+        db = database.SessionLocal()
+        try:
+            return sum(crud.ensure_indexing_task(db, db_job.id) for db_job in crud.get_unfinished_jobs(db))
+        except Exception as e:
+            logging.error(f"检查未完成的索引任务时出错: {e}")
+            return 0
+        finally:
+            db.close()
+
+    def pause(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job.status not in ("queued", "running"):
+            return None
+        return self._set_status(job_id, "paused")
+
+    def resume(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job.status != "paused":
+            return None
+        db = database.SessionLocal()
+        try:
+            held = any(task.job_id == job_id and task.status == "running" and task.heartbeat_at is not None
+                       and task.heartbeat_at >= time.time() - WORKER_LEASE_SECONDS
+                       for task in crud.get_active_worker_tasks(db, "indexing"))
+            if not held:
+                # 暂停期间工作进程退出了，重新排队
+                crud.ensure_indexing_task(db, job_id)
+        finally:
+            db.close()
+        return self._set_status(job_id, "running" if held else "queued")
+
+    def cancel(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job.status in ("completed", "cancelled", "failed"):
+            return None
+        job = self._set_status(job_id, "cancelled")
+        db = database.SessionLocal()
+        try:
+            crud.cancel_worker_tasks(db, kind="indexing", job_id=job_id)
+        finally:
+            db.close()
+        return job
+
+    def shutdown(self):
+        """任务在工作进程中运行，Web 进程退出不影响它们"""
+
+    # ---- 季节分类 ----
+
+    def classification_running(self):
+        db = database.SessionLocal()
+        try:
+            return bool(crud.get_active_worker_tasks(db, "classification"))
+        finally:
+            db.close()
+
+    def submit_classification(self, sid: str = None, **params):
+        """
+        把季节分类任务加入任务队列 (参数同 classify_seasons.classification_task)。
+        :return: 任务；已有排队或运行中的分类任务时返回 None。
+        """
+        db = database.SessionLocal()
+        try:
+            if crud.get_active_worker_tasks(db, "classification"):
+                return None
+            return crud.create_worker_task(db, "classification", params=params, sid=sid)
+        finally:
+            db.close()
+
+    def cancel_classification(self):
+        """取消排队或运行中的分类任务，返回是否有任务被取消"""
+        db = database.SessionLocal()
+        try:
+            return crud.cancel_worker_tasks(db, kind="classification") > 0
+        finally:
+            db.close()
+
+job_manager = QueuedJobManager() if JOB_QUEUE == "sqlite" else JobManager()
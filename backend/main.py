@@ -2,24 +2,28 @@
 import asyncio
 import os
 import socketio
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 from sqlalchemy.orm import Session
 
 # 导入数据库和模型相关的模块
-from . import crud, models, database, clip_model, vector_db
-from .classify_seasons import classification_task
+from . import crud, models, database, clip_model, vector_db, migrations, search, thumbnails, dedup, embedding_cache, metrics
+from . import jobs, messaging
+from .jobs import job_manager
+from .watcher import watcher
+from . import classify_seasons
 
 # 在应用启动时创建数据库表
 models.Base.metadata.create_all(bind=database.engine)
+migrations.run_migrations()
 
 # 日志配置
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# 预加载模型，确保应用启动时模型就绪
-if clip_model.model is None:
-    logging.error("CLIP模型未能加载，应用可能无法正常处理图片特征。")
+# CLIP 模型与向量库在第一次使用时加载；设置 PHOTO_INSIGHT_WARMUP=1 可在启动后于后台提前加载
+WARMUP = os.environ.get("PHOTO_INSIGHT_WARMUP", "0") == "1"
 
 # 创建 FastAPI 应用
 app = FastAPI()
@@ -34,9 +38,65 @@ app.add_middleware(
 )
 
 # 创建 Socket.IO 服务
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+# 设置 PHOTO_INSIGHT_MESSAGE_QUEUE 后多个 Web 进程与工作进程通过消息队列共享客户端 (见 messaging.py)
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*',
+                           client_manager=messaging.create_client_manager())
 socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
+@app.on_event("startup")
+async def startup():
+    """启动时绑定任务管理器的消息通道，并恢复上次未完成的索引任务"""
+    loop = asyncio.get_running_loop()
+
+    def emit(event, payload, room=None):
+        # 任务在工作线程中运行，通过事件循环线程安全地发送消息
+        asyncio.run_coroutine_threadsafe(sio.emit(event, payload, room=room), loop)
+
+    job_manager.set_emitter(emit)
+    resumed = job_manager.resume_unfinished()
+    if resumed:
+        logging.info(f"已恢复 {resumed} 个未完成的索引任务")
+    if jobs.JOB_QUEUE == "sqlite":
+        # 多个 Web 进程不能各自监视同一批目录，文件监视由 python -m backend.worker --watch 运行
+        if watcher.roots:
+            logging.info("多进程部署时文件监视在工作进程中运行 (python -m backend.worker --watch)")
+    elif watcher.start(emit):
+        # 补上服务未运行期间的变化 (增量扫描，未变化的文件不会重新处理)
+        for directory in watcher.roots:
+            if os.path.isdir(directory):
+                job_manager.submit(directory)
+    if WARMUP:
+        logging.info("正在后台预加载 CLIP 模型与向量库...")
+        clip_model.warmup()
+        vector_db.warmup()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """关闭时停止文件监视并中断正在运行的任务，检查点会保留到下次启动"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, watcher.stop)
+    await loop.run_in_executor(None, job_manager.shutdown)
+
+@app.get("/health")
+def health():
+    """
+    健康检查。服务能响应即为存活；模型与向量库都已加载时 ready 为 true，
+    未加载的组件会在第一次需要时 (或预加载时) 加载。
+    """
+    model_status = clip_model.status()
+    vector_status = vector_db.status()
+    return {
+        'status': 'ok',
+        'ready': model_status['loaded'] and vector_status['loaded'],
+        'model': model_status,
+        'vector_store': vector_status,
+    }
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus 格式的运行指标: 索引各阶段耗时、队列深度、VLM 延迟与错误、检索耗时等"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @sio.event
 async def connect(sid, environ):
     """客户端连接时触发"""
@@ -50,9 +110,16 @@ async def disconnect(sid):
 
 @sio.on('start_indexing')
 async def start_indexing(sid, data):
-    """开始索引指定目录的图片并存入数据库"""
+    """开始索引指定目录的图片并存入数据库 (可选参数 profile: "cprofile" / "pyinstrument"，对本次任务开启性能分析)"""
+    data = _request_data(data)
     directory = data.get('directory')
-    if not directory or not os.path.isdir(directory):
+    profiler = data.get('profile')
+    if profiler is True:
+        profiler = "cprofile"
+    if profiler and (not isinstance(profiler, str) or profiler not in metrics.PROFILERS):
+        await sio.emit('error', {'data': f'不支持的性能分析器: {profiler}，可选: {", ".join(metrics.PROFILERS)}'}, room=sid)
+        return
+    if not isinstance(directory, str) or not os.path.isdir(directory):
         logging.error(f"无效的目录: {directory}")
         await sio.emit('error', {'data': '无效的目录或目录不存���'}, room=sid)
         return
@@ -60,104 +127,482 @@ async def start_indexing(sid, data):
     logging.info(f"开始扫描目录: {directory}")
     await sio.emit('indexing_status', {'data': f'开始扫描目录: {directory}'}, room=sid)
 
-    supported_extensions = ('.jpg', '.jpeg', '.png', '.webp')
+    # 索引在后台任务中运行，事件循环保持响应
+    job = job_manager.submit(directory, sid=sid, profiler=profiler or None)
+    await sio.emit('job_created', {'job': job.to_dict()}, room=sid)
+
+@sio.on('pause_job')
+async def pause_job(sid, data):
+    """暂停索引任务"""
+    await _control_job(sid, data, job_manager.pause, '暂停')
+
+@sio.on('resume_job')
+async def resume_job(sid, data):
+    """恢复已暂停的索引任务"""
+    await _control_job(sid, data, job_manager.resume, '恢复')
+
+@sio.on('cancel_job')
+async def cancel_job(sid, data):
+    """取消索引任务"""
+    await _control_job(sid, data, job_manager.cancel, '取消')
+
+async def _control_job(sid, data, action, action_name):
+    job_id = _request_data(data).get('job_id')
+    job = action(job_id) if isinstance(job_id, str) and job_id else None
+    if job is None:
+        await sio.emit('error', {'data': f'无法{action_name}任务: {job_id}'}, room=sid)
+        return
+    logging.info(f"客户端 {sid} {action_name}了索引任务 {job_id}")
+
+@sio.on('list_jobs')
+async def list_jobs(sid, data):
+    """列出所有索引任务"""
+    await sio.emit('jobs_list', {'jobs': job_manager.list_jobs()}, room=sid)
+
+def _image_data(image):
+    """发送给前端的图片信息"""
+    return {
+        'id': image.id,
+        'path': image.path,
+        'thumbnail_url': thumbnails.thumbnail_url(image.id, image.content_hash),
+    }
+
+def _request_data(data):
+    """Socket.IO 事件的参数，不是对象时按没有参数处理"""
+    return data if isinstance(data, dict) else {}
+
+async def _invalid_params(sid, error):
+    """参数格式错误 (int()/float() 等抛出的 ValueError 或 TypeError) 时通知客户端"""
+    logging.warning(f"客户端 {sid} 的请求参数无效: {error}")
+    await sio.emit('error', {'data': f'无效的参数: {error}'}, room=sid)
+
+def _page_options(data):
+    """解析图片列表请求的分页参数 (格式错误时抛出 ValueError 或 TypeError)"""
+    data = _request_data(data)
+    return {
+        'after_id': int(data.get('cursor') or 0),
+        'limit': int(data.get('limit') or crud.IMAGE_PAGE_SIZE),
+        'stream': bool(data.get('stream')),
+    }
+
+async def _send_images(sid, event, options, season=None):
+    """
+    按游标分页发送图片列表。
+    普通模式只发送一页: event {'images', 'next_cursor', 'season'}，客户端用 next_cursor 请求下一页。
+    流式模式从游标开始连续读取，每读到一页就发送一个 'images_chunk'，全部发送后发送 'images_stream_complete'。
+    """
     db = database.SessionLocal()
     try:
-        image_files = []
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if file.lower().endswith(supported_extensions):
-                    image_files.append(os.path.join(root, file))
-        
-        total_files = len(image_files)
-        await sio.emit('indexing_status', {'data': f'发现 {total_files} 张图片，准备开始处理...'}, room=sid)
-        await asyncio.sleep(1)
-
-        for i, file_path in enumerate(image_files):
-            # 检查图片是否已完整索引
-            db_image = crud.get_image_by_path(db, path=file_path)
-            if db_image and db_image.vector_id:
-                logging.info(f"图片已完整索引，跳过: {file_path}")
-                continue
-
-            # 发送当前处理状态到前端
-            await sio.emit('indexing_status', {'data': f'({i+1}/{total_files}) 正在处理: {os.path.basename(file_path)}'}, room=sid)
-            
-            # 创建记录并生成向量
-            new_image = crud.create_image_record(db, path=file_path)
-            if new_image:
-                logging.info(f"成功索引新图片: {file_path}")
-                await sio.emit('new_image_found', {'path': new_image.path, 'status': 'Indexed'}, room=sid)
-            else:
-                # 可能是文件已存在但未向量化，或者创建失败
-                logging.warning(f"未能为图片创建新索引记录 (可能已存在或出错): {file_path}")
-
-            await asyncio.sleep(0.05) # 防止消息过于频繁
-
-        logging.info(f"目录 {directory} 扫描完成")
-        await sio.emit('indexing_complete', {'data': '所有图片处理完成!'})
-    except Exception as e:
-        logging.error(f"扫描过程中发生错误: {e}")
-        await sio.emit('error', {'data': f'扫描出错: {str(e)}'}, room=sid)
+        if not options['stream']:
+            rows, next_cursor = crud.list_images(db, after_id=options['after_id'], limit=options['limit'], season=season)
+            await sio.emit(event, {
+                'images': [_image_data(row) for row in rows],
+                'next_cursor': next_cursor,
+                'season': season,
+            }, room=sid)
+            return len(rows)
+
+        sent = 0
+        for chunk, (rows, next_cursor) in enumerate(
+                crud.iter_image_pages(db, after_id=options['after_id'], page_size=options['limit'], season=season)):
+            if not sio.manager.is_connected(sid, '/'):
+                logging.info(f"客户端 {sid} 已断开，停止发送图片列表")
+                break
+            await sio.emit('images_chunk', {
+                'images': [_image_data(row) for row in rows],
+                'chunk': chunk,
+                'next_cursor': next_cursor,
+                'season': season,
+            }, room=sid)
+            sent += len(rows)
+        await sio.emit('images_stream_complete', {'total': sent, 'season': season}, room=sid)
+        return sent
     finally:
         db.close()
 
 @sio.on('load_all_images')
 async def load_all_images(sid, data):
-    """从数据库加载所有已索引的图片"""
+    """从数据库分页加载已索引的图片 (参数: cursor、limit、stream)"""
     logging.info("收到加载所有图片的请求")
-    db = database.SessionLocal()
     try:
-        images = crud.get_all_images(db)
-        # 过滤掉那些还没有 vector_id 的不完整记录
-        images_data = [{'path': image.path} for image in images if image.vector_id]
-        await sio.emit('all_images_loaded', {'images': images_data}, room=sid)
-        logging.info(f"已发送 {len(images_data)} 条完整索引记录到客户端")
+        options = _page_options(data)
+    except (TypeError, ValueError) as e:
+        await _invalid_params(sid, e)
+        return
+    try:
+        sent = await _send_images(sid, 'all_images_loaded', options)
+        logging.info(f"已发送 {sent} 条完整索引记录到客户端")
     except Exception as e:
         logging.error(f"加载图片时发生错误: {e}")
         await sio.emit('error', {'data': f'加载图片出错: {str(e)}'}, room=sid)
+
+@sio.on('load_label_counts')
+async def load_label_counts(sid, data):
+    """各标签的图片数 (默认为季节)，用于显示分面计数"""
+    label_type = _request_data(data).get('label_type') or crud.LABEL_SEASON
+    db = database.SessionLocal()
+    try:
+        counts = crud.count_labels(db, label_type)
+        await sio.emit('label_counts_loaded', {'label_type': label_type, 'counts': counts}, room=sid)
+    except Exception as e:
+        logging.error(f"统计标签时发生错误: {e}")
+        await sio.emit('error', {'data': f'统计标签出错: {str(e)}'}, room=sid)
     finally:
         db.close()
 
 @sio.on('start_season_classification')
 async def start_season_classification(sid, data):
-    """从前端启动季节分类任务"""
-    logging.info(f"收到来自 {sid} 的季节分类请求")
+    """从前端启动季节分类任务 (参数: mode、vlm_threshold、force)，未完成的任务会从上次的进度继续"""
+    data = _request_data(data)
+    mode = data.get('mode', 'vlm')
+    force = bool(data.get('force', False))
+    try:
+        vlm_threshold = data.get('vlm_threshold')
+        vlm_threshold = float(vlm_threshold) if vlm_threshold is not None else None
+    except (TypeError, ValueError) as e:
+        await _invalid_params(sid, e)
+        return
+    logging.info(f"收到来自 {sid} 的季节分类请求 (模式: {mode}{'，全部重新分类' if force else ''})")
+    if jobs.JOB_QUEUE == "sqlite":
+        # 加入任务队列，由工作进程执行，进度通过消息队列发回
+        if job_manager.submit_classification(sid=sid, mode=mode, vlm_threshold=vlm_threshold, force=force) is None:
+            await sio.emit('error', {'data': '已有分类任务正在运行'}, room=sid)
+        return
+    if classify_seasons.is_running():
+        await sio.emit('error', {'data': '已有分类任务正在运行'}, room=sid)
+        return
     # 在后台运行分类任务，避免阻塞服务器
-    sio.start_background_task(classification_task, sio=sio, sid=sid)
+    sio.start_background_task(classify_seasons.classification_task, sio=sio, sid=sid, mode=mode,
+                              vlm_threshold=vlm_threshold, force=force)
+
+@sio.on('cancel_season_classification')
+async def cancel_season_classification(sid, data):
+    """取消正在运行的季节分类任务，已提交的结果保留，再次启动时从当前进度继续"""
+    if jobs.JOB_QUEUE == "sqlite":
+        if not job_manager.cancel_classification():
+            await sio.emit('error', {'data': '没有正在运行的分类任务'}, room=sid)
+            return
+        await sio.emit('classification_status', {'data': '正在取消分类任务...', 'job_id': None}, room=sid)
+        return
+    job_id = classify_seasons.cancel_classification()
+    if job_id is None:
+        await sio.emit('error', {'data': '没有正在运行的分类任务'}, room=sid)
+        return
+    await sio.emit('classification_status', {'data': '正在取消分类任务...', 'job_id': job_id}, room=sid)
 
 @sio.on('load_season_images')
 async def load_season_images(sid, data):
-    """根据季节加载图片"""
-    season = data.get('season')
+    """根据季节分页加载图片 (参数: season、cursor、limit、stream)"""
+    season = _request_data(data).get('season')
     if not season:
         await sio.emit('error', {'data': '未提供季节参数'}, room=sid)
         return
+    if season not in crud.SEASONS:
+        await sio.emit('error', {'data': f'无效的季节: {season}'}, room=sid)
+        return
 
     logging.info(f"收到加载 {season} 图片的请求")
+    try:
+        options = _page_options(data)
+    except (TypeError, ValueError) as e:
+        await _invalid_params(sid, e)
+        return
+    try:
+        sent = await _send_images(sid, 'season_images_loaded', options, season=season)
+        logging.info(f"已发送 {sent} 张 {season} 的图片到客户端")
+    except Exception as e:
+        logging.error(f"加载 {season} 图片时发生错误: {e}")
+        await sio.emit('error', {'data': f'加载 {season} 图片出错: {str(e)}'}, room=sid)
+
+def _search_text(query, top_k, offset, filters):
     db = database.SessionLocal()
     try:
-        season_map = {
-            "Spring": crud.get_spring_photos,
-            "Summer": crud.get_summer_photos,
-            "Autumn": crud.get_autumn_photos,
-            "Winter": crud.get_winter_photos,
-        }
-        
-        if season not in season_map:
-            await sio.emit('error', {'data': f'无效的季节: {season}'}, room=sid)
+        return search.search_text(db, query, top_k=top_k, offset=offset, filters=filters)
+    finally:
+        db.close()
+
+@sio.on('search_text')
+async def search_text(sid, data):
+    """
+    文本语义搜索，例如 "海滩上的日落"。
+    可选的过滤条件: seasons、date_from、date_to、min_size_mb、max_size_mb、directory (见 search.SearchFilters)。
+    """
+    data = _request_data(data)
+    query = data.get('query')
+    query = query.strip() if isinstance(query, str) else ''
+    if not query:
+        await sio.emit('error', {'data': '搜索内容不能为空'}, room=sid)
+        return
+    try:
+        top_k = int(data.get('top_k', search.DEFAULT_TOP_K))
+        offset = int(data.get('offset', 0))
+        filters = search.SearchFilters.from_params(data)
+    except (TypeError, ValueError) as e:
+        await _invalid_params(sid, e)
+        return
+    if offset > search.MAX_OFFSET:
+        await sio.emit('error', {'data': f'翻页偏移量不能超过 {search.MAX_OFFSET}'}, room=sid)
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, _search_text, query, top_k, offset, filters)
+        if results is None:
+            await sio.emit('error', {'data': f'无法处理搜索内容: {query}'}, room=sid)
             return
+        await sio.emit('search_results', {'query': query, 'offset': offset, 'results': results}, room=sid)
+    except Exception as e:
+        logging.error(f"搜索 '{query}' 时发生错误: {e}")
+        await sio.emit('error', {'data': f'搜索出错: {str(e)}'}, room=sid)
+
+def _http_filters(season, date_from, date_to, min_size_mb, max_size_mb, directory):
+    """HTTP 查询参数中的过滤条件，格式错误时返回 400"""
+    try:
+        return search.SearchFilters(seasons=season, date_from=date_from, date_to=date_to, min_size_mb=min_size_mb,
+                                    max_size_mb=max_size_mb, directory=directory)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"无效的过滤条件: {e}")
+
+@app.get("/api/search")
+def search_images(q: str, top_k: int = search.DEFAULT_TOP_K, offset: int = 0, season: list = Query(default=[]),
+                  date_from: str = None, date_to: str = None, min_size_mb: float = None, max_size_mb: float = None,
+                  directory: str = None, db: Session = Depends(database.get_db)):
+    """
+    文本语义搜索的 HTTP 接口。
+    例如 /api/search?q=日落&season=Winter&min_size_mb=2&date_from=2023&date_to=2023
+    """
+    if offset > search.MAX_OFFSET:
+        raise HTTPException(status_code=400, detail=f"翻页偏移量不能超过 {search.MAX_OFFSET}")
+    filters = _http_filters(season, date_from, date_to, min_size_mb, max_size_mb, directory)
+    results = search.search_text(db, q, top_k=top_k, offset=offset, filters=filters)
+    if results is None:
+        if not clip_model.is_loaded():
+            raise HTTPException(status_code=503, detail=f"CLIP 模型不可用: {clip_model.status()['error']}")
+        raise HTTPException(status_code=400, detail=f"无法处理搜索内容: {q}")
+    return {'query': q, 'offset': offset, 'results': results}
+
+def _similar_options(data):
+    """从请求参数中提取以图搜图的选项 (格式错误时抛出 ValueError 或 TypeError)"""
+    return {
+        'top_k': int(data.get('top_k', search.DEFAULT_TOP_K)),
+        'min_similarity': float(data.get('min_similarity', 0.0)),
+        'filters': search.SearchFilters.from_params(data),
+    }
+
+def _find_similar(image_id, image_bytes, options):
+    db = database.SessionLocal()
+    try:
+        if image_bytes is not None:
+            return search.find_similar_to_upload(db, image_bytes, **options)
+        return search.find_similar(db, image_id, **options)
+    finally:
+        db.close()
 
-        # limit=500 是一个临时的保护措施，防止一次加载过多图片
-        images = season_map[season](db, limit=500)
-        images_data = [{'path': image.path} for image in images]
-        
-        await sio.emit('season_images_loaded', {'images': images_data, 'season': season}, room=sid)
-        logging.info(f"已发送 {len(images_data)} 张 {season} 的图片到客户端")
+@sio.on('find_similar')
+async def find_similar(sid, data):
+    """
+    以图搜图。data 中提供已索引图片的 image_id，或上传图片的二进制内容 image。
+    结果按页 (page_size) 分多条 similar_results_page 消息发送。
+    """
+    data = _request_data(data)
+    request_id = data.get('request_id')
+    image_id = data.get('image_id')
+    image_bytes = data.get('image')
+    if image_id is None and image_bytes is None:
+        await sio.emit('error', {'data': '未提供 image_id 或图片内容'}, room=sid)
+        return
+    if image_bytes is not None and len(image_bytes) > search.MAX_UPLOAD_BYTES:
+        await sio.emit('error', {'data': f'上传的图片超过 {search.MAX_UPLOAD_BYTES // 1024 // 1024} MB'}, room=sid)
+        return
+    try:
+        if image_id is not None:
+            image_id = int(image_id)
+        options = _similar_options(data)
+        page_size = int(data.get('page_size', search.DEFAULT_PAGE_SIZE))
+    except (TypeError, ValueError) as e:
+        await _invalid_params(sid, e)
+        return
 
+    try:
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, _find_similar, image_id, image_bytes, options)
+        if results is None:
+            await sio.emit('error', {'data': '无法为该图片检索相似图片'}, room=sid)
+            return
+        pages = search.paginate(results, page_size)
+        for page_number, page in enumerate(pages):
+            await sio.emit('similar_results_page', {
+                'request_id': request_id,
+                'page': page_number,
+                'total_pages': len(pages),
+                'done': page_number == len(pages) - 1,
+                'results': page,
+            }, room=sid)
     except Exception as e:
-        logging.error(f"加载 {season} 图片时发生错误: {e}")
-        await sio.emit('error', {'data': f'加载 {season} 图片出错: {str(e)}'}, room=sid)
+        logging.error(f"以图搜图时发生错误: {e}")
+        await sio.emit('error', {'data': f'以图搜图出错: {str(e)}'}, room=sid)
+
+def _find_duplicates(threshold, on_progress=None):
+    db = database.SessionLocal()
+    try:
+        return dedup.find_duplicates(db, threshold, on_progress=on_progress)
     finally:
         db.close()
 
+@sio.on('find_duplicates')
+async def find_duplicates(sid, data):
+    """
+    查找重复图片: 内容完全相同的图片组与向量相似度不低于 threshold 的近似重复组。
+    计算在线程池中进行，期间发送 duplicates_progress，完成后发送 duplicates_found。
+    """
+    try:
+        threshold = float(_request_data(data).get('threshold', dedup.NEAR_DUPLICATE_THRESHOLD))
+    except (TypeError, ValueError) as e:
+        await _invalid_params(sid, e)
+        return
+    loop = asyncio.get_running_loop()
+
+    def on_progress(done, total):
+        asyncio.run_coroutine_threadsafe(
+            sio.emit('duplicates_progress', {'data': f'({done}/{total}) 正在比较图片向量...', 'done': done, 'total': total},
+                     room=sid), loop)
+
+    logging.info(f"收到来自 {sid} 的重复图片检测请求 (阈值: {threshold})")
+    try:
+        groups = await loop.run_in_executor(None, _find_duplicates, threshold, on_progress)
+        await sio.emit('duplicates_found', dict(groups, threshold=threshold), room=sid)
+    except Exception as e:
+        logging.error(f"查找重复图片时发生错误: {e}")
+        await sio.emit('error', {'data': f'查找重复图片出错: {str(e)}'}, room=sid)
+
+def _similar_page(results, page, page_size):
+    pages = search.paginate(results, page_size)
+    page = max(0, min(page, len(pages) - 1))
+    return {
+        'page': page,
+        'total_pages': len(pages),
+        'next_page': page + 1 if page + 1 < len(pages) else None,
+        'results': pages[page],
+    }
+
+@app.get("/api/images")
+def list_images(cursor: int = 0, limit: int = crud.IMAGE_PAGE_SIZE, season: str = None,
+                db: Session = Depends(database.get_db)):
+    """按游标分页列出已索引的图片"""
+    if season is not None and season not in crud.SEASONS:
+        raise HTTPException(status_code=400, detail=f"无效的季节: {season}")
+    rows, next_cursor = crud.list_images(db, after_id=cursor, limit=limit, season=season)
+    return {'images': [_image_data(row) for row in rows], 'next_cursor': next_cursor}
+
+@app.get("/api/labels/{label_type}/counts")
+def label_counts(label_type: str, db: Session = Depends(database.get_db)):
+    """各标签的图片数"""
+    return {'label_type': label_type, 'counts': crud.count_labels(db, label_type)}
+
+@app.get("/api/images/{image_id}/similar")
+def similar_images(image_id: int, top_k: int = search.DEFAULT_TOP_K, min_similarity: float = 0.0,
+                   season: list = Query(default=[]), date_from: str = None, date_to: str = None,
+                   min_size_mb: float = None, max_size_mb: float = None, directory: str = None,
+                   page: int = 0, page_size: int = search.DEFAULT_PAGE_SIZE,
+                   db: Session = Depends(database.get_db)):
+    """以图搜图的 HTTP 接口 (已索引的图片)"""
+    filters = _http_filters(season, date_from, date_to, min_size_mb, max_size_mb, directory)
+    results = search.find_similar(db, image_id, top_k=top_k, min_similarity=min_similarity, filters=filters)
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"图片 {image_id} 不存在或尚未生成向量")
+    return _similar_page(results, page, page_size)
+
+async def _read_upload(request: Request, limit: int):
+    """读取请求体，超过 limit 字节时返回 413 (按 Content-Length 提前拒绝，没有该头时边读边检查)"""
+    too_large = HTTPException(status_code=413, detail=f"上传的图片超过 {limit // 1024 // 1024} MB")
+    try:
+        if int(request.headers.get('content-length') or 0) > limit:
+            raise too_large
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的 Content-Length")
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > limit:
+            raise too_large
+    return bytes(body)
+
+@app.post("/api/similar")
+async def similar_to_upload(request: Request, top_k: int = search.DEFAULT_TOP_K, min_similarity: float = 0.0,
+                            season: list = Query(default=[]), date_from: str = None, date_to: str = None,
+                            min_size_mb: float = None, max_size_mb: float = None, directory: str = None,
+                            page: int = 0, page_size: int = search.DEFAULT_PAGE_SIZE):
+    """以图搜图的 HTTP 接口 (上传图片，请求体为图片的二进制内容，不超过 PHOTO_INSIGHT_MAX_UPLOAD_MB)"""
+    image_bytes = await _read_upload(request, search.MAX_UPLOAD_BYTES)
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="请求体中没有图片内容")
+    filters = _http_filters(season, date_from, date_to, min_size_mb, max_size_mb, directory)
+    options = {'top_k': top_k, 'min_similarity': min_similarity, 'filters': filters}
+    loop = asyncio.get_running_loop()
+    try:
+        results = await loop.run_in_executor(None, _find_similar, None, image_bytes, options)
+    except clip_model.ModelUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if results is None:
+        raise HTTPException(status_code=400, detail="无法解码上传的图片")
+    return _similar_page(results, page, page_size)
+
+@app.get("/api/embedding-cache")
+def embedding_cache_stats():
+    """向量缓存的条目数、大小与命中统计"""
+    cache = embedding_cache.get_cache()
+    if cache is None:
+        return {'enabled': False}
+    return dict(cache.stats(), enabled=True)
+
+@app.get("/api/watcher")
+def watcher_status():
+    """文件监视的状态: 事件来源、监视的目录、待处理的变化数与最近一批的处理结果"""
+    return watcher.status()
+
+@app.get("/api/classification")
+def classification_status():
+    """最近一个季节分类任务的状态与工作队列统计"""
+    return classify_seasons.classification_status() or {}
+
+@app.get("/api/duplicates")
+def list_duplicates(threshold: float = dedup.NEAR_DUPLICATE_THRESHOLD):
+    """重复图片检测的 HTTP 接口"""
+    try:
+        return dict(_find_duplicates(threshold), threshold=threshold)
+    except dedup.DedupMemoryError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/api/images/{image_id}/thumbnail")
+def image_thumbnail(image_id: int, request: Request, size: int = thumbnails.THUMBNAIL_SIZES[0], v: str = None,
+                    db: Session = Depends(database.get_db)):
+    """
+    图片缩略图。缓存中缺失时 (尚未生成或已被淘汰) 从原图重新生成。
+    请求带有内容版本号 v 时允许浏览器长期缓存，否则每次通过 ETag 校验。
+    """
+    if size not in thumbnails.THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"不支持的缩略图尺寸: {size}，可选: {list(thumbnails.THUMBNAIL_SIZES)}")
+    image = db.query(models.Image).filter(models.Image.id == image_id).first()
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"图片 {image_id} 不存在")
+
+    content_hash = image.content_hash
+    if content_hash is None:
+        # 旧版本索引的图片没有内容哈希，首次访问时补全
+        try:
+            content_hash = thumbnails.generate_from_file(image.path)
+        except Exception as e:
+            raise HTTPException(status_code=404, detail=f"无法为图片 {image_id} 生成缩略图: {e}")
+        image.content_hash = content_hash
+        db.commit()
+
+    etag = f'"{content_hash}-{size}"'
+    cache_control = "public, max-age=31536000, immutable" if v == content_hash[:16] else "public, max-age=0, must-revalidate"
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+
+    path = thumbnails.get_thumbnail(content_hash, size, image_path=image.path)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"无法为图片 {image_id} 生成缩略图")
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
@@ -0,0 +1,119 @@
+"""
+Socket.IO 的消息队列: 多个 Web 进程与工作进程共享客户端列表，任何进程都可以向任意客户端 (sid) 发送消息。
+
+PHOTO_INSIGHT_MESSAGE_QUEUE:
+- 空 (默认): 单进程部署，不使用消息队列。
+- redis://host:port/db: 使用 Redis 的发布/订阅 (需要 pip install redis)，可以跨机器。
+- local: 由存储服务进程 (store_service.py) 转发，不需要额外安装服务，适合单机上的多进程部署。
+
+Web 进程的 Socket.IO 服务使用 create_client_manager() 创建的管理器；
+工作进程使用 create_emitter() 创建的只写管理器发送进度消息，消息由持有该客户端连接的 Web 进程发出。
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+from . import ipc
+
+# 配置
+MESSAGE_QUEUE = os.environ.get("PHOTO_INSIGHT_MESSAGE_QUEUE", "")
+CHANNEL = "photo_insight"
+RECONNECT_SECONDS = 2.0  # 订阅连接断开后重连的间隔
+
+def _subscribe(channel: str, on_message):
+    """在后台线程中订阅存储服务转发的消息，连接断开 (例如服务重启) 后自动重连"""
+    def run():
+        while True:
+            try:
+                conn = ipc.connect()
+                conn.send(("subscribe", channel))
+                while True:
+                    on_message(conn.recv())
+            except (ipc.ServiceError, EOFError, OSError) as e:
+                logging.warning(f"消息订阅中断，{RECONNECT_SECONDS} 秒后重连: {e}")
+                time.sleep(RECONNECT_SECONDS)
+    threading.Thread(target=run, name="message-subscriber", daemon=True).start()
+
+class IpcManager(socketio.PubSubManager):
+    """经由存储服务转发消息的客户端管理器 (同步版本，工作进程以 write_only=True 使用)"""
+    name = "photo-insight-ipc"
+
+    def __init__(self, channel: str = CHANNEL, write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._client = ipc.RpcClient()
+
+    def _publish(self, data):
+        try:
+            self._client.request(("publish", self.channel, self.json.dumps(data)))
+        except ipc.ServiceError as e:
+            logging.error(f"发布消息失败: {e}")
+
+    def _listen(self):
+        messages = queue.Queue()
+        _subscribe(self.channel, messages.put)
+        while True:
+            yield messages.get()
+
+class AsyncIpcManager(AsyncPubSubManager):
+    """经由存储服务转发消息的客户端管理器 (asyncio 版本，Web 进程使用)"""
+    name = "photo-insight-ipc"
+
+    def __init__(self, channel: str = CHANNEL, write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._client = ipc.RpcClient()
+
+    async def _publish(self, data):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._client.request, ("publish", self.channel, self.json.dumps(data)))
+        except ipc.ServiceError as e:
+            # 本进程的客户端已经收到消息，只有其他进程的客户端会错过
+            logging.error(f"发布消息失败: {e}")
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        _subscribe(self.channel, lambda message: loop.call_soon_threadsafe(messages.put_nowait, message))
+        while True:
+            yield await messages.get()
+
+def _check_queue_url():
+    if MESSAGE_QUEUE != "local" and not MESSAGE_QUEUE.startswith(("redis://", "rediss://")):
+        raise ValueError(f"不支持的消息队列: {MESSAGE_QUEUE} (可选: redis://... 或 local)")
+
+def create_client_manager():
+    """Web 进程的 Socket.IO 客户端管理器；没有配置消息队列时返回 None (使用默认的进程内管理器)。"""
+    if not MESSAGE_QUEUE:
+        return None
+    _check_queue_url()
+    logging.info(f"Socket.IO 消息队列: {MESSAGE_QUEUE}")
+    if MESSAGE_QUEUE == "local":
+        return AsyncIpcManager()
+    return socketio.AsyncRedisManager(MESSAGE_QUEUE, channel=CHANNEL)
+
+def create_emitter():
+    """
+    工作进程的消息发送回调 emit(event, data, room)，room 为客户端的 sid，None 表示广播。
+    没有配置消息队列时消息只能丢弃 (进度仍会记录在日志与数据库中)。
+    """
+    if not MESSAGE_QUEUE:
+        logging.warning("未设置 PHOTO_INSIGHT_MESSAGE_QUEUE，工作进程的进度消息不会发送给客户端")
+        return lambda event, data, room=None: None
+    _check_queue_url()
+    if MESSAGE_QUEUE == "local":
+        manager = IpcManager(write_only=True)
+    else:
+        manager = socketio.RedisManager(MESSAGE_QUEUE, channel=CHANNEL, write_only=True)
+
+    def emit(event, data, room=None):
+        try:
+            manager.emit(event, data, room=room)
+        except Exception as e:
+            logging.error(f"发送消息 {event} 失败: {e}")
+    return emit
@@ -0,0 +1,294 @@
+"""
+运行指标与性能分析。
+
+- 计数器 (Counter)、仪表 (Gauge) 与直方图 (Histogram)，以 Prometheus 文本格式在 /metrics 导出。
+  实现只依赖标准库，记录一次指标只是一次加锁的字典更新，可以放在热路径上。
+- RateEstimator: 指数平滑的吞吐量与剩余时间 (ETA) 估计，用于进度消息。
+- profile(): 可按任务开启的性能分析 (cProfile，或安装了 pyinstrument 时使用 pyinstrument)。
+"""
+import contextlib
+import cProfile
+import logging
+import math
+import os
+import threading
+import time
+
+# 配置
+PROFILE_DIR = os.environ.get("PHOTO_INSIGHT_PROFILE_DIR", "./profiles")
+# 秒级直方图的默认桶边界: 1ms ~ 60s
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if not self.labelnames and self.type != "histogram":
+            self._values[()] = 0
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples())
+        return lines
+
+class Counter(_Metric):
+    """只增不减的计数"""
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """可增可减的当前值，例如队列深度"""
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """耗时等数值的分布 (累积桶 + 总和 + 次数)"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """记录 with 语句块的耗时 (秒)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get(self, **labels):
+        """:return: (count, sum)"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (state[2], state[1]) if state else (0, 0.0)
+
+    def quantile(self, q: float, **labels):
+        """
+        由桶计数估计分位数 (与 Prometheus 的 histogram_quantile 相同，在所在桶内线性插值)。
+        :return: 估计值；没有观测值时为 None，落在最后一个 (+Inf) 桶时返回最大的有限边界。
+        """
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            counts = list(state[0]) if state else None
+        if not counts or not sum(counts):
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets, counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound if bound != math.inf else lower
+        return lower
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                labels = _format_labels(self.labelnames, key)
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+def register_collector(collect):
+    """注册在每次导出前调用的回调 collect()，用于采样当前状态 (例如各状态的任务数)。"""
+    with _registry_lock:
+        _collectors.append(collect)
+
+def render():
+    """所有指标的 Prometheus 文本格式 (text/plain; version=0.0.4)"""
+    with _registry_lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+    for collect in collectors:
+        try:
+            collect()
+        except Exception as e:
+            logging.error(f"采集指标时出错: {e}")
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# 索引
+FILES_SCANNED = Counter("photo_insight_files_scanned_total", "增量扫描发现的文件数，按扫描结果分类", ["result"])
+STAGE_SECONDS = Histogram(
+    "photo_insight_stage_seconds",
+    "索引各阶段每次操作的耗时: scan 为一次目录扫描，decode 为一个解码任务，inference 为一个推理批次，"
+    "write 为一个批次的写入，db_write / vector_write 为其中 SQLite 与向量库的部分",
+    ["stage"])
+STAGE_ITEMS = Counter("photo_insight_stage_items_total", "索引各阶段处理的图片数", ["stage"])
+PIPELINE_FAILURES = Counter("photo_insight_pipeline_failures_total", "索引流水线中无法解码或推理的图片数")
+IMAGE_LATENCY_SECONDS = Histogram("photo_insight_image_latency_seconds",
+                                  "单张图片从提交解码到写入完成的延迟 (秒)")
+QUEUE_DEPTH = Gauge("photo_insight_queue_depth", "已解码、等待推理的图片数 (最近一次采样)")
+EMBEDDING_CACHE_LOOKUPS = Counter("photo_insight_embedding_cache_lookups_total", "向量缓存的查询次数", ["result"])
+INDEXING_JOBS = Gauge("photo_insight_indexing_jobs", "当前各状态的索引任务数", ["status"])
+
+# VLM
+VLM_REQUEST_SECONDS = Histogram("photo_insight_vlm_request_seconds", "单次 VLM 请求的耗时 (不含排队与重试等待)",
+                                ["outcome"])
+VLM_REQUESTS = Counter("photo_insight_vlm_requests_total",
+                       "VLM 请求数: success 成功，retryable 可重试的错误，error 不可重试的错误", ["outcome"])
+VLM_RETRIES = Counter("photo_insight_vlm_retries_total", "VLM 请求的重试次数")
+VLM_IN_FLIGHT = Gauge("photo_insight_vlm_in_flight", "正在进行中的 VLM 请求数")
+VLM_CIRCUIT_OPEN = Counter("photo_insight_vlm_circuit_open_total", "VLM 熔断器打开的次数")
+
+# 检索
+SEARCH_SECONDS = Histogram("photo_insight_search_seconds", "检索请求的耗时", ["kind"])
+SEARCH_PLANS = Counter("photo_insight_search_plans_total",
+                       "向量检索的执行计划: ann 无过滤条件，prefilter 预过滤，postfilter 后过滤", ["plan"])
+
+class RateEstimator:
+    """
+    吞吐量与剩余时间估计。吞吐量为指数平滑的瞬时速率，对批次大小不均匀的进度也比较平稳。
+    """
+
+    def __init__(self, total: int, done: int = 0, smoothing: float = 0.3):
+        """:param done: 开始计时时已完成的数量 (例如跳过的文件)，不计入吞吐量。"""
+        self.total = total
+        self.smoothing = smoothing
+        self.rate = None
+        self._last_done = done
+        self._last_time = time.perf_counter()
+
+    def update(self, done: int):
+        """:return: {'throughput': 每秒处理数, 'eta_seconds': 预计剩余秒数 (无法估计时为 None)}"""
+        now = time.perf_counter()
+        elapsed = now - self._last_time
+        if elapsed > 0 and done > self._last_done:
+            instant = (done - self._last_done) / elapsed
+            self.rate = instant if self.rate is None else self.smoothing * instant + (1 - self.smoothing) * self.rate
+            self._last_done = done
+            self._last_time = now
+        remaining = max(self.total - done, 0)
+        eta = remaining / self.rate if self.rate else None
+        return {
+            'throughput': round(self.rate, 2) if self.rate else 0.0,
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+        }
+
+def format_eta(seconds):
+    """将剩余秒数格式化为便于阅读的文字"""
+    if seconds is None:
+        return "估算中"
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} 秒"
+    if seconds < 3600:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds // 3600} 小时 {seconds % 3600 // 60} 分"
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+@contextlib.contextmanager
+def profile(name: str, profiler: str = "cprofile", directory: str = PROFILE_DIR):
+    """
+    在性能分析器下执行 with 语句块，结束后把结果写入 directory。
+    只分析当前线程 (索引任务即其推理与写入线程)，解码子进程不在其中。
+    :param profiler: "cprofile" 输出 {name}.prof (可用 snakeviz 等查看)；"pyinstrument" 输出 {name}.html。
+    产出 dict，结束后其中的 'path' 为结果文件路径。
+    """
+    os.makedirs(directory, exist_ok=True)
+    result = {'path': None}
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logging.warning("未安装 pyinstrument，改用 cProfile")
+            profiler = "cprofile"
+    if profiler == "pyinstrument":
+        instrument = Profiler()
+        instrument.start()
+        try:
+            yield result
+        finally:
+            instrument.stop()
+            result['path'] = os.path.join(directory, f"{name}.html")
+            with open(result['path'], "w", encoding="utf-8") as f:
+                f.write(instrument.output_html())
+    else:
+        tracer = cProfile.Profile()
+        tracer.enable()
+        try:
+            yield result
+        finally:
+            tracer.disable()
+            result['path'] = os.path.join(directory, f"{name}.prof")
+            tracer.dump_stats(result['path'])
+    logging.info(f"性能分析结果已保存: {result['path']}")
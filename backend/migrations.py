@@ -0,0 +1,105 @@
+"""
+轻量级的数据库结构升级。
+models.Base.metadata.create_all 只会创建缺失的表，不会为已有的表添加新列，
+这里为旧版本创建的数据库补齐新增的列与索引。
+向量库中旧向量的归一化在第一次打开向量库时进行 (见 vector_db.get_backend)，不会拖慢服务启动。
+"""
+import logging
+from sqlalchemy import inspect, text
+
+from . import database
+
+# 表名 -> [(列名, 列定义)]
+ADDED_COLUMNS = {
+    "images": [
+        ("mtime", "FLOAT"),
+        ("size_bytes", "INTEGER"),
+        ("inode", "INTEGER"),
+        ("content_hash", "VARCHAR"),
+    ],
+}
+
+# v0.2 的四个季节表与 season_scores 表，数据已迁移到 image_labels
+LEGACY_SEASON_TABLES = {
+    "spring_photos": "Spring",
+    "summer_photos": "Summer",
+    "autumn_photos": "Autumn",
+    "winter_photos": "Winter",
+}
+LEGACY_SCORE_TABLE = "season_scores"
+
+# (索引名, 表名, 列名)
+ADDED_INDEXES = [
+    ("ix_images_inode", "images", "inode"),
+    ("ix_images_content_hash", "images", "content_hash"),
+    # 检索的元数据过滤条件 (search.SearchFilters)
+    ("ix_images_created_at", "images", "created_at"),
+    ("ix_images_size_mb", "images", "size_mb"),
+]
+
+def run_migrations(engine=database.engine):
+    """为已有数据库添加缺失的列和索引。可以重复执行。"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            if not inspector.has_table(table):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table)}
+            for name, ddl in columns:
+                if name not in existing:
+                    logging.info(f"数据库升级: 为表 {table} 添加列 {name}")
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+        for index_name, table, column in ADDED_INDEXES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({column})"))
+
+    relax_vector_id_index(engine)
+    migrate_season_tables(engine)
+
+def relax_vector_id_index(engine=database.engine):
+    """旧版本的 images.vector_id 为唯一索引；重复图片需要共用同一个向量，改为普通索引。"""
+    inspector = inspect(engine)
+    if not inspector.has_table("images"):
+        return
+    for index in inspector.get_indexes("images"):
+        if index["name"] == "ix_images_vector_id" and index["unique"]:
+            logging.info("数据库升级: 将 ix_images_vector_id 改为非唯一索引")
+            with engine.begin() as conn:
+                conn.execute(text("DROP INDEX ix_images_vector_id"))
+                conn.execute(text("CREATE INDEX ix_images_vector_id ON images (vector_id)"))
+            return
+
+def migrate_season_tables(engine=database.engine):
+    """
+    将旧的季节表 (spring_photos 等) 与 season_scores 中的数据复制到 image_labels，然后删除旧表。
+    在一个事务中完成，失败时旧表保持不变。
+    """
+    inspector = inspect(engine)
+    legacy = [table for table in LEGACY_SEASON_TABLES if inspector.has_table(table)]
+    has_scores = inspector.has_table(LEGACY_SCORE_TABLE)
+    if not legacy and not has_scores:
+        return
+
+    logging.info(f"数据库升级: 将 {legacy + ([LEGACY_SCORE_TABLE] if has_scores else [])} 迁移到 image_labels")
+    with engine.begin() as conn:
+        for table in legacy:
+            season = LEGACY_SEASON_TABLES[table]
+            if has_scores:
+                select = (f"SELECT t.image_id, 'season', :season, s.confidence, COALESCE(s.source, 'vlm'), "
+                          f"COALESCE(s.updated_at, CURRENT_TIMESTAMP) "
+                          f"FROM {table} t LEFT JOIN {LEGACY_SCORE_TABLE} s ON s.image_id = t.image_id")
+            else:
+                # 旧版本只有 VLM 分类
+                select = f"SELECT t.image_id, 'season', :season, NULL, 'vlm', CURRENT_TIMESTAMP FROM {table} t"
+            # 旧表允许同一张图片出现在多个季节中，迁移后只保留第一个
+            conn.execute(text(
+                "INSERT OR IGNORE INTO image_labels (image_id, label_type, label, score, source, updated_at) "
+                + select + " WHERE t.image_id NOT IN "
+                "(SELECT image_id FROM image_labels WHERE label_type = 'season')"), {"season": season})
+        if has_scores:
+            for season in LEGACY_SEASON_TABLES.values():
+                conn.execute(text(
+                    "INSERT OR REPLACE INTO image_labels (image_id, label_type, label, score, source, updated_at) "
+                    f"SELECT image_id, 'season_prob', :season, {season.lower()}, 'clip', updated_at "
+                    f"FROM {LEGACY_SCORE_TABLE}"), {"season": season})
+        for table in legacy + ([LEGACY_SCORE_TABLE] if has_scores else []):
+            conn.execute(text(f"DROP TABLE {table}"))
@@ -0,0 +1,280 @@
+"""
+进程内的内存映射向量索引。
+
+向量归一化后存放在内存映射的 .npy 文件中 (可选 float16 或 int8 量化)，
+ID 存放在另一个 .npy 文件中，并在内存中维护 vector_id -> 行号 的映射。
+int8 量化按行缩放: 每行的缩放系数 (max|x| / 127) 以 float32 存放在 scales.npy 中。
+归一化的 512 维向量各分量约为 0.04，固定的缩放系数只能保留约 3 位精度，召回率明显下降。
+查询时对所有行做一次分块的 NumPy 矩阵乘法，再用 argpartition 取出精确的 top-k。
+删除的行会被标记为空并在之后的写入中复用。
+"""
+import json
+import logging
+import os
+import threading
+import numpy as np
+
+from .vector_db import VectorBackend, normalize, top_hits
+
+# 配置
+INDEX_PATH = os.environ.get("PHOTO_INSIGHT_MMAP_PATH", "./vector_index")
+INDEX_DTYPE = os.environ.get("PHOTO_INSIGHT_MMAP_DTYPE", "float32")  # float32 / float16 / int8，只在新建索引时生效
+EMBEDDING_DIM = 512
+ID_DTYPE = "S64"  # vector_id 以定长字节串存储
+INITIAL_CAPACITY = 1024
+QUERY_BLOCK_ROWS = 4096  # float16/int8 分块反量化后计算相似度，块足够小以留在 CPU 缓存中
+INT8_MAX = 127.0
+LEGACY_INT8_SCALE = 1 / INT8_MAX  # 没有 scales.npy 的旧索引使用固定的缩放系数
+
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "ids.npy"
+SCALES_FILE = "scales.npy"  # 仅 int8 索引
+META_FILE = "meta.json"
+
+class MmapVectorBackend(VectorBackend):
+    """基于内存映射 .npy 文件的精确向量检索。"""
+    name = "mmap"
+    exhaustive = True
+
+    def __init__(self, path: str = INDEX_PATH, dtype: str = INDEX_DTYPE, dim: int = EMBEDDING_DIM):
+        self.path = path
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        meta = self._load_meta()
+        if meta is None:
+            if dtype not in ("float32", "float16", "int8"):
+                raise ValueError(f"不支持的索引数据类型: {dtype}")
+            self._create_files(INITIAL_CAPACITY, dim, dtype)
+            self._meta = {'dim': dim, 'dtype': dtype, 'count': 0}
+            self._save_meta()
+        else:
+            self._meta = meta
+        self.dim = self._meta['dim']
+        self.dtype = self._meta['dtype']
+        self._open_files()
+        self._rebuild_mapping()
+        logging.info(f"内存映射向量索引已加载: {path} ({self.count()} 个向量, {self.dtype})")
+
+    # ---- 文件管理 ----
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load_meta(self):
+        try:
+            with open(self._file(META_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_meta(self):
+        tmp_path = self._file(META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._meta, f)
+        os.replace(tmp_path, self._file(META_FILE))
+
+    def load_info(self):
+        with self._lock:
+            return dict(self._meta.get('info', {}))
+
+    def save_info(self, info):
+        with self._lock:
+            self._meta['info'] = dict(info)
+            self._save_meta()
+
+    def _create_files(self, capacity, dim, dtype, suffix=""):
+        vectors = np.lib.format.open_memmap(self._file(VECTORS_FILE + suffix), mode="w+",
+                                            dtype=dtype, shape=(capacity, dim))
+        ids = np.lib.format.open_memmap(self._file(IDS_FILE + suffix), mode="w+",
+                                        dtype=ID_DTYPE, shape=(capacity,))
+        scales = None
+        if dtype == "int8":
+            scales = np.lib.format.open_memmap(self._file(SCALES_FILE + suffix), mode="w+",
+                                               dtype=np.float32, shape=(capacity,))
+        return vectors, ids, scales
+
+    def _open_files(self):
+        self._vectors = np.lib.format.open_memmap(self._file(VECTORS_FILE), mode="r+")
+        self._ids = np.lib.format.open_memmap(self._file(IDS_FILE), mode="r+")
+        self._scales = None
+        if self.dtype == "int8":
+            if not os.path.exists(self._file(SCALES_FILE)):
+                # 按行缩放之前创建的索引: 所有行使用原来的固定缩放系数
+                scales = np.lib.format.open_memmap(self._file(SCALES_FILE), mode="w+", dtype=np.float32,
+                                                   shape=(self._vectors.shape[0],))
+                scales[:] = LEGACY_INT8_SCALE
+                scales.flush()
+                del scales
+            self._scales = np.lib.format.open_memmap(self._file(SCALES_FILE), mode="r+")
+
+    def _rebuild_mapping(self):
+        """根据 ID 文件重建 vector_id <-> 行号 映射与空闲行列表"""
+        count = self._meta['count']
+        ids = self._ids[:count]
+        self._alive = ids != b""
+        self._row_of = {ids[row].decode(): int(row) for row in np.flatnonzero(self._alive)}
+        self._free_rows = [int(row) for row in np.flatnonzero(~self._alive)]
+
+    def _grow(self, needed):
+        """扩容: 按倍数创建更大的文件并复制已有数据"""
+        capacity = self._vectors.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(capacity * 2, needed)
+        count = self._meta['count']
+        vectors, ids, scales = self._create_files(new_capacity, self.dim, self.dtype, suffix=".tmp")
+        vectors[:count] = self._vectors[:count]
+        ids[:count] = self._ids[:count]
+        vectors.flush()
+        ids.flush()
+        if scales is not None:
+            scales[:count] = self._scales[:count]
+            scales.flush()
+        del vectors, ids, scales
+        self._vectors = self._ids = self._scales = None
+        os.replace(self._file(VECTORS_FILE + ".tmp"), self._file(VECTORS_FILE))
+        os.replace(self._file(IDS_FILE + ".tmp"), self._file(IDS_FILE))
+        if self.dtype == "int8":
+            os.replace(self._file(SCALES_FILE + ".tmp"), self._file(SCALES_FILE))
+        self._open_files()
+
+    def _flush(self):
+        self._vectors.flush()
+        self._ids.flush()
+        if self._scales is not None:
+            self._scales.flush()
+        self._save_meta()
+
+    # ---- 编码 ----
+
+    def _write_rows(self, rows, vectors):
+        """编码并写入若干行；int8 按行计算缩放系数，使每行绝对值最大的分量对应 ±127"""
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / INT8_MAX
+            scales[scales == 0] = 1.0
+            self._vectors[rows] = np.clip(np.rint(vectors / scales[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+            self._scales[rows] = scales
+        else:
+            self._vectors[rows] = vectors.astype(self.dtype, copy=False)
+
+    def _decode_rows(self, rows):
+        """读取若干行并反量化为 float32"""
+        stored = self._vectors[rows]
+        if self.dtype == "int8":
+            return stored.astype(np.float32) * self._scales[rows][:, None]
+        return stored.astype(np.float32, copy=False)
+
+    # ---- 接口实现 ----
+
+    def upsert(self, vectors, vector_ids):
+        vectors = normalize(vectors)
+        try:
+            with self._lock:
+                rows = []
+                appended = 0
+                for vector_id in vector_ids:
+                    row = self._row_of.get(vector_id)
+                    if row is None:
+                        if self._free_rows:
+                            row = self._free_rows.pop()
+                        else:
+                            row = self._meta['count'] + appended
+                            appended += 1
+                        self._row_of[vector_id] = row
+                    rows.append(row)
+
+                count = self._meta['count'] + appended
+                self._grow(count)
+                if appended:
+                    self._alive = np.concatenate([self._alive, np.zeros(appended, dtype=bool)])
+                rows = np.asarray(rows)
+                self._write_rows(rows, vectors)
+                self._ids[rows] = [vector_id.encode() for vector_id in vector_ids]
+                self._alive[rows] = True
+                self._meta['count'] = count
+                self._flush()
+            return True
+        except Exception as e:
+            logging.error(f"向内存映射索引写入 {len(vector_ids)} 个向量时出错: {e}")
+            with self._lock:
+                self._rebuild_mapping()
+            return False
+
+    def delete(self, vector_ids):
+        try:
+            with self._lock:
+                rows = [self._row_of.pop(vector_id) for vector_id in vector_ids if vector_id in self._row_of]
+                if rows:
+                    rows = np.asarray(rows)
+                    self._vectors[rows] = 0
+                    if self._scales is not None:
+                        self._scales[rows] = 0
+                    self._ids[rows] = b""
+                    self._alive[rows] = False
+                    self._free_rows.extend(int(row) for row in rows)
+                    self._flush()
+            return True
+        except Exception as e:
+            logging.error(f"从内存映射索引删除向量时出错: {e}")
+            return False
+
+    def query(self, vector, n_results: int):
+        query = normalize(vector)
+        with self._lock:
+            count = self._meta['count']
+            n_results = min(n_results, len(self._row_of))
+            if n_results <= 0:
+                return []
+            if self.dtype == "float32":
+                scores = self._vectors[:count] @ query
+            else:
+                scores = np.empty(count, dtype=np.float32)
+                for start in range(0, count, QUERY_BLOCK_ROWS):
+                    end = min(start + QUERY_BLOCK_ROWS, count)
+                    scores[start:end] = self._vectors[start:end].astype(np.float32) @ query
+                if self.dtype == "int8":
+                    scores *= self._scales[:count]
+            scores[~self._alive] = -np.inf
+            top = np.argpartition(-scores, n_results - 1)[:n_results]
+            top = top[np.argsort(-scores[top])]
+            # 量化误差可能使分数略大于 1
+            return [(self._ids[row].decode(), min(float(scores[row]), 1.0)) for row in top]
+
+    def query_subset(self, vector, vector_ids, n_results: int):
+        """只对候选向量所在的行计算相似度 (按行号排序后读取，对内存映射文件更友好)"""
+        query = normalize(vector)
+        with self._lock:
+            found = sorted((self._row_of[vector_id], vector_id) for vector_id in vector_ids if vector_id in self._row_of)
+            if not found:
+                return []
+            rows = np.fromiter((row for row, _ in found), dtype=np.int64, count=len(found))
+            scores = np.empty(len(rows), dtype=np.float32)
+            for start in range(0, len(rows), QUERY_BLOCK_ROWS):
+                block = rows[start:start + QUERY_BLOCK_ROWS]
+                scores[start:start + len(block)] = self._decode_rows(block) @ query
+        return top_hits([vector_id for _, vector_id in found], scores, n_results)
+
+    def get(self, vector_ids):
+        with self._lock:
+            found = [(vector_id, self._row_of[vector_id]) for vector_id in vector_ids if vector_id in self._row_of]
+            if not found:
+                return {}
+            vectors = self._decode_rows(np.asarray([row for _, row in found]))
+            return {vector_id: vectors[i] for i, (vector_id, _) in enumerate(found)}
+
+    def iter_batches(self, batch_size: int):
+        with self._lock:
+            count = self._meta['count']
+        for start in range(0, count, batch_size):
+            with self._lock:
+                end = min(start + batch_size, self._meta['count'])
+                rows = np.flatnonzero(self._alive[start:end]) + start
+                if len(rows) == 0:
+                    continue
+                ids = [vector_id.decode() for vector_id in self._ids[rows]]
+                vectors = self._decode_rows(rows)
+            yield ids, vectors
+
+    def count(self):
+        with self._lock:
+            return len(self._row_of)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 import datetime
@@ -9,31 +9,93 @@ class Image(Base):
     id = Column(Integer, primary_key=True, index=True)
     path = Column(String, unique=True, index=True, nullable=False)
     filename = Column(String, nullable=False)
-    size_mb = Column(Float, nullable=False)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    size_mb = Column(Float, nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True) # 文件的 st_ctime (本地时间)
     indexed_at = Column(DateTime, default=datetime.datetime.utcnow)
-    vector_id = Column(String, unique=True, index=True, nullable=True) # 存储在 ChromaDB 中的唯一 ID
+    vector_id = Column(String, index=True, nullable=True) # 存储在向量库中的 ID，内容完全相同的重复图片共用同一个
+    # 文件指纹，用于增量扫描时判断文件是否新增、修改或移动
+    mtime = Column(Float, nullable=True) # 文件修改时间 (st_mtime)
+    size_bytes = Column(Integer, nullable=True) # 文件大小 (字节)
+    inode = Column(Integer, nullable=True, index=True) # 文件的 inode 编号，移动/重命名后保持不变
+    content_hash = Column(String, nullable=True, index=True) # 文件内容哈希，缩略图缓存的键
 
-class SpringPhoto(Base):
-    __tablename__ = "spring_photos"
-    id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(Integer, ForeignKey("images.id"), unique=True)
+class ImageLabel(Base):
+    """
+    图片标签。一张图片可以有多种类型的标签，例如:
+    - season: 图片所属的季节 (每张图片最多一个)，score 为置信度
+    - season_prob: CLIP 零样本分类给出的各季节概率 (每个季节一行)
+    """
+    __tablename__ = "image_labels"
+    image_id = Column(Integer, ForeignKey("images.id"), primary_key=True)
+    label_type = Column(String, primary_key=True)
+    label = Column(String, primary_key=True)
+    score = Column(Float, nullable=True)
+    source = Column(String, nullable=True) # 标签来源，例如 clip / vlm
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     image = relationship("Image")
 
-class SummerPhoto(Base):
-    __tablename__ = "summer_photos"
-    id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(Integer, ForeignKey("images.id"), unique=True)
-    image = relationship("Image")
+    # 按标签查图片 (label_type, label -> image_id) 与分面计数都只需扫描这个索引
+    __table_args__ = (Index("ix_image_labels_type_label", "label_type", "label", "image_id"),)
 
-class AutumnPhoto(Base):
-    __tablename__ = "autumn_photos"
-    id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(Integer, ForeignKey("images.id"), unique=True)
-    image = relationship("Image")
+class IndexingJob(Base):
+    __tablename__ = "indexing_jobs"
+    id = Column(String, primary_key=True, index=True) # 任务 ID (UUID hex)
+    directory = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued", index=True) # queued/running/paused/completed/cancelled/failed
+    total = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0)
+    checkpoint = Column(String, nullable=True) # 按排序顺序最后一个已处理完成的文件路径
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
-class WinterPhoto(Base):
-    __tablename__ = "winter_photos"
-    id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(Integer, ForeignKey("images.id"), unique=True)
-    image = relationship("Image")
+class ClassificationJob(Base):
+    """
+    季节分类任务。待分类的图片保存在 classification_items 中 (持久化的工作队列)，
+    任务中断、取消或 VLM 不可用后，再次启动同类任务时从队列中未完成的图片继续。
+    """
+    __tablename__ = "classification_jobs"
+    id = Column(String, primary_key=True, index=True) # 任务 ID (UUID hex)
+    kind = Column(String, nullable=False) # vlm: VLM 分类尚未由 VLM 判定的图片; review: VLM 复核 CLIP 低置信度的图片
+    status = Column(String, nullable=False, default="running", index=True) # running/completed/cancelled/failed
+    force = Column(Integer, nullable=False, default=0) # 1 表示重新分类所有图片 (包括已由 VLM 判定的)
+    vlm_threshold = Column(Float, nullable=True) # review 任务的置信度阈值
+    total = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0) # 已完成 (成功或达到重试上限) 的图片数
+    failed = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class ClassificationItem(Base):
+    """分类任务的工作队列: 每张待分类的图片一行"""
+    __tablename__ = "classification_items"
+    job_id = Column(String, ForeignKey("classification_jobs.id"), primary_key=True)
+    image_id = Column(Integer, primary_key=True)
+    status = Column(String, nullable=False, default="pending") # pending/done/failed
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+
+    # 取下一批待处理的图片: WHERE job_id = ? AND status = 'pending' ORDER BY attempts, image_id
+    __table_args__ = (Index("ix_classification_items_queue", "job_id", "status", "attempts", "image_id"),)
+
+class WorkerTask(Base):
+    """
+    交给工作进程 (python -m backend.worker) 执行的任务队列，仅在 PHOTO_INSIGHT_JOB_QUEUE=sqlite 时使用。
+    工作进程领取任务后定期更新 heartbeat_at；心跳超时说明工作进程已退出，任务会被其他工作进程重新领取。
+    """
+    __tablename__ = "worker_tasks"
+    id = Column(String, primary_key=True, index=True) # 任务 ID (UUID hex)
+    kind = Column(String, nullable=False) # indexing / classification
+    job_id = Column(String, nullable=True, index=True) # indexing 任务对应的 indexing_jobs.id
+    params = Column(String, nullable=False, default="{}") # 任务参数 (JSON)
+    sid = Column(String, nullable=True) # 发起任务的客户端，进度消息发送给它；为空时广播
+    status = Column(String, nullable=False, default="queued") # queued/running/completed/cancelled/failed
+    worker_id = Column(String, nullable=True) # 领取任务的工作进程
+    heartbeat_at = Column(Float, nullable=True) # 最近一次心跳 (time.time())
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    # 领取任务: WHERE status = 'queued' ORDER BY created_at
+    __table_args__ = (Index("ix_worker_tasks_queue", "status", "kind", "created_at"),)
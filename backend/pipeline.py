@@ -0,0 +1,265 @@
+"""
+索引流水线: 解码进程池 -> 有界队列 -> 模型推理线程。
+
+解码与 CLIP 预处理在独立的进程中进行 (见 preprocess.decode_images)，
+模型线程从有界队列中取出已解码的图片，凑满一个批次后执行一次前向推理，
+再交给调用方的回调写入数据库。各阶段分别统计吞吐量，便于判断瓶颈所在，
+每次操作的耗时同时记录到 metrics 的直方图中 (/metrics)。
+内容相同的图片若已在向量缓存中 (见 embedding_cache.py)，解码进程跳过解码，模型线程跳过推理。
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from . import clip_model, embedding_cache, metrics, preprocess
+
+# 配置
+DECODE_WORKERS = int(os.environ.get("PHOTO_INSIGHT_DECODE_WORKERS", "0")) or preprocess.default_worker_count()
+QUEUE_SIZE = int(os.environ.get("PHOTO_INSIGHT_QUEUE_SIZE", "256"))  # 已解码、等待推理的图片上限
+DECODE_CHUNK_SIZE = 8  # 每个进程池任务解码的图片数量
+LATENCY_SAMPLES = 10000  # 保留最近多少张图片的处理延迟，用于计算分位数
+
+_DONE = object()
+
+class StageStats:
+    """单个流水线阶段的计数与耗时统计。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def add(self, items: int, seconds: float):
+        self.items += items
+        self.busy_seconds += seconds
+        metrics.STAGE_SECONDS.observe(seconds, stage=self.name)
+        metrics.STAGE_ITEMS.inc(items, stage=self.name)
+
+    def as_dict(self, elapsed: float):
+        return {
+            'items': self.items,
+            'busy_seconds': round(self.busy_seconds, 3),
+            # 按墙钟时间计算的实际吞吐量
+            'items_per_sec': round(self.items / elapsed, 2) if elapsed > 0 else 0.0,
+            # 该阶段满负荷时的理论吞吐量 (解码阶段为所有进程的合计耗时)
+            'busy_items_per_sec': round(self.items / self.busy_seconds, 2) if self.busy_seconds > 0 else 0.0,
+        }
+
+class IndexingPipeline:
+    """
+    生产者/消费者索引流水线。
+    run() 是阻塞调用，应在线程中执行 (不要直接在事件循环中调用)，调用它的线程即模型推理线程。
+    """
+
+    def __init__(self, decode_workers: int = DECODE_WORKERS, batch_size: int = clip_model.BATCH_SIZE,
+                 queue_size: int = QUEUE_SIZE, cache: embedding_cache.EmbeddingCache = None):
+        self.decode_workers = max(1, decode_workers)
+        self.cache = cache if cache is not None else embedding_cache.get_cache()
+        self.cache_key = embedding_cache.cache_key() if self.cache is not None else None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.batch_size = max(1, batch_size)
+        self.queue_size = max(self.batch_size, queue_size)
+        self.stages = {name: StageStats(name) for name in ('decode', 'inference', 'write')}
+        self.failed = 0
+        # 单张图片的延迟: 从提交解码到写入完成 (秒)
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._submitted_at = {}
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        self._started_at = None
+
+    def stats(self):
+        """返回各阶段的吞吐量统计与当前队列深度。"""
+        elapsed = time.perf_counter() - self._started_at if self._started_at else 0.0
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'failed': self.failed,
+            'queue_depth': self._queue.qsize(),
+            'decode_workers': self.decode_workers,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'latency_ms': self._latency_percentiles(),
+            'stages': {name: stage.as_dict(elapsed) for name, stage in self.stages.items()},
+        }
+
+    def _latency_percentiles(self):
+        if not self.latencies:
+            return None
+        p50, p95, p99 = np.percentile(np.fromiter(self.latencies, dtype=np.float64), [50, 95, 99]) * 1000
+        return {'p50': round(float(p50), 1), 'p95': round(float(p95), 1), 'p99': round(float(p99), 1)}
+
+    def _finish(self, paths):
+        """记录一组已写入图片的延迟"""
+        now = time.perf_counter()
+        for path in paths:
+            submitted_at = self._submitted_at.pop(path, None)
+            if submitted_at is not None:
+                self.latencies.append(now - submitted_at)
+                metrics.IMAGE_LATENCY_SECONDS.observe(now - submitted_at)
+
+    def _produce(self, image_paths):
+        """生产者线程: 向进程池提交解码任务，并按提交顺序将结果放入有界队列。"""
+        # spawn 方式启动子进程，避免 fork 已加载 torch 的父进程
+        context = multiprocessing.get_context("spawn")
+        chunks = [image_paths[i:i + DECODE_CHUNK_SIZE] for i in range(0, len(image_paths), DECODE_CHUNK_SIZE)]
+        # 在途任务数受限于队列容量，防止解码速度远超推理时占用过多内存
+        max_in_flight = max(self.decode_workers * 2, self.queue_size // DECODE_CHUNK_SIZE)
+        in_flight = deque()  # (chunk, future)
+        next_chunk = 0
+        try:
+            with ProcessPoolExecutor(max_workers=self.decode_workers, mp_context=context) as executor:
+                while (next_chunk < len(chunks) or in_flight) and not self._stop.is_set():
+                    while next_chunk < len(chunks) and len(in_flight) < max_in_flight:
+                        submitted_at = time.perf_counter()
+                        self._submitted_at.update((path, submitted_at) for path in chunks[next_chunk])
+                        in_flight.append((chunks[next_chunk], executor.submit(
+                            preprocess.decode_images, chunks[next_chunk], self.cache_key,
+                            self.cache.path if self.cache is not None else None)))
+                        next_chunk += 1
+                    results, seconds = in_flight[0][1].result()
+                    in_flight.popleft()
+                    self.stages['decode'].add(len(results), seconds)
+                    for item in results:
+                        if not self._put(item):
+                            break
+                for _, future in in_flight:
+                    future.cancel()
+        except Exception as e:
+            # 例如解码进程异常退出 (BrokenProcessPool): 尚未得到结果的图片逐个报告为失败，不能静默丢弃
+            logging.error(f"解码进程池发生错误: {e}")
+            remaining = [path for chunk, _ in in_flight for path in chunk]
+            remaining.extend(path for chunk in chunks[next_chunk:] for path in chunk)
+            error = f"解码进程池发生错误: {type(e).__name__}: {e}"
+            for path in remaining:
+                if not self._put((path, None, error, None, None)):
+                    break
+        finally:
+            self._put(_DONE, force=True)
+
+    def _put(self, item, force: bool = False):
+        """
+        向队列放入元素，队列满时阻塞等待模型线程取走数据 (推理较慢时不能丢弃已解码的图片)。
+        停止后放弃 (哨兵除外: 模型线程已不再取数据，腾出空间放入哨兵)。
+        """
+        while True:
+            if self._stop.is_set() and not force:
+                return False
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if force and self._stop.is_set():
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def run(self, image_paths, on_batch, on_failure=None, on_progress=None, should_stop=None):
+        """
+        运行流水线直到所有图片处理完毕或被要求停止。
+        :param image_paths: 待处理的图片路径列表。
+        :param on_batch: 回调 on_batch(paths, features, content_hashes)，features 为 (N, 512) float32 数组，
+                         content_hashes 为图片内容哈希 (缩略图的键)，在模型线程中调用。
+        :param on_failure: 回调 on_failure(path, error)，逐个报告无法解码或推理的文件。
+        :param on_progress: 回调 on_progress(stats)，每个批次完成后调用。
+        :param should_stop: 返回 True 时提前结束流水线。
+        :return: 最终的统计信息 (见 stats())。
+        """
+        image_paths = list(image_paths)
+        self._started_at = time.perf_counter()
+        producer = threading.Thread(target=self._produce, args=(image_paths,), name="decode-producer", daemon=True)
+        producer.start()
+
+        finished = False
+        try:
+            while not finished:
+                batch_paths = []
+                batch_pixels = []
+                batch_hashes = []
+                batch_cached = []
+                while len(batch_paths) < self.batch_size:
+                    item = self._queue.get()
+                    if item is _DONE:
+                        finished = True
+                        break
+                    path, pixels, error, content_hash, cached_vector = item
+                    if error is not None:
+                        self.failed += 1
+                        metrics.PIPELINE_FAILURES.inc()
+                        self._submitted_at.pop(path, None)
+                        if on_failure:
+                            on_failure(path, error)
+                        continue
+                    batch_paths.append(path)
+                    batch_pixels.append(pixels)
+                    batch_hashes.append(content_hash)
+                    batch_cached.append(cached_vector)
+
+                if batch_paths:
+                    self._process_batch(batch_paths, batch_pixels, batch_hashes, batch_cached, on_batch, on_failure)
+                    if on_progress:
+                        on_progress(self.stats())
+
+                if should_stop and should_stop():
+                    logging.info("索引流水线收到停止请求")
+                    break
+        finally:
+            self._stop.set()
+            producer.join()
+        return self.stats()
+
+    def _process_batch(self, batch_paths, batch_pixels, batch_hashes, batch_cached, on_batch, on_failure):
+        """模型线程: 对一个批次中未命中缓存的图片执行推理，与缓存的向量合并后交给回调写入。"""
+        metrics.QUEUE_DEPTH.set(self._queue.qsize())
+        misses = [i for i, vector in enumerate(batch_cached) if vector is None]
+        hits = len(batch_paths) - len(misses)
+        self.cache_hits += hits
+        self.cache_misses += len(misses)
+        metrics.EMBEDDING_CACHE_LOOKUPS.inc(hits, result="hit")
+        metrics.EMBEDDING_CACHE_LOOKUPS.inc(len(misses), result="miss")
+        if self.cache is not None:
+            self.cache.record(hits, len(misses))
+            if hits:
+                self.cache.touch(self.cache_key,
+                                 [content_hash for content_hash, vector in zip(batch_hashes, batch_cached) if vector is not None])
+
+        features = np.empty((len(batch_paths), clip_model.EMBEDDING_DIM), dtype=np.float32)
+        for i, vector in enumerate(batch_cached):
+            if vector is not None:
+                features[i] = vector
+        if misses:
+            start = time.perf_counter()
+            try:
+                computed = clip_model.encode_pixel_batch([batch_pixels[i] for i in misses])
+            except Exception as e:
+                logging.error(f"批量提取图片特征时发生错误 ({len(misses)} 张): {e}")
+                self.failed += len(misses)
+                metrics.PIPELINE_FAILURES.inc(len(misses))
+                for i in misses:
+                    self._submitted_at.pop(batch_paths[i], None)
+                    if on_failure:
+                        on_failure(batch_paths[i], str(e))
+                if not hits:
+                    return
+                # 命中缓存的图片仍然可以写入
+                keep = [i for i, vector in enumerate(batch_cached) if vector is not None]
+                batch_paths = [batch_paths[i] for i in keep]
+                batch_hashes = [batch_hashes[i] for i in keep]
+                features = features[keep]
+            else:
+                features[misses] = computed
+                self.stages['inference'].add(len(misses), time.perf_counter() - start)
+                if self.cache is not None:
+                    self.cache.put_many(self.cache_key, [batch_hashes[i] for i in misses], computed)
+
+        start = time.perf_counter()
+        on_batch(batch_paths, features, batch_hashes)
+        self.stages['write'].add(len(batch_paths), time.perf_counter() - start)
+        self._finish(batch_paths)
@@ -0,0 +1,124 @@
+"""
+图片解码与 CLIP 预处理。
+此模块不依赖 torch/transformers，以便在解码进程池的子进程中导入时不会重复加载模型。
+"""
+import io
+import logging
+import os
+import time
+import numpy as np
+from PIL import Image
+
+from . import embedding_cache, thumbnails
+
+# 配置 (与 openai/clip-vit-base-patch32 的预处理参数保持一致)
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+PREPROCESS_VERSION = 1  # 预处理结果变化时递增，使向量缓存中旧的条目失效
+
+def _center_crop(img, size: int):
+    """最短边缩放到 size，再居中裁剪为 size x size。"""
+    width, height = img.size
+    scale = size / min(width, height)
+    new_size = (max(size, round(width * scale)), max(size, round(height * scale)))
+    img = img.resize(new_size, Image.BICUBIC)
+    left = (new_size[0] - size) // 2
+    top = (new_size[1] - size) // 2
+    img = img.crop((left, top, left + size, top + size))
+    return np.asarray(img, dtype=np.uint8)
+
+def decode_image(image_path, size: int = CLIP_IMAGE_SIZE):
+    """
+    解码图片 (文件路径或类文件对象) 并缩放、居中裁剪为 size x size 的 RGB 图像。
+    对于 JPEG 使用 draft() 让解码器直接按 1/2、1/4、1/8 比例解码，避免解出全尺寸像素。
+    :return: 形状为 (size, size, 3) 的 uint8 numpy 数组。失败时抛出异常。
+    """
+    with Image.open(image_path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (size, size))
+        return _center_crop(img.convert("RGB"), size)
+
+def decode_image_with_thumbnails(image_path: str, size: int = CLIP_IMAGE_SIZE):
+    """
+    读取一次文件: 计算内容哈希，解码为 CLIP 输入，并在缩略图缺失时用同一次解码的结果生成缩略图。
+    :return: (pixels, content_hash)
+    """
+    with open(image_path, "rb") as f:
+        data = f.read()
+    content_hash = thumbnails.hash_bytes(data)
+    return _decode_bytes_with_thumbnails(image_path, data, content_hash, size), content_hash
+
+def _decode_bytes_with_thumbnails(image_path: str, data: bytes, content_hash: str, size: int = CLIP_IMAGE_SIZE):
+    need_thumbnails = not thumbnails.has_thumbnails(content_hash)
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format == "JPEG":
+            # 需要生成缩略图时按最大缩略图尺寸解码，否则只解码到 CLIP 所需的尺寸
+            draft_size = max(thumbnails.THUMBNAIL_SIZES) if need_thumbnails else size
+            img.draft("RGB", (draft_size, draft_size))
+        img = img.convert("RGB")
+        if need_thumbnails:
+            try:
+                thumbnails.save_thumbnails(img, content_hash)
+            except OSError as e:
+                # 缩略图只是缓存，写入失败不影响索引
+                logging.warning(f"保存缩略图失败: {image_path} ({e})")
+        return _center_crop(img, size)
+
+def _error_message(e):
+    return "文件未找到" if isinstance(e, FileNotFoundError) else f"{type(e).__name__}: {e}"
+
+def decode_images(image_paths, cache_key=None, cache_path: str = None):
+    """
+    进程池工作函数: 逐个解码一组图片，并顺带生成缩略图。
+    提供 cache_key 时先流式计算每个文件的内容哈希并批量查询向量缓存 (见 embedding_cache.py)，
+    命中且缩略图已存在的图片不再读取与解码，由模型线程直接使用缓存的向量；
+    其余图片逐个读取并立即解码，同一时间只有一个文件的完整内容在内存中。
+    :return: [(path, pixels 或 None, 错误信息 或 None, 内容哈希 或 None, 缓存的向量 或 None), ...]
+             以及本组解码耗时 (秒)。
+    """
+    start = time.perf_counter()
+    results = []
+    hashes = {}
+    cached = {}
+    if cache_key is not None:
+        for path in image_paths:
+            try:
+                hashes[path] = thumbnails.hash_file(path)
+            except Exception as e:
+                results.append((path, None, _error_message(e), None, None))
+        if hashes:
+            reader = embedding_cache.get_reader(cache_path or embedding_cache.EMBEDDING_CACHE_PATH)
+            cached = reader.get_many(cache_key, list(hashes.values()), touch=False)
+        pending = list(hashes)
+    else:
+        pending = image_paths
+
+    for path in pending:
+        expected_hash = hashes.get(path)
+        vector = cached.get(expected_hash) if expected_hash else None
+        if vector is not None and thumbnails.has_thumbnails(expected_hash):
+            results.append((path, None, None, expected_hash, vector))
+            continue
+        try:
+            pixels, content_hash = decode_image_with_thumbnails(path)
+            # 文件在计算哈希之后被修改时，缓存的向量不再对应其内容
+            results.append((path, pixels, None, content_hash, vector if content_hash == expected_hash else None))
+        except Exception as e:
+            results.append((path, None, _error_message(e), None, None))
+    # 与输入顺序保持一致，保证检查点按路径推进
+    order = {path: i for i, path in enumerate(image_paths)}
+    results.sort(key=lambda item: order[item[0]])
+    return results, time.perf_counter() - start
+
+def to_pixel_values(pixel_batch):
+    """
+    将 uint8 图像堆叠为 CLIP 所需的归一化 float32 张量数据 (N, 3, H, W)。
+    """
+    batch = np.stack(pixel_batch).astype(np.float32) / 255.0
+    batch = (batch - CLIP_MEAN) / CLIP_STD
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+def default_worker_count():
+    """默认的解码进程数: 为模型推理线程预留一个核心。"""
+    return max(1, (os.cpu_count() or 2) - 1)
@@ -0,0 +1,153 @@
+"""
+基于文件指纹的增量目录扫描。
+
+一次性查询数据库中该目录下所有图片的指纹 (mtime、大小、inode)，
+再用 os.scandir 遍历文件系统，计算出新增、修改、移动和删除的文件，
+只有新增和修改的文件需要重新经过 CLIP 模型。
+文件监视 (watcher.py) 收集到的零散变化用 diff_paths 以同样的规则只对比涉及的路径。
+"""
+import os
+import logging
+import stat
+
+from . import crud
+
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+class ScanResult:
+    """一次增量扫描的结果。"""
+
+    def __init__(self):
+        self.total = 0  # 文件系统中受支持的图片总数
+        self.new = []  # 新文件路径
+        self.modified = []  # 内容已修改 (或尚未生成向量) 的文件路径
+        self.moved = []  # [(image_id, 新路径), ...]
+        self.deleted = []  # 已删除文件的 image_id
+        self.backfill = []  # 旧记录缺失的指纹 [(image_id, mtime, size_bytes, inode), ...]
+        self.fingerprints = {}  # 新增与修改文件的指纹 {路径: (mtime, size, inode)}，用于重复检测
+        self.unchanged = 0
+
+    @property
+    def to_embed(self):
+        """需要送入 CLIP 模型的文件 (按路径排序)"""
+        return sorted(self.new + self.modified)
+
+    def summary(self):
+        return {
+            'total': self.total,
+            'new': len(self.new),
+            'modified': len(self.modified),
+            'moved': len(self.moved),
+            'deleted': len(self.deleted),
+            'unchanged': self.unchanged,
+        }
+
+def scan_files(directory: str):
+    """
+    使用 os.scandir 递归遍历目录。
+    :return: {路径: (mtime, size, inode)}
+    """
+    files = {}
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS) and entry.is_file():
+                            st = entry.stat()
+                            files[entry.path] = (st.st_mtime, st.st_size, st.st_ino or None)
+                    except OSError as e:
+                        logging.warning(f"无法读取文件信息: {entry.path} ({e})")
+        except OSError as e:
+            logging.warning(f"无法读取目录: {current} ({e})")
+    return files
+
+def stat_files(paths):
+    """
+    读取一组文件的指纹，已不存在或不受支持的文件会被忽略。
+    :return: {路径: (mtime, size, inode)}
+    """
+    files = {}
+    for path in paths:
+        if not path.lower().endswith(SUPPORTED_EXTENSIONS):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files[path] = (st.st_mtime, st.st_size, st.st_ino or None)
+    return files
+
+def diff_directory(db, directory: str):
+    """
+    对比文件系统与数据库中的指纹，计算目录的增量变化。
+    :return: ScanResult
+    """
+    return _diff(scan_files(directory), crud.get_fingerprints(db, directory))
+
+def diff_paths(db, paths):
+    """
+    只对比给定的一组路径 (例如文件监视收集到的变化)，计算它们的增量变化。
+    磁盘上已不存在的路径视为删除；同一组路径中删除与新增的文件 inode 相同时视为移动。
+    :return: ScanResult
+    """
+    paths = set(paths)
+    return _diff(stat_files(paths), crud.get_fingerprints_by_paths(db, paths))
+
+def _diff(on_disk, rows):
+    """
+    :param on_disk: {路径: (mtime, size, inode)}，磁盘上的文件 (会被修改)。
+    :param rows: 数据库中对应范围内的记录 [(id, path, mtime, size_bytes, inode, vector_id), ...]
+    """
+    result = ScanResult()
+    result.total = len(on_disk)
+
+    missing = {}  # 数据库中存在但磁盘上已不存在的记录: path -> row
+    for row in rows:
+        image_id, path, mtime, size_bytes, inode, vector_id = row
+        fingerprint = on_disk.pop(path, None)
+        if fingerprint is None:
+            missing[path] = row
+            continue
+        if not vector_id:
+            result.modified.append(path)
+            result.fingerprints[path] = fingerprint
+        elif mtime is None:
+            # 旧版本创建的记录没有指纹，补全后视为未修改
+            result.backfill.append((image_id, *fingerprint))
+            result.unchanged += 1
+        elif (mtime, size_bytes) != fingerprint[:2]:
+            result.modified.append(path)
+            result.fingerprints[path] = fingerprint
+        else:
+            result.unchanged += 1
+
+    # 剩余的磁盘文件是新文件；若与某条已删除记录的 inode、大小和 mtime 都相同，则视为移动
+    moved_from = {}
+    for path, row in missing.items():
+        image_id, _, mtime, size_bytes, inode, vector_id = row
+        if inode is not None and vector_id:
+            moved_from[(inode, size_bytes, mtime)] = image_id
+    for path, fingerprint in on_disk.items():
+        mtime, size, inode = fingerprint
+        image_id = moved_from.pop((inode, size, mtime), None) if inode is not None else None
+        if image_id is not None:
+            result.moved.append((image_id, path))
+        else:
+            result.new.append(path)
+            result.fingerprints[path] = fingerprint
+
+    moved_ids = {image_id for image_id, _ in result.moved}
+    result.deleted = [row[0] for row in missing.values() if row[0] not in moved_ids]
+    return result
+
+def apply_changes(db, result: ScanResult):
+    """在数据库中应用移动、删除与指纹补全 (不涉及模型推理)。"""
+    crud.update_image_paths(db, result.moved)
+    crud.update_fingerprints(db, result.backfill)
+    crud.delete_images(db, result.deleted)
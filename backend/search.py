@@ -0,0 +1,307 @@
+"""
+基于 CLIP 向量的语义搜索。
+
+带元数据过滤条件 (季节、创建时间、文件大小、目录，见 SearchFilters) 的检索由 filtered_query 选择执行计划:
+- 预过滤 (prefilter): 先用 SQL 条件查出候选向量，只在候选集中精确计算相似度。
+  代价与候选数 c 成正比 (每个候选读取一行 SQL 结果与一个向量)，适合选择性强的条件。
+- 后过滤 (postfilter): 向量检索超额取回 需要的条数 / 选择率 个结果，再用 SQL 条件筛选，不够时扩大范围重试。
+  代价为关联的结果行数，加上暴力检索的后端 (mmap) 扫描全部向量的代价，适合大部分图片都满足的条件。
+两者的代价相等时的候选数 (盈亏平衡点) 可以由向量总数与需要的条数直接算出，
+因此候选查询只取到该数量为止: 没有超出时预过滤一定更便宜；超出时放弃预过滤改用后过滤，
+已经花费的代价不超过后过滤本身，选择率的下界也随之确定，用于估计初始的超额倍数。
+"""
+import copy
+import datetime
+import io
+import logging
+import math
+import os
+from sqlalchemy import exists
+from sqlalchemy.orm import Session
+
+from . import clip_model, crud, metrics, models, preprocess, thumbnails, vector_db
+
+# 配置
+DEFAULT_TOP_K = 20
+MAX_TOP_K = 200
+MAX_OFFSET = 1000  # 翻页的最大偏移量: 每次翻页都要检索并关联前 offset + top_k 个结果
+DEFAULT_PAGE_SIZE = 50
+MAX_UPLOAD_BYTES = int(float(os.environ.get("PHOTO_INSIGHT_MAX_UPLOAD_MB", "20")) * 1024 * 1024)  # 以图搜图上传图片的大小上限
+PREFILTER_MAX_CANDIDATES = int(os.environ.get("PHOTO_INSIGHT_PREFILTER_MAX", "20000"))  # 预过滤候选数的上限
+POSTFILTER_MARGIN = 1.5  # 后过滤按估计的选择率超额检索时再乘的余量
+SCAN_ROW_COST = 0.05  # 暴力检索中一个向量的代价，以读取一行 SQL 结果为单位
+
+def parse_date(value, end: bool = False):
+    """
+    解析日期过滤条件: "2023"、"2023-06"、"2023-06-01" 或 ISO 格式的日期时间。
+    :param end: 作为范围的结束 (不含) 时，年份与日期表示该时间段的结束，例如 "2023" -> 2024-01-01。
+    :return: datetime (本地时间，与 Image.created_at 一致)；value 为空时返回 None。
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        start = datetime.datetime(value.year, value.month, value.day)
+        return start + datetime.timedelta(days=1) if end else start
+    text = str(value).strip()
+    parts = text.split("-")
+    try:
+        if len(parts) == 1:
+            year = int(parts[0])
+            return datetime.datetime(year + 1 if end else year, 1, 1)
+        if len(parts) == 2:
+            year, month = int(parts[0]), int(parts[1])
+            if end:
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            return datetime.datetime(year, month, 1)
+        if len(text) == 10:
+            return parse_date(datetime.date.fromisoformat(text), end)
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"无效的日期: {value}")
+
+class SearchFilters:
+    """
+    检索的元数据过滤条件，转换为 images 表上的 SQL 条件 (都可以使用索引):
+    - seasons: 季节列表，图片属于其中之一
+    - date_from / date_to: 创建时间范围，date_to 不含 (见 parse_date)
+    - min_size_mb / max_size_mb: 文件大小范围 (MB，含边界)
+    - directory: 只检索该目录 (含子目录) 下的图片
+    """
+
+    def __init__(self, seasons=None, date_from=None, date_to=None, min_size_mb=None, max_size_mb=None,
+                 directory=None):
+        if isinstance(seasons, str):
+            seasons = [seasons]
+        self.seasons = [season for season in (seasons or []) if season in crud.SEASONS]
+        self.date_from = parse_date(date_from)
+        self.date_to = parse_date(date_to, end=True)
+        self.min_size_mb = float(min_size_mb) if min_size_mb not in (None, "") else None
+        self.max_size_mb = float(max_size_mb) if max_size_mb not in (None, "") else None
+        self.directory = os.path.abspath(directory) if directory else None
+
+    @classmethod
+    def from_params(cls, params):
+        """从请求参数 (dict) 中提取过滤条件"""
+        return cls(seasons=params.get('seasons'), date_from=params.get('date_from'), date_to=params.get('date_to'),
+                   min_size_mb=params.get('min_size_mb'), max_size_mb=params.get('max_size_mb'),
+                   directory=params.get('directory'))
+
+    def __bool__(self):
+        return bool(self.seasons) or any(value is not None for value in (
+            self.date_from, self.date_to, self.min_size_mb, self.max_size_mb, self.directory))
+
+    def __repr__(self):
+        fields = ("seasons", "date_from", "date_to", "min_size_mb", "max_size_mb", "directory")
+        return "SearchFilters(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in fields
+                                            if getattr(self, name) not in (None, [])) + ")"
+
+    def apply(self, query):
+        """为包含 models.Image 的查询加上过滤条件"""
+        if self.seasons:
+            # 关联的行数很少时，逐行检查标签比展开该季节的全部图片更快
+            query = query.filter(exists().where(models.ImageLabel.image_id == models.Image.id,
+                                                models.ImageLabel.label_type == crud.LABEL_SEASON,
+                                                models.ImageLabel.label.in_(self.seasons)))
+        if self.date_from is not None:
+            query = query.filter(models.Image.created_at >= self.date_from)
+        if self.date_to is not None:
+            query = query.filter(models.Image.created_at < self.date_to)
+        if self.min_size_mb is not None:
+            query = query.filter(models.Image.size_mb >= self.min_size_mb)
+        if self.max_size_mb is not None:
+            query = query.filter(models.Image.size_mb <= self.max_size_mb)
+        if self.directory is not None:
+            # 与 crud.get_fingerprints 相同，用路径范围代替 LIKE 以命中 path 索引
+            prefix = os.path.join(self.directory, "")
+            query = query.filter(models.Image.path >= prefix,
+                                 models.Image.path < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return query
+
+def join_images(db: Session, hits, filters: SearchFilters = None):
+    """
+    将向量检索结果与图片记录关联，并保持相似度排序。
+    :param hits: [(vector_id, similarity), ...]
+    :param filters: 可选的过滤条件，只保留满足条件的图片 (没有图片满足条件的向量会被丢弃)。
+    :return: [{'id', 'path', 'filename', 'thumbnail_url', 'similarity'}, ...]
+    """
+    if not hits:
+        return []
+    vector_ids = [vector_id for vector_id, _ in hits]
+    rows = []
+    for start in range(0, len(vector_ids), crud.SQL_CHUNK_SIZE):
+        query = (db.query(models.Image.id, models.Image.path, models.Image.filename, models.Image.vector_id,
+                          models.Image.content_hash)
+                 .filter(models.Image.vector_id.in_(vector_ids[start:start + crud.SQL_CHUNK_SIZE])))
+        if filters:
+            query = filters.apply(query)
+        rows.extend(query)
+    rows.sort(key=lambda row: row.id)
+    # 内容完全相同的重复图片共用一个向量，结果中只保留最早索引 (且满足过滤条件) 的一张
+    by_vector_id = {}
+    for row in rows:
+        by_vector_id.setdefault(row.vector_id, row)
+    results = []
+    for vector_id, similarity in hits:
+        row = by_vector_id.get(vector_id)
+        if row is None:
+            continue
+        results.append({
+            'id': row.id,
+            'path': row.path,
+            'filename': row.filename,
+            'thumbnail_url': thumbnails.thumbnail_url(row.id, row.content_hash),
+            'similarity': round(float(similarity), 4),
+        })
+    return results
+
+def _candidate_rows(db: Session, filters: SearchFilters, limit: int):
+    """满足过滤条件的图片的 vector_id (最多 limit 行，重复图片各占一行)"""
+    query = db.query(models.Image.vector_id).filter(models.Image.vector_id.isnot(None))
+    if filters.seasons:
+        # 从季节标签的索引出发，而不是逐行检查 images (每张图片最多一个季节标签，不会产生重复行)
+        query = query.join(models.ImageLabel, models.ImageLabel.image_id == models.Image.id).filter(
+            models.ImageLabel.label_type == crud.LABEL_SEASON, models.ImageLabel.label.in_(filters.seasons))
+        filters = copy.copy(filters)
+        filters.seasons = []
+    return [vector_id for (vector_id,) in filters.apply(query).limit(limit)]
+
+def prefilter_break_even(total: int, needed: int, exhaustive: bool):
+    """
+    预过滤与后过滤代价相等时的候选数 c*。
+    后过滤的代价为 needed * POSTFILTER_MARGIN * total / c (+ 暴力检索时的 total * SCAN_ROW_COST)，
+    令其等于预过滤的代价 c，解二次方程得到 c*；候选数不超过 c* 时预过滤更便宜。
+    """
+    scan = total * SCAN_ROW_COST if exhaustive else 0.0
+    return int((scan + math.sqrt(scan * scan + 4 * needed * POSTFILTER_MARGIN * total)) / 2)
+
+def filtered_query(db: Session, vector, n_results: int, filters: SearchFilters = None, min_similarity: float = None,
+                   exclude_vector_id: str = None):
+    """
+    带元数据过滤条件的向量检索，按估计的代价选择预过滤或后过滤 (见模块说明)。
+    :param n_results: 需要的结果条数。
+    :param min_similarity: 可选的最低余弦相似度。
+    :param exclude_vector_id: 需要排除的向量 (通常是查询图片自身)。
+    :return: (结果列表 (见 join_images，最多 n_results 条)，执行计划 "ann" / "prefilter" / "postfilter")
+    """
+    def accept(hits):
+        return [(vector_id, similarity) for vector_id, similarity in hits
+                if vector_id != exclude_vector_id and (min_similarity is None or similarity >= min_similarity)]
+
+    needed = n_results + (1 if exclude_vector_id else 0)
+    if not filters:
+        plan = "ann"
+        results = join_images(db, accept(vector_db.query_vectors(vector, needed)))
+    else:
+        total = vector_db.get_vector_count()
+        limit = min(PREFILTER_MAX_CANDIDATES, prefilter_break_even(total, needed, vector_db.get_backend().exhaustive))
+        rows = _candidate_rows(db, filters, limit + 1)
+        if len(rows) <= limit:
+            plan = "prefilter"
+            candidates = [vector_id for vector_id in dict.fromkeys(rows) if vector_id != exclude_vector_id]
+            hits = accept(vector_db.query_vector_subset(vector, candidates, n_results))
+            results = join_images(db, hits, filters)
+        else:
+            plan = "postfilter"
+            results = _postfilter(db, vector, n_results, filters, accept, min(1.0, len(rows) / max(total, 1)), total,
+                                  min_similarity)
+    metrics.SEARCH_PLANS.inc(plan=plan)
+    return results[:n_results], plan
+
+def _postfilter(db: Session, vector, needed: int, filters: SearchFilters, accept, selectivity: float, total: int,
+                min_similarity):
+    """
+    后过滤: 按选择率的下界超额检索后筛选，结果不够时按实际观察到的选择率扩大检索范围。
+    :param selectivity: 满足过滤条件的向量比例的下界。
+    """
+    n = min(total, math.ceil(needed / selectivity * POSTFILTER_MARGIN))
+    while True:
+        hits = vector_db.query_vectors(vector, n)
+        results = join_images(db, accept(hits), filters)
+        # 已检索全部向量，或最后一条已低于最低相似度 (继续扩大范围也不会有更多结果)
+        exhausted = n >= total or len(hits) < n or (
+            min_similarity is not None and hits and hits[-1][1] < min_similarity)
+        if len(results) >= needed or exhausted:
+            return results
+        observed = max(len(results), 1) / n
+        n = min(total, max(n * 2, math.ceil(needed / observed * POSTFILTER_MARGIN)))
+        logging.debug(f"后过滤结果不足 ({len(results)}/{needed})，扩大检索范围到 {n}")
+
+@metrics.SEARCH_SECONDS.time(kind="text")
+def search_text(db: Session, query: str, top_k: int = DEFAULT_TOP_K, offset: int = 0, seasons=None,
+                filters: SearchFilters = None):
+    """
+    文本搜图: 用 CLIP 文本编码器编码查询，在向量库中检索最相似的图片。
+    查询向量有 LRU 缓存，翻页 (offset) 时不会再次运行模型。
+    :param seasons: 可选的季节列表，只返回属于这些季节的图片 (等同于 filters.seasons)。
+    :param filters: 可选的元数据过滤条件 (SearchFilters)。
+    :return: 结果列表 (见 join_images)；查询无法编码时返回 None。
+    """
+    top_k = max(1, min(top_k, MAX_TOP_K))
+    offset = max(0, min(offset, MAX_OFFSET))
+    filters = _with_seasons(filters, seasons)
+    vector = clip_model.get_text_features(query)
+    if vector is None:
+        return None
+    results, plan = filtered_query(db, vector, offset + top_k, filters)
+    results = results[offset:offset + top_k]
+    logging.info(f"文本搜索 '{query}' 返回 {len(results)} 条结果 (offset={offset}, 执行计划: {plan})")
+    return results
+
+def _with_seasons(filters, seasons):
+    """合并单独传入的季节列表与过滤条件"""
+    if not seasons:
+        return filters
+    merged = copy.copy(filters) if filters else SearchFilters()
+    merged.seasons = list(dict.fromkeys(merged.seasons + SearchFilters(seasons=seasons).seasons))
+    return merged
+
+def find_similar_to_vector(db: Session, vector, top_k: int = DEFAULT_TOP_K, min_similarity: float = 0.0,
+                           seasons=None, exclude_vector_id: str = None, filters: SearchFilters = None):
+    """
+    以向量为查询检索相似图片。
+    :param min_similarity: 最低余弦相似度，低于该值的结果会被丢弃。
+    :param seasons: 可选的季节列表 (例如 ["Spring", "Winter"])，只返回属于这些季节的图片。
+    :param exclude_vector_id: 需要排除的向量 (通常是查询图片自身)。
+    :param filters: 可选的元数据过滤条件 (SearchFilters)。
+    """
+    top_k = max(1, min(top_k, MAX_TOP_K))
+    results, _ = filtered_query(db, vector, top_k, _with_seasons(filters, seasons), min_similarity=min_similarity,
+                                exclude_vector_id=exclude_vector_id)
+    return results
+
+@metrics.SEARCH_SECONDS.time(kind="similar")
+def find_similar(db: Session, image_id: int, **kwargs):
+    """
+    以图搜图: 直接使用已存储的向量作为查询，不会再次运行 CLIP 模型。
+    :return: 结果列表；图片不存在或尚未生成向量时返回 None。
+    """
+    db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
+    if db_image is None or not db_image.vector_id:
+        return None
+    vector = vector_db.get_vectors([db_image.vector_id]).get(db_image.vector_id)
+    if vector is None:
+        logging.error(f"向量库中找不到图片 {image_id} 的向量 ({db_image.vector_id})")
+        return None
+    return find_similar_to_vector(db, vector, exclude_vector_id=db_image.vector_id, **kwargs)
+
+@metrics.SEARCH_SECONDS.time(kind="upload")
+def find_similar_to_upload(db: Session, data: bytes, **kwargs):
+    """
+    为临时上传的图片检索相似图片。图片经过与索引相同的解码与批量推理路径。
+    :return: 结果列表；图片无法解码时返回 None。
+    :raises clip_model.ModelUnavailableError: 模型无法加载时。
+    """
+    try:
+        pixels = preprocess.decode_image(io.BytesIO(data))
+    except Exception as e:
+        logging.error(f"无法解码上传的图片: {e}")
+        return None
+    vector = clip_model.encode_pixel_batch([pixels])[0]
+    return find_similar_to_vector(db, vector, **kwargs)
+
+def paginate(results, page_size: int = DEFAULT_PAGE_SIZE):
+    """将结果切分为固定大小的页"""
+    page_size = max(1, page_size)
+    return [results[start:start + page_size] for start in range(0, len(results), page_size)] or [[]]
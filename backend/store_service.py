@@ -0,0 +1,228 @@
+"""
+存储服务: 多进程部署时唯一持有向量库的进程 (单一写入者)，同时作为 Socket.IO 消息的本地中转。
+
+嵌入式的 ChromaDB 客户端与内存映射索引 (mmap) 都只能由一个进程打开，
+多个 Web 进程与工作进程通过 IPC (ipc.py) 访问这里的向量库:
+设置 PHOTO_INSIGHT_VECTOR_BACKEND=remote 后，vector_db 使用 RemoteVectorBackend，
+接口与本地后端相同，所有写入在本进程中串行执行。
+本进程自身使用 PHOTO_INSIGHT_SERVICE_BACKEND 指定的本地后端 (chroma / mmap)。
+
+没有 Redis 时，本进程还提供简单的发布/订阅 (见 messaging.py)，把工作进程的进度消息转发给所有 Web 进程，
+再由持有对应客户端 (sid) 的 Web 进程发送出去。
+
+SQLite 不经过本进程: WAL 模式下多个进程可以同时读，写入由 SQLite 的文件锁串行化 (busy_timeout)。
+
+用法:
+    python -m backend.store_service
+"""
+import logging
+import os
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+from . import ipc, vector_db
+from .vector_db import VectorBackend
+
+# 配置
+SERVICE_BACKEND = os.environ.get("PHOTO_INSIGHT_SERVICE_BACKEND", "chroma")  # 存储服务进程实际使用的向量库
+# 允许远程调用的向量库方法
+VECTOR_METHODS = ("upsert", "delete", "query", "query_subset", "get", "count", "is_ready", "normalize_existing",
+                  "load_info", "save_info")
+
+class StoreService:
+    """IPC 服务端: 每个连接一个线程。"""
+
+    def __init__(self, backend: VectorBackend, address: str = ipc.SERVICE_ADDRESS, authkey: bytes = None):
+        """:param authkey: 为 None 时使用 ipc.service_authkey(create=True)，见 ipc.py 中的说明。"""
+        self.backend = backend
+        self.address = address
+        self.authkey = authkey
+        self._subscribers = {}  # 频道 -> {连接: 发送锁}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def serve_forever(self):
+        if self.authkey is None:
+            # 没有密钥时拒绝启动 (或生成只有所有者可读的密钥文件)，不使用公开的默认密钥
+            self.authkey = ipc.service_authkey(create=True)
+        self._listener = Listener(ipc.parse_address(self.address), authkey=self.authkey)
+        logging.info(f"存储服务已启动: {self.address} (向量库: {self.backend.name}，{self.backend.count()} 个向量)")
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                if self._listener is None:
+                    return
+                # 认证失败等错误只影响这一个连接
+                logging.warning(f"拒绝连接: {e}")
+                continue
+            threading.Thread(target=self._handle, args=(conn,), name="store-service-conn", daemon=True).start()
+
+    def close(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == "subscribe":
+                    # 订阅连接之后只用于接收消息，收到 EOF 表示订阅者已退出
+                    self._subscribe(message[1], conn)
+                    conn.recv()
+                elif kind == "iterate":
+                    self._iterate(conn, message[1])
+                else:
+                    conn.send(self._dispatch(message))
+        except (EOFError, OSError):
+            pass
+        finally:
+            self._unsubscribe(conn)
+            conn.close()
+
+    def _dispatch(self, message):
+        kind = message[0]
+        try:
+            if kind == "call":
+                _, method, args, kwargs = message
+                if method not in VECTOR_METHODS:
+                    return "error", f"不支持的方法: {method}"
+                return "ok", getattr(self.backend, method)(*args, **kwargs)
+            if kind == "describe":
+                return "ok", {'name': self.backend.name, 'exhaustive': self.backend.exhaustive}
+            if kind == "publish":
+                return "ok", self._publish(message[1], message[2])
+            return "error", f"未知的请求: {kind}"
+        except Exception as e:
+            logging.error(f"处理请求 {kind} 时出错: {e}")
+            return "error", str(e)
+
+    def _iterate(self, conn, batch_size: int):
+        """按批发送所有向量: ("batch", ids, vectors) ...，最后发送 ("end", None)"""
+        try:
+            for ids, vectors in self.backend.iter_batches(batch_size):
+                conn.send(("batch", ids, vectors))
+            conn.send(("end", None))
+        except (EOFError, OSError):
+            raise
+        except Exception as e:
+            logging.error(f"遍历向量时出错: {e}")
+            conn.send(("error", str(e)))
+
+    # ---- 发布/订阅 ----
+
+    def _subscribe(self, channel: str, conn):
+        with self._lock:
+            self._subscribers.setdefault(channel, {})[conn] = threading.Lock()
+
+    def _unsubscribe(self, conn):
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                subscribers.pop(conn, None)
+
+    def _publish(self, channel: str, payload):
+        """转发给频道的所有订阅者，返回送达的订阅者数"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, {}).items())
+        delivered = 0
+        for conn, send_lock in subscribers:
+            try:
+                with send_lock:
+                    conn.send(payload)
+                delivered += 1
+            except (EOFError, OSError):
+                self._unsubscribe(conn)
+        return delivered
+
+class RemoteVectorBackend(VectorBackend):
+    """通过 IPC 使用存储服务进程中的向量库 (PHOTO_INSIGHT_VECTOR_BACKEND=remote)。"""
+    name = "remote"
+
+    def __init__(self, address: str = ipc.SERVICE_ADDRESS, authkey: bytes = None):
+        self._client = ipc.RpcClient(address, authkey)
+        info = self._client.request(("describe",))
+        self.exhaustive = info['exhaustive']
+        logging.info(f"已连接存储服务 {address} (向量库: {info['name']})")
+
+    def _call(self, method, *args):
+        try:
+            return self._client.call(method, *args)
+        except ipc.ServiceError as e:
+            logging.error(f"调用存储服务 {method} 时出错: {e}")
+            raise
+
+    def upsert(self, vectors, vector_ids):
+        try:
+            return self._call("upsert", vectors, list(vector_ids))
+        except ipc.ServiceError:
+            return False
+
+    def delete(self, vector_ids):
+        try:
+            return self._call("delete", list(vector_ids))
+        except ipc.ServiceError:
+            return False
+
+    def query(self, vector, n_results: int):
+        return self._call("query", vector, n_results)
+
+    def query_subset(self, vector, vector_ids, n_results: int):
+        return self._call("query_subset", vector, list(vector_ids), n_results)
+
+    def get(self, vector_ids):
+        return self._call("get", list(vector_ids))
+
+    def iter_batches(self, batch_size: int):
+        # 遍历期间调用方可能还会发出其他请求，因此使用单独的连接
+        conn = ipc.connect(self._client.address, self._client.authkey)
+        try:
+            conn.send(("iterate", batch_size))
+            while True:
+                message = conn.recv()
+                if message[0] == "end":
+                    return
+                if message[0] == "error":
+                    raise ipc.ServiceError(message[1])
+                yield message[1], message[2]
+        finally:
+            conn.close()
+
+    def count(self):
+        return self._call("count")
+
+    def is_ready(self):
+        return self._call("is_ready")
+
+    def normalize_existing(self):
+        # 存储服务启动时已经执行过
+        pass
+
+    def load_info(self):
+        return self._call("load_info")
+
+    def save_info(self, info):
+        return self._call("save_info", info)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if SERVICE_BACKEND == "remote":
+        raise SystemExit("PHOTO_INSIGHT_SERVICE_BACKEND 必须是本地后端 (chroma 或 mmap)")
+    try:
+        authkey = ipc.service_authkey(create=True)
+    except ipc.ServiceError as e:
+        raise SystemExit(str(e))
+    backend = vector_db.create_backend(SERVICE_BACKEND)
+    backend.normalize_existing()
+    service = StoreService(backend, authkey=authkey)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("存储服务已停止")
+    finally:
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+测试在临时目录中运行: 在导入 backend 模块之前把数据库、向量库、缓存等路径指向临时目录，不会影响已有数据。
+
+运行: python -m pytest backend/tests
+"""
+import os
+import tempfile
+
+import pytest
+
+_WORKDIR = tempfile.mkdtemp(prefix="photo-insight-test-")
+os.environ["PHOTO_INSIGHT_DATABASE_URL"] = f"sqlite:///{os.path.join(_WORKDIR, 'photo_insight.db')}"
+os.environ["PHOTO_INSIGHT_CHROMA_PATH"] = os.path.join(_WORKDIR, "chroma_db")
+os.environ["PHOTO_INSIGHT_MMAP_PATH"] = os.path.join(_WORKDIR, "vector_index")
+os.environ["PHOTO_INSIGHT_THUMBNAIL_DIR"] = os.path.join(_WORKDIR, "thumbnails")
+os.environ["PHOTO_INSIGHT_EMBEDDING_CACHE"] = os.path.join(_WORKDIR, "embedding_cache.db")
+os.environ["PHOTO_INSIGHT_PROFILE_DIR"] = os.path.join(_WORKDIR, "profiles")
+os.environ["PHOTO_INSIGHT_ONNX_DIR"] = os.path.join(_WORKDIR, "onnx_models")
+os.environ["PHOTO_INSIGHT_VECTOR_BACKEND"] = "mmap"
+os.environ["PHOTO_INSIGHT_JOB_QUEUE"] = "local"
+
+from backend import database, migrations, models, vector_db  # noqa: E402
+
+models.Base.metadata.create_all(bind=database.engine)
+migrations.run_migrations()
+
+@pytest.fixture
+def db():
+    """数据库会话，测试结束后清空所有表"""
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        for table in reversed(models.Base.metadata.sorted_tables):
+            session.execute(table.delete())
+        session.commit()
+        session.close()
+
+@pytest.fixture
+def use_backend(monkeypatch):
+    """把 vector_db 当前使用的向量库替换为给定的后端: use_backend(backend)"""
+    def use(backend):
+        monkeypatch.setattr(vector_db, "backend", backend)
+        return backend
+    return use
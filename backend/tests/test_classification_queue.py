@@ -0,0 +1,79 @@
+import asyncio
+
+from backend import classify_seasons, crud, database, models
+
+def _add_images(db, count):
+    images = [models.Image(path=f"/photos/{i}.jpg", filename=f"{i}.jpg", size_mb=1.0) for i in range(count)]
+    db.add_all(images)
+    db.commit()
+    return [image.id for image in images]
+
+def _create_job(db, image_ids):
+    job = crud.create_classification_job(db, "vlm")
+    db.add_all(models.ClassificationItem(job_id=job.id, image_id=image_id, status="pending", attempts=0)
+               for image_id in image_ids)
+    db.commit()
+    crud.update_classification_job(db, job.id, total=len(image_ids))
+    db.refresh(job)
+    return job
+
+class _FakeMetrics:
+    def as_dict(self):
+        return {}
+
+class _FakeVLMClient:
+    """代替 VLMClient: 把每张图片分类为 Summer，第一批处理时调用 on_first_batch"""
+
+    def __init__(self, on_first_batch):
+        self.on_first_batch = on_first_batch
+        self.metrics = _FakeMetrics()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def classify_all(self, items, load_image, on_result, on_error, should_stop=None):
+        if self.on_first_batch is not None:
+            self.on_first_batch()
+            self.on_first_batch = None
+        for image_id, path in items:
+            await on_result(image_id, path, "Summer")
+
+def test_delete_images_removes_pending_queue_items(db):
+    kept, deleted = _add_images(db, 2)
+    job = _create_job(db, [kept, deleted])
+
+    assert crud.delete_images(db, [deleted]) == 1
+    assert crud.count_classification_items(db, job.id) == {'pending': 1, 'done': 0, 'failed': 0}
+
+def test_prepare_drops_items_of_deleted_images(db):
+    (kept,) = _add_images(db, 1)
+    job = _create_job(db, [kept, kept + 1000])  # 第二张图片已不存在 (在清理队列之前被删除)
+    crud.update_classification_job(db, job.id, status="cancelled")
+
+    resumed, _ = classify_seasons.prepare_classification_job(db, "vlm")
+    assert resumed.id == job.id
+    assert (resumed.total, resumed.processed) == (1, 0)
+
+def test_job_completes_when_images_are_deleted_while_running(db, monkeypatch):
+    image_ids = _add_images(db, 3)
+    job = _create_job(db, image_ids)
+
+    def delete_last_image():
+        other = database.SessionLocal()
+        try:
+            crud.delete_images(other, [image_ids[-1]])
+        finally:
+            other.close()
+    monkeypatch.setattr(classify_seasons, "CLASSIFY_BATCH_SIZE", 1)
+    monkeypatch.setattr(classify_seasons, "VLMClient", lambda: _FakeVLMClient(delete_last_image))
+
+    async def emit_status(message, **kwargs):
+        pass
+    outcome = asyncio.run(classify_seasons.run_classification_job(db, job, emit_status))
+
+    assert outcome['classified'] == 2
+    db.refresh(job)
+    assert (job.status, job.total, job.processed) == ("completed", 2, 2)
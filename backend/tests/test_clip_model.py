@@ -0,0 +1,55 @@
+import sys
+import types
+
+import pytest
+
+from backend import clip_model, inference_backends
+
+class _FakeModel:
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+@pytest.fixture
+def model_state(monkeypatch):
+    """测试结束后恢复 clip_model 的加载状态"""
+    for name in ("encoder", "processor", "DEVICE", "_load_error", "_load_seconds", "_load_failures", "_retry_at"):
+        monkeypatch.setattr(clip_model, name, getattr(clip_model, name))
+    monkeypatch.setattr(clip_model, "encoder", None)
+    monkeypatch.setattr(clip_model, "_load_error", None)
+
+def _fake_libraries(monkeypatch, fail: bool):
+    def from_pretrained(name):
+        if fail:
+            raise OSError("无法连接到 huggingface.co")
+        return _FakeModel()
+    torch = types.SimpleNamespace(cuda=types.SimpleNamespace(is_available=lambda: False))
+    transformers = types.SimpleNamespace(CLIPModel=types.SimpleNamespace(from_pretrained=from_pretrained),
+                                         CLIPProcessor=types.SimpleNamespace(from_pretrained=from_pretrained))
+    monkeypatch.setitem(sys.modules, "torch", torch)
+    monkeypatch.setitem(sys.modules, "transformers", transformers)
+    monkeypatch.setattr(inference_backends, "create_encoder", lambda *args, **kwargs: object())
+
+def test_load_failure_is_retried_after_backoff(model_state, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(clip_model.time, "monotonic", lambda: now[0])
+    _fake_libraries(monkeypatch, fail=True)
+
+    assert not clip_model.load_model()
+    assert clip_model.status()['retry_in_seconds'] == clip_model.LOAD_RETRY_SECONDS
+    with pytest.raises(RuntimeError):
+        clip_model.encode_pixel_batch([])
+    assert clip_model._load_failures == 1  # 退避期间不重新加载
+
+    now[0] += clip_model.LOAD_RETRY_SECONDS
+    assert not clip_model.load_model()
+    assert clip_model._load_failures == 2
+    assert clip_model.status()['retry_in_seconds'] == 2 * clip_model.LOAD_RETRY_SECONDS
+
+    _fake_libraries(monkeypatch, fail=False)
+    now[0] += 2 * clip_model.LOAD_RETRY_SECONDS
+    assert clip_model.load_model()
+    status = clip_model.status()
+    assert status['loaded'] and status['error'] is None and status['retry_in_seconds'] is None
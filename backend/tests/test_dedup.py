@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from backend import dedup, models
+from backend.mmap_index import MmapVectorBackend
+
+@pytest.fixture(autouse=True)
+def clear_cluster_cache():
+    dedup._cluster_cache.clear()
+    yield
+    dedup._cluster_cache.clear()
+
+@pytest.fixture
+def library(db, use_backend, tmp_path):
+    """
+    a/a2 为近似重复 (余弦相似度约 0.99)，b 与它们无关；
+    copy1/copy2 内容相同，共用向量 c。
+    """
+    rng = np.random.default_rng(0)
+    base = rng.standard_normal((3, 64)).astype(np.float32)
+    near = base[0] + 0.1 * rng.standard_normal(64).astype(np.float32)
+    store = use_backend(MmapVectorBackend(str(tmp_path / "index"), dim=64))
+    store.upsert(np.stack([base[0], near, base[1], base[2]]), ["a", "a2", "b", "c"])
+    for name, vector_id, content_hash in [("a", "a", "ha"), ("a2", "a2", "ha2"), ("b", "b", "hb"),
+                                          ("copy1", "c", "hc"), ("copy2", "c", "hc")]:
+        db.add(models.Image(path=f"/photos/{name}.jpg", filename=f"{name}.jpg", size_mb=1.0,
+                            vector_id=vector_id, content_hash=content_hash))
+    db.commit()
+    return store
+
+def _paths(groups):
+    return sorted(sorted(entry['path'] for entry in group) for group in groups)
+
+def test_exact_and_near_duplicates(db, library):
+    result = dedup.find_duplicates(db, threshold=0.95)
+    assert _paths(result['exact_groups']) == [["/photos/copy1.jpg", "/photos/copy2.jpg"]]
+    # 共用一个向量的完全重复不计入近似重复组 (只有一个向量)
+    assert _paths(result['near_groups']) == [["/photos/a.jpg", "/photos/a2.jpg"]]
+    assert dedup.find_duplicates(db, threshold=0.999)['near_groups'] == []
+
+def test_clusters_are_cached_until_library_changes(db, library, monkeypatch):
+    calls = []
+    load_vectors = dedup._load_vectors
+    monkeypatch.setattr(dedup, "_load_vectors", lambda budget: calls.append(budget) or load_vectors(budget))
+
+    first = dedup.cluster_near_duplicates(db, 0.95)
+    assert dedup.cluster_near_duplicates(db, 0.95) == first
+    assert len(calls) == 1
+
+    library.upsert(library.get(["a"])["a"][None, :], ["a3"])
+    db.add(models.Image(path="/photos/a3.jpg", filename="a3.jpg", size_mb=1.0, vector_id="a3"))
+    db.commit()
+    assert _paths(dedup.cluster_near_duplicates(db, 0.95)) == [["/photos/a.jpg", "/photos/a2.jpg", "/photos/a3.jpg"]]
+    assert len(calls) == 2
+
+def test_refuses_to_exceed_memory_budget(db, library):
+    # 4 个 64 维向量加上最小的计算分块 (MIN_BLOCK_SIZE) 约需 0.4 MB
+    with pytest.raises(dedup.DedupMemoryError):
+        dedup.cluster_near_duplicates(db, 0.95, memory_budget_mb=0)
+    assert dedup.cluster_near_duplicates(db, 0.95, memory_budget_mb=1)
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from backend import embedding_cache, preprocess, thumbnails
+
+KEY = ("test-model@torch", preprocess.PREPROCESS_VERSION)
+
+def _vectors(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, 8)).astype(np.float32)
+
+def test_hit_and_miss(tmp_path):
+    cache = embedding_cache.EmbeddingCache(str(tmp_path / "cache.db"))
+    vectors = _vectors(2)
+    cache.put_many(KEY, ["h1", "h2", None], list(vectors) + [vectors[0]])
+
+    found = cache.get_many(KEY, ["h1", "h2", "h3"])
+    assert set(found) == {"h1", "h2"}
+    assert np.array_equal(found["h2"], vectors[1])
+    # 模型或预处理版本不同的条目不会混用
+    assert cache.get_many(("other-model@torch", KEY[1]), ["h1"]) == {}
+    assert cache.get_many((KEY[0], KEY[1] + 1), ["h1"]) == {}
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    cache = embedding_cache.EmbeddingCache(str(tmp_path / "cache.db"))
+    clock = iter(range(1000))
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: next(clock) * embedding_cache.TOUCH_INTERVAL_SECONDS)
+    hashes = [f"h{i}" for i in range(10)]
+    for content_hash, vector in zip(hashes, _vectors(10)):
+        cache.put_many(KEY, [content_hash], [vector])
+    cache.touch(KEY, ["h0"])  # 最早写入，但最近被使用
+
+    entry_bytes = cache._entry_bytes()
+    budget_mb = 5 * entry_bytes / (1024 * 1024)
+    removed = cache.enforce_budget(budget_mb)
+    remaining = set(cache.get_many(KEY, hashes, touch=False))
+    assert removed == 10 - int(budget_mb * 1024 * 1024 * 0.9 // entry_bytes)
+    assert "h0" in remaining and "h9" in remaining
+    assert "h1" not in remaining
+    assert cache.stats()['evictions'] == removed
+
+def test_readonly_reader_never_creates_or_writes(tmp_path):
+    path = tmp_path / "cache.db"
+    reader = embedding_cache.EmbeddingCache(str(path), readonly=True)
+    assert reader.get_many(KEY, ["h1"]) == {}
+    assert not path.exists()
+
+    writer = embedding_cache.EmbeddingCache(str(path))
+    writer.put_many(KEY, ["h1"], _vectors(1))
+    size = path.stat().st_size
+    assert set(reader.get_many(KEY, ["h1"])) == {"h1"}
+    reader.put_many(KEY, ["h2"], _vectors(1))
+    reader.touch(KEY, ["h1"])
+    assert set(writer.get_many(KEY, ["h1", "h2"])) == {"h1"}
+    assert path.stat().st_size == size
+
+def test_decode_images_skips_cached_images(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for name in ("cached", "new"):
+        path = tmp_path / f"{name}.png"
+        Image.fromarray(rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)).save(path)
+        paths.append(str(path))
+    cache_path = str(tmp_path / "cache.db")
+    cached_hash = thumbnails.hash_file(paths[0])
+    embedding_cache.EmbeddingCache(cache_path).put_many(KEY, [cached_hash], _vectors(1))
+
+    # 第一次: 缩略图不存在，命中缓存的图片也需要解码以生成缩略图
+    results, _ = preprocess.decode_images(paths, KEY, cache_path)
+    assert [path for path, *_ in results] == paths
+    assert all(pixels is not None for _, pixels, *_ in results)
+    assert results[0][4] is not None and results[1][4] is None
+
+    results, _ = preprocess.decode_images(paths + [str(tmp_path / "missing.png")], KEY, cache_path)
+    (_, pixels, error, content_hash, vector), new, missing = results
+    assert pixels is None and error is None and content_hash == cached_hash and vector is not None
+    assert new[1] is not None and new[3] == thumbnails.hash_file(paths[1])
+    assert missing[2] == "文件未找到"
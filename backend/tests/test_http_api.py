@@ -0,0 +1,46 @@
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from backend import clip_model, main, search
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+@pytest.fixture
+def model_unavailable(monkeypatch):
+    monkeypatch.setattr(clip_model, "load_model", lambda: False)
+    monkeypatch.setattr(clip_model, "encoder", None)
+
+def _png_bytes():
+    buffer = io.BytesIO()
+    Image.fromarray(np.zeros((32, 32, 3), dtype=np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def test_upload_search_without_model_returns_503(db, client, model_unavailable):
+    response = client.post("/api/similar", content=_png_bytes())
+    assert response.status_code == 503
+
+def test_text_search_without_model_returns_503(db, client, model_unavailable):
+    assert client.get("/api/search", params={'q': "sunset"}).status_code == 503
+
+def test_upload_above_limit_is_rejected(db, client, monkeypatch):
+    monkeypatch.setattr(search, "MAX_UPLOAD_BYTES", 1024)
+    assert client.post("/api/similar", content=b"x" * 2048).status_code == 413
+
+    def chunks():
+        for _ in range(4):
+            yield b"x" * 512
+    # 分块传输 (没有 Content-Length) 时同样限制大小
+    assert client.post("/api/similar", content=chunks()).status_code == 413
+
+def test_undecodable_upload_returns_400(db, client):
+    assert client.post("/api/similar", content=b"not an image").status_code == 400
+
+def test_text_search_rejects_offset_above_limit(db, client):
+    response = client.get("/api/search", params={'q': "sunset", 'offset': search.MAX_OFFSET + 1})
+    assert response.status_code == 400
@@ -0,0 +1,52 @@
+"""
+推理后端与参考实现 (torch eager) 的一致性，在不同的批次大小下校验。
+需要 torch、transformers 与本地已下载的 CLIP 模型，不满足时跳过。
+"""
+import numpy as np
+import pytest
+
+from backend import clip_model, inference_backends
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+TEXTS = ["a dog", "snow covered mountains at sunrise", "autumn leaves on a wet street in the city at night", "beach"]
+
+@pytest.fixture(scope="module")
+def model():
+    try:
+        return transformers.CLIPModel.from_pretrained(clip_model.MODEL_NAME, local_files_only=True).eval()
+    except OSError:
+        pytest.skip("本地没有 CLIP 模型")
+
+@pytest.fixture(scope="module")
+def tokenizer(model):
+    return transformers.CLIPTokenizer.from_pretrained(clip_model.MODEL_NAME, local_files_only=True)
+
+@pytest.fixture(scope="module")
+def reference(model):
+    return inference_backends.TorchEncoder(torch, model, "cpu")
+
+@pytest.fixture(scope="module")
+def torchscript(model):
+    encoder = inference_backends.TorchScriptEncoder(torch, model, "cpu")
+    # 加载时的校验不通过会退回 eager 推理，这里要求 trace 的图本身可用
+    assert encoder.name == "torchscript"
+    return encoder
+
+def _assert_parity(reference, candidate, threshold):
+    assert inference_backends.cosine_parity(reference, candidate)['min'] >= threshold
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_torchscript_image_parity(reference, torchscript, batch_size):
+    pixel_values = np.random.default_rng(batch_size).standard_normal((batch_size, 3, 224, 224)).astype(np.float32)
+    _assert_parity(reference.encode_image(pixel_values), torchscript.encode_image(pixel_values),
+                   inference_backends.PARITY_THRESHOLDS["torchscript"])
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_torchscript_text_parity(reference, torchscript, tokenizer, batch_size):
+    inputs = tokenizer(TEXTS[:batch_size], return_tensors="np", padding="max_length",
+                       max_length=inference_backends.TEXT_MAX_LENGTH, truncation=True)
+    _assert_parity(reference.encode_text(inputs["input_ids"], inputs["attention_mask"]),
+                   torchscript.encode_text(inputs["input_ids"], inputs["attention_mask"]),
+                   inference_backends.PARITY_THRESHOLDS["torchscript"])
@@ -0,0 +1,69 @@
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+from backend import ipc, store_service
+from backend.mmap_index import MmapVectorBackend
+
+@pytest.fixture
+def key_file(monkeypatch, tmp_path):
+    path = str(tmp_path / "service.key")
+    monkeypatch.delenv("PHOTO_INSIGHT_SERVICE_KEY", raising=False)
+    monkeypatch.setattr(ipc, "SERVICE_KEY_FILE", path)
+    return path
+
+def test_refuses_without_key(key_file):
+    with pytest.raises(ipc.ServiceError):
+        ipc.service_authkey()
+    with pytest.raises(ipc.ServiceError):
+        ipc.connect("127.0.0.1:1", retries=0)
+
+def test_generates_private_key_file(key_file):
+    key = ipc.service_authkey(create=True)
+    assert len(key) >= 32
+    assert stat.S_IMODE(os.stat(key_file).st_mode) == 0o600
+    assert ipc.service_authkey() == key
+    assert ipc.service_authkey(create=True) == key
+
+def test_default_key_file_is_outside_working_tree():
+    assert not os.path.abspath(ipc.SERVICE_KEY_FILE).startswith(os.getcwd() + os.sep)
+
+def test_creates_private_key_directory(key_file, monkeypatch, tmp_path):
+    path = tmp_path / "config" / "photo-insight" / "service.key"
+    monkeypatch.setattr(ipc, "SERVICE_KEY_FILE", str(path))
+    ipc.service_authkey(create=True)
+    assert stat.S_IMODE(os.stat(path.parent).st_mode) == 0o700
+
+@pytest.mark.skipif(os.name != "posix", reason="文件权限检查只在 POSIX 上进行")
+def test_rejects_readable_key_file(key_file):
+    ipc.service_authkey(create=True)
+    os.chmod(key_file, 0o644)
+    with pytest.raises(ipc.ServiceError):
+        ipc.service_authkey()
+
+def test_explicit_key_takes_precedence(key_file, monkeypatch):
+    monkeypatch.setenv("PHOTO_INSIGHT_SERVICE_KEY", "secret")
+    assert ipc.service_authkey(create=True) == b"secret"
+    assert not os.path.exists(key_file)
+
+def test_service_requires_matching_key(key_file, tmp_path):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        address = f"127.0.0.1:{probe.getsockname()[1]}"
+    service = store_service.StoreService(MmapVectorBackend(str(tmp_path / "index")), address=address)
+    thread = threading.Thread(target=service.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = ipc.RpcClient(address)
+        assert client.call("count") == 0
+        client.close()
+        assert os.path.exists(key_file)
+        with pytest.raises(ipc.ServiceError):
+            ipc.RpcClient(address, authkey=b"wrong").call("count")
+        # 认证失败只影响那一个连接
+        assert ipc.RpcClient(address).call("count") == 0
+    finally:
+        service.close()
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from backend import crud, indexer, jobs, worker
+
+def _wait_for(predicate, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+def _fake_index_directory(slow_directory):
+    """代替 indexer.index_directory: slow_directory 一直运行到 should_stop() 为 True，其他目录立即完成"""
+    def index_directory(directory, emit, should_stop=None, checkpoint=None, on_checkpoint=None):
+        if directory == slow_directory:
+            while not should_stop():
+                time.sleep(0.01)
+        return {'total': 0}
+    return index_directory
+
+def test_paused_job_does_not_block_queue(db, monkeypatch):
+    monkeypatch.setattr(indexer, "index_directory", _fake_index_directory("/photos/slow"))
+    manager = jobs.JobManager(max_workers=1)
+    try:
+        slow = manager.submit("/photos/slow")
+        assert _wait_for(lambda: slow.status == "running")
+        manager.pause(slow.id)
+
+        other = manager.submit("/photos/other")
+        assert _wait_for(lambda: other.status == "completed")
+        assert slow.status == "paused"
+
+        manager.resume(slow.id)
+        assert _wait_for(lambda: slow.status == "running")
+        manager.cancel(slow.id)
+    finally:
+        manager.shutdown()
+
+def test_restored_paused_job_does_not_block_queue(db, monkeypatch, use_backend, tmp_path):
+    from backend.mmap_index import MmapVectorBackend
+    use_backend(MmapVectorBackend(str(tmp_path / "index")))
+    monkeypatch.setattr(indexer, "index_directory", _fake_index_directory("/photos/slow"))
+    crud.create_indexing_job(db, "paused-job", "/photos/slow")
+    crud.update_indexing_job(db, "paused-job", status="paused")
+    manager = jobs.JobManager(max_workers=1)
+    try:
+        assert manager.resume_unfinished() == 1
+        other = manager.submit("/photos/other")
+        assert _wait_for(lambda: other.status == "completed")
+        assert manager.get("paused-job").status == "paused"
+    finally:
+        manager.shutdown()
+
+def test_paused_task_releases_worker(db, monkeypatch):
+    monkeypatch.setattr(indexer, "index_directory", _fake_index_directory("/photos/slow"))
+    monkeypatch.setattr(worker, "POLL_INTERVAL", 0.05)
+    queue = jobs.QueuedJobManager()
+    runner = worker.Worker(concurrency=1, emit=lambda *args: None)
+    thread = threading.Thread(target=runner.run)
+    thread.start()
+    try:
+        slow = queue.submit("/photos/slow")
+        assert _wait_for(lambda: queue.get(slow.id).status == "running")
+        queue.pause(slow.id)
+
+        other = queue.submit("/photos/other")
+        assert _wait_for(lambda: queue.get(other.id).status == "completed")
+        assert queue.get(slow.id).status == "paused"
+
+        queue.resume(slow.id)
+        assert _wait_for(lambda: queue.get(slow.id).status == "running")
+        queue.cancel(slow.id)
+        assert _wait_for(lambda: not runner._running)
+    finally:
+        runner.stop()
+        thread.join()
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from backend import mmap_index
+from backend.benchmarks.bench_vector_backends import clustered_vectors, exact_top_k
+
+def _ids(count):
+    return [f"v{i:05d}" for i in range(count)]
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_add_query_delete_round_trip(tmp_path, dtype):
+    data = clustered_vectors(300, seed=1)
+    ids = _ids(len(data))
+    index = mmap_index.MmapVectorBackend(str(tmp_path), dtype=dtype, dim=data.shape[1])
+    assert index.upsert(data, ids)
+    assert index.count() == len(ids)
+
+    hits = index.query(data[7], 5)
+    assert hits[0][0] == ids[7] and hits[0][1] == pytest.approx(1.0, abs=1e-2)
+    assert index.query_subset(data[7], ids[100:110], 3)[0][0] in ids[100:110]
+    unit = data[3] / np.linalg.norm(data[3])
+    assert np.allclose(index.get([ids[3]])[ids[3]], unit, atol=1e-2)
+
+    assert index.delete(ids[:10])
+    assert index.count() == len(ids) - 10
+    assert ids[7] not in [vector_id for vector_id, _ in index.query(data[7], 20)]
+
+    # 删除的行被复用，重新打开后内容不变
+    assert index.upsert(data[:2], ["new-a", "new-b"])
+    reopened = mmap_index.MmapVectorBackend(str(tmp_path))
+    assert reopened.count() == len(ids) - 8
+    assert reopened.query(data[0], 1)[0][0] == "new-a"
+    assert sorted(vector_id for batch, _ in reopened.iter_batches(64) for vector_id in batch) == \
+        sorted(ids[10:] + ["new-a", "new-b"])
+
+@pytest.mark.parametrize("dtype, min_recall", [("float32", 1.0), ("float16", 0.99), ("int8", 0.9)])
+def test_recall_against_exact_search(tmp_path, dtype, min_recall):
+    top_k = 10
+    data = clustered_vectors(5000, seed=2, cluster_size=200)
+    ids = _ids(len(data))
+    index = mmap_index.MmapVectorBackend(str(tmp_path), dtype=dtype, dim=data.shape[1])
+    index.upsert(data, ids)
+
+    unit = data / np.linalg.norm(data, axis=1, keepdims=True)
+    row_of = {vector_id: row for row, vector_id in enumerate(ids)}
+    recall = [len(exact_top_k(unit, data[row], top_k) & {row_of[vid] for vid, _ in index.query(data[row], top_k)})
+              / top_k for row in range(0, len(data), 50)]
+    assert np.mean(recall) >= min_recall
+
+def test_int8_index_without_scales_uses_legacy_scale(tmp_path):
+    data = clustered_vectors(50, seed=3)
+    ids = _ids(len(data))
+    index = mmap_index.MmapVectorBackend(str(tmp_path), dtype="int8", dim=data.shape[1])
+    # 模拟按行缩放之前创建的索引: 固定缩放系数且没有 scales.npy
+    unit = data / np.linalg.norm(data, axis=1, keepdims=True)
+    index._vectors[:len(ids)] = np.clip(np.rint(unit * mmap_index.INT8_MAX), -127, 127).astype(np.int8)
+    index._ids[:len(ids)] = [vector_id.encode() for vector_id in ids]
+    index._meta['count'] = len(ids)
+    index._flush()
+    del index
+    (tmp_path / mmap_index.SCALES_FILE).unlink()
+
+    reopened = mmap_index.MmapVectorBackend(str(tmp_path))
+    assert reopened.query(data[4], 1)[0][0] == ids[4]
+    assert np.allclose(reopened.get([ids[4]])[ids[4]], unit[4], atol=1e-2)
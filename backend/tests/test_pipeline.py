@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PIL import Image
+
+import pytest
+
+from backend import clip_model, embedding_cache, pipeline
+
+@pytest.fixture(autouse=True)
+def no_embedding_cache(monkeypatch):
+    monkeypatch.setattr(embedding_cache, "get_cache", lambda: None)
+
+def _write_images(directory, count):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        path = directory / f"{i:02d}.png"
+        Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)).save(path)
+        paths.append(str(path))
+    return paths
+
+def _run(paths, **kwargs):
+    written, failures = [], []
+    stats = pipeline.IndexingPipeline(**kwargs).run(
+        paths, on_batch=lambda batch, features, hashes: written.extend(batch),
+        on_failure=lambda path, error: failures.append(path))
+    return written, failures, stats
+
+def test_slow_inference_does_not_drop_decoded_images(tmp_path, monkeypatch):
+    def slow_encode(pixel_batch):
+        time.sleep(0.8)  # 长于 _put 的等待间隔，队列在生产者结束时仍是满的
+        return np.zeros((len(pixel_batch), clip_model.EMBEDDING_DIM), dtype=np.float32)
+    monkeypatch.setattr(clip_model, "encode_pixel_batch", slow_encode)
+    paths = _write_images(tmp_path, 6)
+
+    written, failures, stats = _run(paths, decode_workers=1, batch_size=2, queue_size=2)
+    assert sorted(written) == paths
+    assert failures == [] and stats['failed'] == 0
+
+class _BrokenExecutor:
+    """代替 ProcessPoolExecutor: 第一个任务正常完成，之后解码进程异常退出"""
+
+    def __init__(self, *args, **kwargs):
+        self.submitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, paths, *args):
+        future = Future()
+        self.submitted += 1
+        if self.submitted == 1:
+            future.set_result(([(path, np.zeros((224, 224, 3), np.uint8), None, None, None) for path in paths], 0.0))
+        else:
+            future.set_exception(BrokenProcessPool("decode worker died"))
+        return future
+
+def test_broken_process_pool_reports_remaining_images(monkeypatch):
+    monkeypatch.setattr(pipeline, "ProcessPoolExecutor", _BrokenExecutor)
+    monkeypatch.setattr(clip_model, "encode_pixel_batch",
+                        lambda batch: np.zeros((len(batch), clip_model.EMBEDDING_DIM), dtype=np.float32))
+    paths = [f"/photos/{i:02d}.jpg" for i in range(20)]
+
+    written, failures, stats = _run(paths, decode_workers=1, batch_size=4, queue_size=4)
+    assert written == paths[:pipeline.DECODE_CHUNK_SIZE]
+    assert failures == paths[pipeline.DECODE_CHUNK_SIZE:]
+    assert stats['failed'] == len(paths) - pipeline.DECODE_CHUNK_SIZE
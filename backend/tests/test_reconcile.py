@@ -0,0 +1,43 @@
+import numpy as np
+
+from backend import crud, models, vector_db
+from backend.mmap_index import MmapVectorBackend
+
+def _add_images(db, vector_ids):
+    for i, vector_id in enumerate(vector_ids):
+        db.add(models.Image(path=f"/photos/{i}.jpg", filename=f"{i}.jpg", size_mb=1.0, vector_id=vector_id))
+    db.commit()
+
+def _vector_ids(db):
+    return sorted(vid for (vid,) in db.query(models.Image.vector_id) if vid)
+
+def test_empty_store_keeps_vector_ids(db, use_backend, tmp_path):
+    _add_images(db, ["a", "b"])
+    use_backend(MmapVectorBackend(str(tmp_path / "index")))
+    assert crud.reconcile_vector_store(db) == (0, 0)
+    assert _vector_ids(db) == ["a", "b"]
+
+def test_unopened_store_keeps_vector_ids(db, use_backend, tmp_path):
+    _add_images(db, ["a", "b"])
+    store = use_backend(vector_db.ChromaBackend(str(tmp_path / "chroma")))
+    store.collection = None  # 集合打开失败
+    assert crud.reconcile_vector_store(db) == (0, 0)
+    assert _vector_ids(db) == ["a", "b"]
+
+def test_unavailable_store_keeps_vector_ids(db, monkeypatch):
+    _add_images(db, ["a", "b"])
+
+    def unavailable():
+        raise RuntimeError("向量存储不可用")
+    monkeypatch.setattr(vector_db, "get_backend", unavailable)
+    assert crud.reconcile_vector_store(db) == (0, 0)
+    assert _vector_ids(db) == ["a", "b"]
+
+def test_repairs_partial_store(db, use_backend, tmp_path):
+    _add_images(db, ["a", "b"])
+    store = use_backend(MmapVectorBackend(str(tmp_path / "index"), dim=4))
+    vectors = np.eye(4, dtype=np.float32)[:2]
+    assert store.upsert(vectors, ["a", "orphan"])
+    assert crud.reconcile_vector_store(db) == (1, 1)
+    assert _vector_ids(db) == ["a"]
+    assert set(store.iter_ids()) == {"a"}
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from backend import clip_model, crud, models, search
+from backend.mmap_index import MmapVectorBackend
+
+def test_text_search_clamps_offset(db, monkeypatch):
+    requested = []
+    monkeypatch.setattr(clip_model, "get_text_features", lambda query: np.ones(4, dtype=np.float32))
+    monkeypatch.setattr(search, "filtered_query", lambda db, vector, n, filters: (requested.append(n) or [], "scan"))
+
+    search.search_text(db, "beach", top_k=10 ** 6, offset=10 ** 9)
+    assert requested == [search.MAX_OFFSET + search.MAX_TOP_K]
+
+@pytest.fixture
+def library(db, use_backend, tmp_path):
+    """400 张图片: /photos/small 下 40 张 (其中偶数为 Winter)，其余在 /photos/large；每张图片一个向量"""
+    vectors = np.random.default_rng(0).standard_normal((400, 16)).astype(np.float32)
+    store = use_backend(MmapVectorBackend(str(tmp_path / "index"), dim=16))
+    store.upsert(vectors, [f"v{i}" for i in range(len(vectors))])
+    for i in range(len(vectors)):
+        directory = "/photos/small" if i < 40 else "/photos/large"
+        image = models.Image(path=f"{directory}/{i:03d}.jpg", filename=f"{i:03d}.jpg", size_mb=float(i % 10),
+                             vector_id=f"v{i}")
+        db.add(image)
+        db.flush()
+        if i < 40 and i % 2 == 0:
+            db.add(models.ImageLabel(image_id=image.id, label_type=crud.LABEL_SEASON, label="Winter", score=1.0))
+    db.commit()
+    return vectors
+
+def _exact(vectors, query, n, accept):
+    """暴力检索后按条件筛选的期望结果 (文件名)"""
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    order = np.argsort(-(unit @ (query / np.linalg.norm(query))))
+    return [f"{i:03d}.jpg" for i in order if accept(i)][:n]
+
+FILTERS = {
+    'directory': (dict(directory="/photos/small"), lambda i: i < 40),
+    'season': (dict(seasons=["Winter"]), lambda i: i < 40 and i % 2 == 0),
+    'size': (dict(min_size_mb=2), lambda i: i % 10 >= 2),
+}
+
+@pytest.mark.parametrize("name, expected_plan", [("directory", "prefilter"), ("season", "prefilter"),
+                                                 ("size", "postfilter")])
+def test_planner_chooses_by_selectivity(db, library, name, expected_plan):
+    params, _ = FILTERS[name]
+    _, plan = search.filtered_query(db, library[0], 10, search.SearchFilters(**params))
+    assert plan == expected_plan
+    assert search.filtered_query(db, library[0], 10)[1] == "ann"
+
+@pytest.mark.parametrize("name", sorted(FILTERS))
+@pytest.mark.parametrize("forced_plan", ["prefilter", "postfilter"])
+def test_plans_return_the_same_results(db, library, monkeypatch, name, forced_plan):
+    if forced_plan == "prefilter":
+        monkeypatch.setattr(search, "prefilter_break_even", lambda *args: len(library))
+        monkeypatch.setattr(search, "PREFILTER_MAX_CANDIDATES", len(library))
+    else:
+        monkeypatch.setattr(search, "PREFILTER_MAX_CANDIDATES", 0)
+    params, accept = FILTERS[name]
+    query = library[5] + 0.5
+
+    results, plan = search.filtered_query(db, query, 10, search.SearchFilters(**params))
+    assert plan == forced_plan
+    assert [result['filename'] for result in results] == _exact(library, query, 10, accept)
+
+    results, _ = search.filtered_query(db, library[4], 10, search.SearchFilters(**params), exclude_vector_id="v4")
+    assert [result['filename'] for result in results] == _exact(library, library[4], 10,
+                                                                lambda i: i != 4 and accept(i))
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from backend import main
+
+@pytest.fixture
+def emitted(monkeypatch):
+    """记录处理函数通过 sio.emit 发送的事件: [(event, data)]"""
+    events = []
+
+    async def emit(event, data=None, room=None, **kwargs):
+        events.append((event, data))
+    monkeypatch.setattr(main.sio, "emit", emit)
+    return events
+
+@pytest.mark.parametrize("handler, data", [
+    (main.search_text, {'query': 'beach', 'top_k': 'ten'}),
+    (main.search_text, {'query': 'beach', 'offset': None}),
+    (main.search_text, {'query': ['beach']}),
+    (main.search_text, {'query': 'beach', 'offset': main.search.MAX_OFFSET + 1}),
+    (main.find_similar, {'image_id': 'abc'}),
+    (main.find_similar, {'image_id': 1, 'top_k': [5]}),
+    (main.find_similar, {'image_id': 1, 'page_size': 'all'}),
+    (main.find_duplicates, {'threshold': 'high'}),
+    (main.start_season_classification, {'vlm_threshold': 'x'}),
+    (main.load_all_images, {'limit': 'many'}),
+    (main.load_season_images, {'season': 'summer', 'cursor': {}}),
+    (main.start_indexing, None),
+])
+def test_invalid_params_emit_error(db, emitted, handler, data):
+    asyncio.run(handler("sid", data))
+    assert [event for event, _ in emitted] == ['error']
@@ -0,0 +1,141 @@
+"""
+按内容寻址的缩略图缓存。
+
+缩略图以图片文件内容的哈希命名: <THUMBNAIL_DIR>/<尺寸>/<哈希前两位>/<哈希>.jpg，
+同一内容的图片 (包括被移动或复制的文件) 共用一份缩略图，文件内容修改后自然生成新的缩略图。
+缩略图在索引时由解码进程根据已解码的图片生成，不会再次读取原图。
+缓存总大小超过预算时按最近访问时间 (文件 mtime) 淘汰。
+此模块不依赖 torch，可以在解码进程中导入。
+"""
+import hashlib
+import io
+import logging
+import os
+import time
+from PIL import Image
+
+# 配置
+THUMBNAIL_DIR = os.environ.get("PHOTO_INSIGHT_THUMBNAIL_DIR", "./thumbnails")
+THUMBNAIL_SIZES = (256, 1024)  # 最长边像素数
+VLM_THUMBNAIL_SIZE = 1024  # VLM 分类使用的缩略图尺寸
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_BUDGET_MB = int(os.environ.get("PHOTO_INSIGHT_THUMBNAIL_BUDGET_MB", "2048"))
+TOUCH_INTERVAL_SECONDS = 3600  # 访问时刷新 mtime 的最小间隔，避免每次请求都写磁盘
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_bytes(data: bytes):
+    """图片内容的哈希 (32 位十六进制)"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def hash_file(path: str):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def thumbnail_path(content_hash: str, size: int, root: str = THUMBNAIL_DIR):
+    return os.path.join(root, str(size), content_hash[:2], f"{content_hash}.jpg")
+
+def thumbnail_url(image_id: int, content_hash: str = None, size: int = THUMBNAIL_SIZES[0]):
+    """
+    图片缩略图的 HTTP 地址 (相对路径)。
+    带上内容哈希作为版本号，文件内容变化后地址随之变化，浏览器可以长期缓存。
+    """
+    url = f"/api/images/{image_id}/thumbnail?size={size}"
+    return f"{url}&v={content_hash[:16]}" if content_hash else url
+
+def has_thumbnails(content_hash: str, root: str = THUMBNAIL_DIR):
+    return all(os.path.exists(thumbnail_path(content_hash, size, root)) for size in THUMBNAIL_SIZES)
+
+def save_thumbnails(img, content_hash: str, root: str = THUMBNAIL_DIR):
+    """
+    由一张已解码的 RGB 图像生成所有尺寸的缩略图。
+    从大到小依次缩放，较小的缩略图由上一个缩略图生成。写入时先写临时文件再替换，避免读到不完整的文件。
+    """
+    current = img
+    for size in sorted(THUMBNAIL_SIZES, reverse=True):
+        path = thumbnail_path(content_hash, size, root)
+        if max(current.size) > size:
+            current = current.copy()
+            current.thumbnail((size, size), Image.BICUBIC)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        current.save(tmp_path, format="JPEG", quality=THUMBNAIL_QUALITY)
+        os.replace(tmp_path, path)
+
+def generate_from_file(image_path: str, content_hash: str = None, root: str = THUMBNAIL_DIR):
+    """读取原图生成缩略图 (缓存被淘汰或旧记录尚未生成缩略图时使用)。:return: 内容哈希"""
+    with open(image_path, "rb") as f:
+        data = f.read()
+    content_hash = content_hash or hash_bytes(data)
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (max(THUMBNAIL_SIZES), max(THUMBNAIL_SIZES)))
+        save_thumbnails(img.convert("RGB"), content_hash, root)
+    return content_hash
+
+def get_thumbnail(content_hash: str, size: int, image_path: str = None, root: str = THUMBNAIL_DIR):
+    """
+    获取缩略图文件路径，并刷新其最近访问时间。缺失时若提供了原图路径则重新生成。
+    :return: 缩略图路径；无法获取时返回 None。
+    """
+    path = thumbnail_path(content_hash, size, root)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        if image_path is None:
+            return None
+        try:
+            generate_from_file(image_path, content_hash, root)
+        except Exception as e:
+            logging.warning(f"为 {image_path} 生成缩略图失败: {e}")
+            return None
+        return path if os.path.exists(path) else None
+
+    now = time.time()
+    if now - mtime > TOUCH_INTERVAL_SECONDS:
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+    return path
+
+def enforce_budget(budget_mb: int = THUMBNAIL_BUDGET_MB, root: str = THUMBNAIL_DIR):
+    """
+    缓存总大小超过预算时，按 mtime 从旧到新删除缩略图，直到低于预算的 90%。
+    :return: 删除的文件数。
+    """
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(".jpg"):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    budget = budget_mb * 1024 * 1024
+    if total <= budget:
+        return 0
+    target = budget * 0.9
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    logging.info(f"缩略图缓存超出预算 {budget_mb} MB，已淘汰 {removed} 个文件")
+    return removed
@@ -1,45 +1,464 @@
-import chromadb
+"""
+向量存储。
+
+模块级函数 (upsert_vectors、query_vectors 等) 是其他模块使用的统一接口，
+实际的存储由可插拔的后端完成，通过环境变量 PHOTO_INSIGHT_VECTOR_BACKEND 选择:
+- chroma: ChromaDB 持久化集合 (默认)
+- mmap: 进程内的内存映射 .npy 索引 (见 mmap_index.py)
+- remote: 通过 IPC 使用存储服务进程中的向量库，用于多进程部署 (见 store_service.py)
+
+后端在第一次使用时才创建 (get_backend)，导入本模块不会打开向量库。
+
+在两种后端之间迁移数据:
+    python -m backend.vector_db migrate --source chroma --target mmap
+"""
+import argparse
+import json
 import logging
+import os
+import threading
+import time
+import numpy as np
 
 # 配置
-DB_PATH = "./chroma_db"
+VECTOR_BACKEND = os.environ.get("PHOTO_INSIGHT_VECTOR_BACKEND", "chroma")
+DB_PATH = os.environ.get("PHOTO_INSIGHT_CHROMA_PATH", "./chroma_db")
 COLLECTION_NAME = "image_vectors"
+STORE_INFO_FILE = "photo_insight.json"  # 记录向量库格式信息 (例如向量是否已归一化)
+DEFAULT_MAX_BATCH_SIZE = 5000
+SUBSET_BATCH_SIZE = 5000  # 预过滤检索每次读取的向量数
+
+def normalize(vectors):
+    """对向量做 L2 归一化，使内积即为余弦相似度。支持单个向量或 (N, D) 矩阵。"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def top_hits(ids, scores, n_results: int):
+    """从 (ids, scores) 中取出分数最高的 n_results 个: [(vector_id, 余弦相似度), ...]，从高到低排序"""
+    n_results = min(n_results, len(ids))
+    if n_results <= 0:
+        return []
+    top = np.argpartition(-scores, n_results - 1)[:n_results]
+    top = top[np.argsort(-scores[top])]
+    # 量化误差可能使分数略大于 1
+    return [(ids[i], min(float(scores[i]), 1.0)) for i in top]
+
+class VectorBackend:
+    """
+    向量存储后端接口。所有写入的向量都会先做 L2 归一化，查询结果中的分数为余弦相似度。
+    写入/删除方法返回 True 表示成功，失败时记录日志并返回 False。
+    """
+    name = None
+    exhaustive = False  # 查询是否需要扫描全部向量 (暴力检索)，用于估计带过滤条件的检索代价
+
+    def upsert(self, vectors, vector_ids):
+        raise NotImplementedError
+
+    def delete(self, vector_ids):
+        raise NotImplementedError
+
+    def query(self, vector, n_results: int):
+        """:return: [(vector_id, 余弦相似度), ...]，按相似度从高到低排序。"""
+        raise NotImplementedError
+
+    def get(self, vector_ids):
+        """:return: {vector_id: (D,) float32 numpy 数组}"""
+        raise NotImplementedError
+
+    def query_subset(self, vector, vector_ids, n_results: int):
+        """
+        只在给定的向量中检索 (预过滤)，结果格式同 query。
+        默认实现分批读取这些向量后精确计算，代价与 len(vector_ids) 成正比。
+        """
+        query = normalize(vector)
+        ids, scores = [], []
+        for start in range(0, len(vector_ids), SUBSET_BATCH_SIZE):
+            found = self.get(vector_ids[start:start + SUBSET_BATCH_SIZE])
+            if found:
+                ids.extend(found)
+                scores.append(normalize(np.stack(list(found.values()))) @ query)
+        return top_hits(ids, np.concatenate(scores) if scores else np.empty(0, dtype=np.float32), n_results)
+
+    def iter_batches(self, batch_size: int):
+        """按批遍历所有向量，产出 (ids, (N, D) float32 数组)，用于迁移。"""
+        raise NotImplementedError
+
+    def iter_ids(self, page_size: int = 10000):
+        for ids, _ in self.iter_batches(page_size):
+            yield from ids
+
+    def count(self):
+        raise NotImplementedError
+
+    def is_ready(self):
+        """向量库是否已正常打开 (打开失败的后端 count() 也会返回 0，不能据此判断向量库为空)。"""
+        return True
+
+    def normalize_existing(self):
+        """将旧版本写入的未归一化向量就地归一化 (只有需要的后端才实现)。"""
+
+    def load_info(self):
+        """读取向量库的格式信息 (例如产生向量的模型)。"""
+        return {}
+
+    def save_info(self, info):
+        raise NotImplementedError
+
+class ChromaBackend(VectorBackend):
+    """基于 ChromaDB 持久化集合的向量存储。"""
+    name = "chroma"
+
+    def __init__(self, path: str = DB_PATH, collection_name: str = COLLECTION_NAME):
+        import chromadb
+
+        self.path = path
+        # 使用持久化存储，确保数据在重启后依然存在
+        self.client = chromadb.PersistentClient(path=path)
+        # 新建的集合使用余弦距离；旧版本创建的集合沿用其原有的距离函数 (默认 l2)
+        try:
+            self.collection = self.client.get_or_create_collection(
+                name=collection_name, metadata={"hnsw:space": "cosine"})
+            logging.info(f"ChromaDB 集合 '{collection_name}' 加载/创建成功")
+        except Exception as e:
+            logging.error(f"加载/创建 ChromaDB 集合失败: {e}")
+            self.collection = None
+
+    def _distance_space(self):
+        metadata = (self.collection.metadata if self.collection is not None else None) or {}
+        return metadata.get("hnsw:space", "l2")
+
+    def _distance_to_similarity(self, distance: float):
+        """将 ChromaDB 返回的距离换算为余弦相似度 (要求存储的向量已归一化)"""
+        if self._distance_space() == "l2":
+            # ChromaDB 的 l2 为平方距离: |a - b|^2 = 2 - 2cos(a, b)
+            return 1.0 - distance / 2.0
+        return 1.0 - distance
+
+    def load_info(self):
+        try:
+            with open(os.path.join(self.path, STORE_INFO_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_info(self, info):
+        with open(os.path.join(self.path, STORE_INFO_FILE), "w", encoding="utf-8") as f:
+            json.dump(info, f, ensure_ascii=False, indent=2)
+
+    def _max_batch_size(self):
+        """ChromaDB 单次写入允许的最大条数"""
+        get_max_batch_size = getattr(self.client, "get_max_batch_size", None)
+        try:
+            return get_max_batch_size() if get_max_batch_size else DEFAULT_MAX_BATCH_SIZE
+        except Exception:
+            return DEFAULT_MAX_BATCH_SIZE
+
+    def upsert(self, vectors, vector_ids):
+        if self.collection is None:
+            logging.error("ChromaDB 集合未初始化，无法写入向量。")
+            return False
+        vectors = normalize(vectors)
+        batch_size = self._max_batch_size()
+        try:
+            for start in range(0, len(vector_ids), batch_size):
+                self.collection.upsert(
+                    embeddings=vectors[start:start + batch_size],
+                    ids=list(vector_ids[start:start + batch_size])
+                )
+            logging.info(f"成功将 {len(vector_ids)} 个向量写入 ChromaDB")
+            return True
+        except Exception as e:
+            logging.error(f"向 ChromaDB 批量写入 {len(vector_ids)} 个向量时出错: {e}")
+            return False
+
+    def delete(self, vector_ids):
+        if self.collection is None:
+            logging.error("ChromaDB 集合未初始化，无法删除向量。")
+            return False
+        try:
+            self.collection.delete(ids=vector_ids)
+            logging.info(f"已从 ChromaDB 删除 {len(vector_ids)} 个向量")
+            return True
+        except Exception as e:
+            logging.error(f"从 ChromaDB 删除向量时出错: {e}")
+            return False
+
+    def query(self, vector, n_results: int):
+        if self.collection is None:
+            logging.error("ChromaDB 集合未初始化，无法查询向量。")
+            return []
+        n_results = min(n_results, self.collection.count())
+        if n_results <= 0:
+            return []
+        result = self.collection.query(
+            query_embeddings=normalize(vector)[None, :],
+            n_results=n_results,
+            include=["distances"]
+        )
+        return [
+            (vector_id, self._distance_to_similarity(distance))
+            for vector_id, distance in zip(result["ids"][0], result["distances"][0])
+        ]
+
+    def get(self, vector_ids):
+        if self.collection is None:
+            return {}
+        result = self.collection.get(ids=vector_ids, include=["embeddings"])
+        return {
+            vector_id: np.asarray(embedding, dtype=np.float32)
+            for vector_id, embedding in zip(result["ids"], result["embeddings"])
+        }
+
+    def iter_batches(self, batch_size: int, include_embeddings: bool = True):
+        if self.collection is None:
+            return
+        offset = 0
+        while True:
+            page = self.collection.get(include=["embeddings"] if include_embeddings else [],
+                                       limit=batch_size, offset=offset)
+            ids = page["ids"]
+            if not ids:
+                return
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32) if include_embeddings else None
+            yield ids, embeddings
+            offset += len(ids)
+
+    def iter_ids(self, page_size: int = 10000):
+        for ids, _ in self.iter_batches(page_size, include_embeddings=False):
+            yield from ids
+
+    def count(self):
+        if self.collection is None:
+            return 0
+        return self.collection.count()
+
+    def is_ready(self):
+        return self.collection is not None
+
+    def normalize_existing(self, page_size: int = 1000):
+        """只需执行一次，完成后记录在向量库信息文件中。"""
+        if self.collection is None:
+            return
+        info = self.load_info()
+        if info.get("normalized"):
+            return
+        total = self.collection.count()
+        if total:
+            logging.info(f"正在归一化 ChromaDB 中已有的 {total} 个向量...")
+        offset = 0
+        while offset < total:
+            page = self.collection.get(include=["embeddings"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            self.collection.upsert(ids=page["ids"], embeddings=normalize(page["embeddings"]))
+            offset += len(page["ids"])
+        info["normalized"] = True
+        self.save_info(info)
+
+def create_backend(name: str = VECTOR_BACKEND):
+    """按名称创建向量存储后端"""
+    if name == "chroma":
+        return ChromaBackend()
+    if name == "mmap":
+        from .mmap_index import MmapVectorBackend
+        return MmapVectorBackend()
+    if name == "remote":
+        from .store_service import RemoteVectorBackend
+        return RemoteVectorBackend()
+    raise ValueError(f"未知的向量存储后端: {name}")
 
-# 初始化 ChromaDB 客户端
-# 使用持久化存储，确保数据在重启后依然存在
-client = chromadb.PersistentClient(path=DB_PATH)
+# 由 get_backend() 在第一次使用时创建
+backend = None
+_backend_lock = threading.Lock()
+_backend_error = None
+_load_seconds = None
 
-# 获取或创建集合
-try:
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
-    logging.info(f"ChromaDB 集合 '{COLLECTION_NAME}' 加载/创建成功")
-except Exception as e:
-    logging.error(f"加载/创建 ChromaDB 集合失败: {e}")
-    collection = None
+def get_backend():
+    """
+    返回当前的向量存储后端，第一次调用时创建 (线程安全)。
+    创建后会将旧版本写入的未归一化向量就地归一化 (只执行一次)。
+    :raises RuntimeError: 后端无法创建时。
+    """
+    global backend, _backend_error, _load_seconds
+    if backend is not None:
+        return backend
+    with _backend_lock:
+        if backend is None:
+            started = time.perf_counter()
+            try:
+                created = create_backend()
+                # 旧版本写入的向量未归一化，无法直接按余弦相似度检索
+                created.normalize_existing()
+            except Exception as e:
+                _backend_error = str(e)
+                logging.error(f"创建向量存储后端 {VECTOR_BACKEND} 失败: {e}")
+                raise RuntimeError(f"向量存储不可用: {e}") from e
+            _load_seconds = time.perf_counter() - started
+            backend = created
+            _backend_error = None
+            logging.info(f"向量存储后端: {backend.name}，加载耗时 {_load_seconds:.1f} 秒")
+    return backend
+
+def status():
+    """向量存储的加载状态，用于健康检查。"""
+    return {
+        'backend': VECTOR_BACKEND,
+        'loaded': backend is not None,
+        'loading': _backend_lock.locked(),
+        'load_seconds': round(_load_seconds, 2) if _load_seconds is not None else None,
+        'error': _backend_error,
+    }
+
+def warmup():
+    """在后台线程中创建向量存储后端，不阻塞调用方。"""
+    def run():
+        try:
+            get_backend()
+        except RuntimeError:
+            pass
+    threading.Thread(target=run, name="vector-store-warmup", daemon=True).start()
+
+_checked_sources = set()
+
+def check_embedding_source(source):
+    """
+    检查并记录写入向量库的向量来源 {'model', 'inference_backend'}。
+    不同推理后端 (见 inference_backends.py) 产生的向量只有数值误差，可以混合存储，这里只记录用过哪些后端；
+    模型不同时向量空间不兼容，拒绝写入。
+    :return: 与向量库中已有的向量兼容时返回 True。
+    """
+    key = (source['model'], source['inference_backend'])
+    if key in _checked_sources:
+        return True
+    store = get_backend()
+    info = store.load_info()
+    stored_model = info.get('embedding_model')
+    if stored_model is None and store.count() > 0:
+        # 旧版本写入的向量没有记录来源，均由参考实现 (torch) 产生
+        info['inference_backends'] = ['torch']
+    elif stored_model is not None and stored_model != source['model']:
+        logging.error(f"向量库中的向量由模型 {stored_model} 产生，与当前模型 {source['model']} 不兼容，"
+                      f"请使用新的向量库目录重新索引")
+        return False
+    backends = info.setdefault('inference_backends', [])
+    if stored_model is None or source['inference_backend'] not in backends:
+        info['embedding_model'] = source['model']
+        if source['inference_backend'] not in backends:
+            backends.append(source['inference_backend'])
+        store.save_info(info)
+    _checked_sources.add(key)
+    return True
+
+def upsert_vectors(vectors, vector_ids, source=None):
+    """
+    批量写入或覆盖向量。
+    :param vectors: (N, 512) float32 numpy 数组。
+    :param vector_ids: 与 vectors 一一对应的 ID 列表。
+    :param source: 可选，产生向量的模型与推理后端 (clip_model.embedding_source())，会记录在向量库中。
+    :return: 如果全部成功则返回 True，否则返回 False。
+    """
+    if len(vector_ids) == 0:
+        return True
+    if source is not None and not check_embedding_source(source):
+        return False
+    return get_backend().upsert(vectors, vector_ids)
 
 def add_vector(vector, vector_id: str):
     """
-    向 ChromaDB 集合中添加一个向量。
+    向向量库中添加一个向量。
     :param vector: 图片的特征向量。
     :param vector_id: 与 SQLite 中图片记录关联的唯一 ID。
     :return: 如果成功则返回 True，否则返回 False。
     """
-    if collection is None:
-        logging.error("ChromaDB 集合未初始化，无法添加向量。")
-        return False
-    try:
-        collection.add(
-            embeddings=[vector.tolist()], # 确保 embedding 是 list
-            ids=[vector_id]
-        )
-        logging.info(f"成功将向量 (ID: {vector_id}) 添加到 ChromaDB")
+    return upsert_vectors(np.asarray(vector, dtype=np.float32)[None, :], [vector_id])
+
+def delete_vectors(vector_ids):
+    """
+    从向量库中删除一组向量。
+    :return: 如果成功则返回 True，否则返回 False。
+    """
+    vector_ids = [vid for vid in vector_ids if vid]
+    if not vector_ids:
         return True
-    except Exception as e:
-        logging.error(f"向 ChromaDB 添加向量时出错 (ID: {vector_id}): {e}")
-        return False
+    return get_backend().delete(vector_ids)
+
+def query_vectors(vector, n_results: int):
+    """
+    查询与给定向量最相似的 n_results 个向量。
+    :return: [(vector_id, 余弦相似度), ...]，按相似度从高到低排序。
+    """
+    return get_backend().query(vector, n_results)
+
+def query_vector_subset(vector, vector_ids, n_results: int):
+    """
+    只在给定的向量中检索与 vector 最相似的 n_results 个 (预过滤)。
+    :return: [(vector_id, 余弦相似度), ...]，按相似度从高到低排序。
+    """
+    vector_ids = [vid for vid in vector_ids if vid]
+    if not vector_ids:
+        return []
+    return get_backend().query_subset(vector, vector_ids, n_results)
+
+def get_vectors(vector_ids):
+    """
+    按 ID 读取已存储的向量。
+    :return: {vector_id: (512,) float32 numpy 数组}，不存在的 ID 不会出现在结果中。
+    """
+    vector_ids = [vid for vid in vector_ids if vid]
+    if not vector_ids:
+        return {}
+    return get_backend().get(vector_ids)
+
+def normalize_existing_vectors():
+    """将旧版本写入的未归一化向量就地归一化 (get_backend() 创建后端时会自动执行)"""
+    get_backend().normalize_existing()
+
+def iter_vector_ids(page_size: int = 10000):
+    """分页遍历向量库中的所有向量 ID"""
+    return get_backend().iter_ids(page_size)
+
+def iter_vectors(batch_size: int = 10000):
+    """按批遍历向量库中的所有向量，产出 (ids, (N, 512) float32 数组)"""
+    return get_backend().iter_batches(batch_size)
 
 def get_vector_count():
-    """获取集合中的向量总数"""
-    if collection is None:
-        return 0
-    return collection.count()
+    """获取向量库中的向量总数"""
+    return get_backend().count()
+
+def migrate(source, target, batch_size: int = 5000):
+    """
+    将 source 后端中的所有向量复制到 target 后端 (相同 ID 会被覆盖)。
+    :return: 复制的向量数。
+    """
+    copied = 0
+    info = source.load_info()
+    if info:
+        target.save_info(dict(target.load_info(), **info))
+    for ids, vectors in source.iter_batches(batch_size):
+        if not target.upsert(vectors, ids):
+            raise RuntimeError(f"写入目标向量库失败 (已复制 {copied} 个)")
+        copied += len(ids)
+        logging.info(f"已迁移 {copied} 个向量")
+    return copied
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="向量库管理工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="在不同的向量存储后端之间复制数据")
+    migrate_parser.add_argument("--source", default="chroma", choices=["chroma", "mmap"])
+    migrate_parser.add_argument("--target", default="mmap", choices=["chroma", "mmap"])
+    migrate_parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    if args.source == args.target:
+        parser.error("源后端与目标后端不能相同")
+    source = get_backend() if VECTOR_BACKEND == args.source else create_backend(args.source)
+    target = get_backend() if VECTOR_BACKEND == args.target else create_backend(args.target)
+    copied = migrate(source, target, batch_size=args.batch_size)
+    print(f"迁移完成: {args.source} -> {args.target}，共 {copied} 个向量")
+    print(f"设置环境变量 PHOTO_INSIGHT_VECTOR_BACKEND={args.target} 以使用新的向量库")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
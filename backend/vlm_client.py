@@ -0,0 +1,259 @@
+"""
+异步 VLM 客户端 (OpenAI chat-completions 兼容接口，例如 LM Studio)。
+
+- 复用 httpx.AsyncClient 的连接池，不再为每张图片建立新连接
+- 通过信号量限制同时发送的请求数，使 GPU 推理服务保持忙碌而不过载
+- 502/503/504 与超时等临时错误按指数退避重试
+- 连续失败达到阈值时熔断，服务不可用期间直接失败，不再逐张等待超时
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+
+import httpx
+
+from . import metrics
+
+# 配置
+VLM_API_URL = os.environ.get("PHOTO_INSIGHT_VLM_URL", "http://localhost:1234/v1/chat/completions")
+VLM_MODEL = os.environ.get("PHOTO_INSIGHT_VLM_MODEL", "gemma/gemma2-9b-it")  # 与 LM Studio 中加载的模型名称一致
+VLM_CONCURRENCY = int(os.environ.get("PHOTO_INSIGHT_VLM_CONCURRENCY", "4"))  # 同时发送的请求数
+VLM_TIMEOUT = float(os.environ.get("PHOTO_INSIGHT_VLM_TIMEOUT", "60"))  # 单次请求超时 (秒)
+VLM_MAX_RETRIES = 3
+VLM_BACKOFF_BASE = 0.5  # 第 n 次重试前等待 base * 2^n 秒 (带随机抖动)
+BREAKER_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断
+BREAKER_RESET_SECONDS = 30.0  # 熔断后多久允许一次试探请求
+
+RETRY_STATUS_CODES = (502, 503, 504)
+SEASON_PROMPT = (
+    "Analyze the following image and determine which of the four seasons it best represents: "
+    "Spring, Summer, Autumn, or Winter. Respond with only one word from the list: [Spring, Summer, Autumn, Winter]."
+)
+
+class VLMError(Exception):
+    """VLM 请求失败 (重试后仍失败，或返回了无法解析的响应)"""
+
+class CircuitOpenError(VLMError):
+    """熔断器处于打开状态，VLM 服务被认为不可用"""
+
+class CircuitBreaker:
+    """
+    连续失败计数熔断器。
+    closed: 正常放行; open: 直接拒绝; 打开超过 reset_seconds 后进入 half-open，只放行一个试探请求。
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def before_request(self):
+        state = self.state
+        if state == "open" or (state == "half-open" and self._probing):
+            raise CircuitOpenError(f"VLM 服务连续失败 {self.failures} 次，已熔断")
+        if state == "half-open":
+            self._probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logging.error(f"VLM 服务连续失败 {self.failures} 次，熔断 {self.reset_seconds} 秒")
+                metrics.VLM_CIRCUIT_OPEN.inc()
+            self.opened_at = time.monotonic()
+
+class VLMMetrics:
+    """请求计数与吞吐量统计"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.requests = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.latency_seconds = 0.0
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            'requests': self.requests,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retries': self.retries,
+            'in_flight': self.in_flight,
+            'elapsed_seconds': round(elapsed, 2),
+            'images_per_sec': round(self.succeeded / elapsed, 2) if elapsed > 0 else 0.0,
+            'avg_latency_ms': round(1000 * self.latency_seconds / self.succeeded, 1) if self.succeeded else 0.0,
+        }
+
+def build_payload(base64_image: str, model: str = VLM_MODEL):
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": SEASON_PROMPT},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                ]
+            }
+        ],
+        "max_tokens": 10,
+    }
+
+def parse_season(response_json):
+    """从 chat-completions 响应中取出季节名称 (首字母大写)"""
+    try:
+        return response_json['choices'][0]['message']['content'].strip().strip('.').capitalize()
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        raise VLMError(f"无法解析 VLM 响应: {e}")
+
+class VLMClient:
+    """
+    使用方式:
+        async with VLMClient() as client:
+            season = await client.classify(base64_image)
+    """
+
+    def __init__(self, api_url: str = VLM_API_URL, model: str = VLM_MODEL, concurrency: int = VLM_CONCURRENCY,
+                 timeout: float = VLM_TIMEOUT, max_retries: int = VLM_MAX_RETRIES,
+                 backoff_base: float = VLM_BACKOFF_BASE, breaker: CircuitBreaker = None):
+        self.api_url = api_url
+        self.model = model
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = VLMMetrics()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._client = None
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self._client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+        self._client = None
+
+    async def classify(self, base64_image: str):
+        """
+        请求 VLM 判断一张图片的季节。
+        :return: 模型返回的季节名称。
+        :raises CircuitOpenError: 熔断器打开时。
+        :raises VLMError: 重试后仍然失败时。
+        """
+        payload = build_payload(base64_image, self.model)
+        async with self._semaphore:
+            return await self._post_with_retries(payload)
+
+    async def _post_with_retries(self, payload):
+        attempt = 0
+        while True:
+            self.breaker.before_request()
+            self.metrics.requests += 1
+            self.metrics.in_flight += 1
+            metrics.VLM_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                response = await self._client.post(self.api_url, json=payload)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    season = parse_season(response.json())
+                    outcome = "success"
+                    self.breaker.record_success()
+                    self.metrics.succeeded += 1
+                    self.metrics.latency_seconds += time.perf_counter() - started
+                    return season
+                reason = f"HTTP {response.status_code}"
+                outcome = "retryable"
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                reason = f"{type(e).__name__}: {e}"
+                outcome = "retryable"
+            except httpx.HTTPStatusError as e:
+                # 其他 4xx/5xx 不是临时错误，不重试
+                self.metrics.failed += 1
+                raise VLMError(f"VLM 返回非预期的状态码 {e.response.status_code}: {e.response.text[:200]}")
+            finally:
+                self.metrics.in_flight -= 1
+                metrics.VLM_IN_FLIGHT.dec()
+                metrics.VLM_REQUESTS.inc(outcome=outcome)
+                metrics.VLM_REQUEST_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+
+            # 仅可重试的错误计入熔断器
+            self.breaker.record_failure()
+            if attempt >= self.max_retries:
+                self.metrics.failed += 1
+                raise VLMError(f"VLM 请求重试 {self.max_retries} 次后仍失败 ({reason})")
+            delay = self.backoff_base * (2 ** attempt) * (0.5 + random.random())
+            logging.warning(f"VLM 请求失败 ({reason})，{delay:.1f} 秒后重试")
+            attempt += 1
+            self.metrics.retries += 1
+            metrics.VLM_RETRIES.inc()
+            await asyncio.sleep(delay)
+
+    async def classify_all(self, items, load_image, on_result, on_error=None, should_stop=None):
+        """
+        以 concurrency 个并发工作协程处理一组图片。
+        :param items: [(key, image_path), ...]
+        :param load_image: 同步函数 load_image(image_path) -> base64 字符串或 None，在线程池中执行。
+        :param on_result: 协程 on_result(key, image_path, season)。
+        :param on_error: 可选协程 on_error(key, image_path, reason)。
+        :param should_stop: 可选，返回 True 时不再开始新的图片 (进行中的请求会完成)。
+        :raises CircuitOpenError: 熔断后停止剩余的工作。
+        """
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        loop = asyncio.get_running_loop()
+
+        async def worker():
+            while not (should_stop and should_stop()):
+                try:
+                    key, image_path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                base64_image = await loop.run_in_executor(None, load_image, image_path)
+                if not base64_image:
+                    if on_error:
+                        await on_error(key, image_path, "无法读取图片")
+                    continue
+                try:
+                    season = await self.classify(base64_image)
+                except CircuitOpenError:
+                    raise
+                except VLMError as e:
+                    logging.error(f"图片 '{os.path.basename(image_path)}' 分类失败: {e}")
+                    if on_error:
+                        await on_error(key, image_path, str(e))
+                    continue
+                await on_result(key, image_path, season)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
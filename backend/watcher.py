@@ -0,0 +1,272 @@
+"""
+文件监视: 持续监视配置的根目录 (PHOTO_INSIGHT_WATCH_DIRS)，新图片在落盘几秒后即可被检索。
+
+- 事件来源: 安装了 watchdog 时使用系统的文件通知 (Linux 上为 inotify)，空闲时不占用 CPU；
+  未安装 watchdog 或无法启动 (例如 inotify 监视数量超出上限、网络文件系统) 时
+  退回到定时轮询，每 WATCH_POLL_INTERVAL 秒对比一次目录的文件指纹。
+- 防抖: 每个路径在最后一次事件之后静默 WATCH_DEBOUNCE_SECONDS 秒才会处理，
+  正在复制或写入的文件会持续产生事件，因此不会在写完之前被读取。
+- 批处理: 处理线程每次取出所有已静默的路径，合并成一批交给 indexer.index_paths，
+  一批之内的删除与新增按 inode 匹配为移动，只更新 Image.path，不重新推理。
+- 目录的创建、删除和移动展开为目录下的所有文件 (磁盘上的与数据库中的)。
+同一目录有正在运行的索引任务时，该目录下的变化会保留到任务结束后再处理。
+"""
+import logging
+import os
+import threading
+import time
+
+from . import crud, database, indexer, scanner
+from .jobs import job_manager
+
+# 配置
+WATCH_DIRS = [path for path in os.environ.get("PHOTO_INSIGHT_WATCH_DIRS", "").split(os.pathsep) if path]
+WATCH_BACKEND = os.environ.get("PHOTO_INSIGHT_WATCH_BACKEND", "auto")  # auto / watchdog / polling
+WATCH_DEBOUNCE_SECONDS = float(os.environ.get("PHOTO_INSIGHT_WATCH_DEBOUNCE", "1.5"))
+WATCH_POLL_INTERVAL = float(os.environ.get("PHOTO_INSIGHT_WATCH_POLL_INTERVAL", "10"))
+
+class _ChangeSet:
+    """收集待处理的路径与目录，记录每个路径最后一次事件的时间。"""
+
+    def __init__(self):
+        self.paths = {}  # 路径 -> 最后一次事件的时间
+        self.dirs = {}  # 目录 -> 最后一次事件的时间
+        self._lock = threading.Condition()
+
+    def add(self, path: str, is_directory: bool = False):
+        with self._lock:
+            (self.dirs if is_directory else self.paths)[path] = time.monotonic()
+            self._lock.notify()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.paths) + len(self.dirs)
+
+    def wait(self, stop: threading.Event):
+        """
+        阻塞直到有路径已静默 WATCH_DEBOUNCE_SECONDS 秒 (没有待处理的路径时无限等待)。
+        :return: (paths, dirs) —— 已静默的路径与目录，已从待处理集合中移除；停止时返回 None。
+        """
+        with self._lock:
+            while not stop.is_set():
+                pending = list(self.paths.values()) + list(self.dirs.values())
+                if not pending:
+                    self._lock.wait()
+                    continue
+                now = time.monotonic()
+                ready_at = min(pending) + WATCH_DEBOUNCE_SECONDS
+                if now < ready_at:
+                    self._lock.wait(ready_at - now)
+                    continue
+                return self._take(self.paths, now), self._take(self.dirs, now)
+            return None
+
+    @staticmethod
+    def _take(pending, now):
+        ready = [path for path, last in pending.items() if now - last >= WATCH_DEBOUNCE_SECONDS]
+        for path in ready:
+            del pending[path]
+        return ready
+
+    def wake(self):
+        with self._lock:
+            self._lock.notify_all()
+
+class _WatchdogSource:
+    """基于 watchdog 的事件来源"""
+    name = "watchdog"
+
+    def __init__(self, roots, changes: _ChangeSet):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type not in ("created", "modified", "deleted", "moved", "closed"):
+                    return
+                # 目录的修改事件只表示其中的条目有变化，条目自身会产生事件
+                if event.is_directory and event.event_type in ("modified", "closed"):
+                    return
+                changes.add(os.fsdecode(event.src_path), event.is_directory)
+                if event.event_type == "moved":
+                    changes.add(os.fsdecode(event.dest_path), event.is_directory)
+
+        self._observer = Observer()
+        handler = Handler()
+        for root in roots:
+            self._observer.schedule(handler, root, recursive=True)
+
+    def start(self):
+        self._observer.start()
+
+    def stop(self):
+        self._observer.stop()
+        self._observer.join()
+
+class _PollingSource:
+    """定时轮询的事件来源: 对比相邻两次扫描的文件指纹 (只读取文件信息，不读取内容)。"""
+    name = "polling"
+
+    def __init__(self, roots, changes: _ChangeSet, interval: float = WATCH_POLL_INTERVAL):
+        self.roots = roots
+        self.changes = changes
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="watch-poller", daemon=True)
+        self._snapshots = {}
+
+    def start(self):
+        self._snapshots = {root: scanner.scan_files(root) for root in self.roots}
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for root in self.roots:
+                before = self._snapshots[root]
+                after = scanner.scan_files(root)
+                for path in before.keys() | after.keys():
+                    if before.get(path) != after.get(path):
+                        self.changes.add(path)
+                self._snapshots[root] = after
+
+class Watcher:
+    """
+    文件监视服务。start() 之后在后台线程中运行，stop() 停止。
+    emit(event, data, room) 为线程安全的消息发送回调，监视产生的消息广播给所有客户端。
+    """
+
+    def __init__(self, roots=None, backend: str = WATCH_BACKEND, busy_directories=None):
+        """
+        :param busy_directories: 可选回调，返回正在执行索引任务的目录列表；这些目录下的变化暂缓处理。
+        """
+        self.roots = [os.path.abspath(root) for root in (WATCH_DIRS if roots is None else roots)]
+        self.backend = backend
+        self.busy_directories = busy_directories
+        self.changes = _ChangeSet()
+        self.source = None
+        self.batches = 0
+        self.last_batch = None
+        self._emit = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, emit=None):
+        roots = [root for root in self.roots if os.path.isdir(root)]
+        for root in set(self.roots) - set(roots):
+            logging.warning(f"监视目录不存在，已忽略: {root}")
+        if not roots:
+            return False
+        self._emit = emit
+        self.source = self._start_source(roots)
+        self._thread = threading.Thread(target=self._run, name="watch-indexer", daemon=True)
+        self._thread.start()
+        logging.info(f"开始监视 {len(roots)} 个目录 ({self.source.name}): {', '.join(roots)}")
+        return True
+
+    def _start_source(self, roots):
+        """创建并启动事件来源，watchdog 不可用时退回到轮询。"""
+        if self.backend in ("auto", "watchdog"):
+            try:
+                source = _WatchdogSource(roots, self.changes)
+                # inotify 的初始化错误 (例如监视数量超出上限) 在启动时才会出现
+                source.start()
+                return source
+            except ImportError:
+                logging.info("未安装 watchdog，文件监视改为定时轮询 (pip install watchdog 可获得实时通知)")
+            except OSError as e:
+                logging.warning(f"无法启动文件系统通知 ({e})，文件监视改为定时轮询")
+        source = _PollingSource(roots, self.changes)
+        source.start()
+        return source
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self.changes.wake()
+        self.source.stop()
+        self._thread.join()
+        self._thread = None
+
+    def status(self):
+        return {
+            'enabled': self._thread is not None,
+            'backend': self.source.name if self.source else None,
+            'roots': self.roots,
+            'pending': len(self.changes),
+            'batches': self.batches,
+            'last_batch': self.last_batch,
+        }
+
+    def _send(self, event, payload):
+        if self._emit is not None:
+            self._emit(event, payload, None)
+
+    def _run(self):
+        while True:
+            ready = self.changes.wait(self._stop)
+            if ready is None:
+                return
+            paths, dirs = ready
+            paths, dirs = self._defer_busy(paths, dirs)
+            if not paths and not dirs:
+                continue
+            try:
+                self._process(paths, dirs)
+            except Exception as e:
+                logging.error(f"处理文件变化时出错: {e}")
+                self._send('error', {'data': f'文件监视出错: {str(e)}'})
+
+    def _defer_busy(self, paths, dirs):
+        """将正在执行索引任务的目录下的路径放回待处理集合 (重新计时，任务结束后再处理)。"""
+        busy = [os.path.join(directory, "") for directory in (self.busy_directories() if self.busy_directories else ())]
+        if not busy:
+            return paths, dirs
+        kept = ([], [])
+        for items, keep, is_directory in ((paths, kept[0], False), (dirs, kept[1], True)):
+            for path in items:
+                if path.startswith(tuple(busy)):
+                    self.changes.add(path, is_directory)
+                else:
+                    keep.append(path)
+        return kept
+
+    def _expand_dirs(self, dirs):
+        """目录下磁盘上现有的文件与数据库中记录的文件"""
+        paths = set()
+        db = database.SessionLocal()
+        try:
+            for directory in dirs:
+                paths.update(scanner.scan_files(directory) if os.path.isdir(directory) else ())
+                paths.update(row[1] for row in crud.get_fingerprints(db, directory))
+        finally:
+            db.close()
+        return paths
+
+    def _process(self, paths, dirs):
+        """处理一批已静默的变化"""
+        paths = set(paths) | self._expand_dirs(dirs)
+        paths = {path for path in paths if path.lower().endswith(scanner.SUPPORTED_EXTENSIONS)}
+        if not paths:
+            return
+        started = time.perf_counter()
+        scan, stats = indexer.index_paths(sorted(paths), self._send, should_stop=self._stop.is_set)
+        summary = scan.summary()
+        self.batches += 1
+        self.last_batch = dict(summary, seconds=round(time.perf_counter() - started, 3),
+                               finished_at=time.time())
+        if summary['new'] or summary['modified'] or summary['moved'] or summary['deleted']:
+            logging.info(f"文件监视: 处理 {len(paths)} 个路径的变化 {summary}"
+                         + (f" | {indexer.format_stage_stats(stats)}" if stats else ""))
+            self._send('watch_changes', {
+                'scan': summary,
+                'moved': [{'id': image_id, 'path': path} for image_id, path in scan.moved],
+                'deleted': scan.deleted,
+                'stats': stats,
+            })
+
+watcher = Watcher(busy_directories=job_manager.active_directories)
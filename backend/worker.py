@@ -0,0 +1,285 @@
+"""
+工作进程: 多进程部署 (PHOTO_INSIGHT_JOB_QUEUE=sqlite) 时执行索引与季节分类任务。
+
+- Web 进程把任务写入 SQLite 的任务队列 (worker_tasks)，工作进程用带条件的 UPDATE 领取，
+  同一台机器上可以同时运行多个工作进程。
+- 心跳: 每 POLL_INTERVAL 秒读取持有任务的状态，Web 进程发出的暂停、恢复与取消在这里生效；
+  暂停的索引任务在检查点处退出并放回队列，恢复之前不会被领取，不占用并发名额；
+  每 HEARTBEAT_INTERVAL 秒更新一次心跳。心跳超过 PHOTO_INSIGHT_WORKER_LEASE 秒未更新的任务
+  (工作进程崩溃) 会被其他工作进程重新领取，索引任务从检查点继续，分类任务从分类工作队列继续。
+- 进度消息通过消息队列 (messaging.create_emitter) 发送给发起任务的客户端 (sid)。
+- 退出 (Ctrl+C / SIGTERM) 时中断正在运行的任务并放回队列。
+- --watch: 同时运行文件监视 (Web 进程在多进程部署时不运行文件监视)。
+
+用法:
+    python -m backend.worker [--concurrency 2] [--kinds indexing classification] [--watch]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+from . import classify_seasons, crud, database, jobs, messaging, migrations, models
+
+# 配置
+WORKER_CONCURRENCY = int(os.environ.get("PHOTO_INSIGHT_WORKER_CONCURRENCY", "1"))  # 同时执行的任务数
+POLL_INTERVAL = float(os.environ.get("PHOTO_INSIGHT_WORKER_POLL_INTERVAL", "1.0"))  # 领取任务与读取任务状态的间隔 (秒)
+HEARTBEAT_INTERVAL = jobs.WORKER_LEASE_SECONDS / 4
+TASK_KINDS = ("indexing", "classification")
+
+class _SioAdapter:
+    """classification_task 需要一个带 async emit 的 sio，这里转给消息队列的 emit"""
+
+    def __init__(self, emit):
+        self._emit = emit
+
+    async def emit(self, event, data, room=None):
+        self._emit(event, data, room)
+
+class _ClassificationRun:
+    """一个分类任务的运行状态"""
+
+    def __init__(self):
+        self.cancel = threading.Event()
+        self.interrupted = False
+        self.thread = None
+
+    def stop(self, interrupted: bool):
+        self.interrupted = self.interrupted or interrupted
+        self.cancel.set()
+
+class Worker:
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY, kinds=TASK_KINDS, emit=None):
+        self.id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.concurrency = max(1, concurrency)
+        self.kinds = tuple(kinds)
+        self.emit = emit or messaging.create_emitter()
+        self.jobs = jobs.JobManager(max_workers=self.concurrency)
+        self.jobs.set_emitter(self.emit)
+        self._slots = threading.Semaphore(self.concurrency)
+        self._running = {}  # task_id -> jobs.Job (索引) 或 _ClassificationRun (分类)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """领取并执行任务，直到 stop() 被调用；退出前中断所有任务并放回队列。"""
+        threading.Thread(target=self._control_loop, name="worker-control", daemon=True).start()
+        logging.info(f"工作进程 {self.id} 已启动 (并发 {self.concurrency}，任务类型: {', '.join(self.kinds)})")
+        try:
+            while not self._stop.is_set():
+                if not self._slots.acquire(timeout=POLL_INTERVAL):
+                    continue
+                task = self._claim()
+                if task is None:
+                    self._slots.release()
+                    self._stop.wait(POLL_INTERVAL)
+                    continue
+                try:
+                    self._start(task)
+                except Exception as e:
+                    logging.error(f"启动任务 {task.id} 时出错: {e}")
+                    self._done(task.id, "failed", str(e))
+        finally:
+            self._shutdown()
+
+    def _claim(self):
+        db = database.SessionLocal()
+        try:
+            return crud.claim_worker_task(db, self.id, self.kinds, jobs.WORKER_LEASE_SECONDS)
+        except Exception as e:
+            logging.error(f"领取任务时出错: {e}")
+            return None
+        finally:
+            db.close()
+
+    def _start(self, task):
+        params = json.loads(task.params) if task.params else {}
+        if task.kind == "indexing":
+            self._start_indexing(task, params)
+        else:
+            self._start_classification(task, params)
+
+    def _start_indexing(self, task, params):
+        db = database.SessionLocal()
+        try:
+            db_job = crud.get_indexing_job(db, task.job_id)
+        finally:
+            db.close()
+        if db_job is None or db_job.status in ("completed", "cancelled", "failed"):
+            # 任务在排队期间已被取消 (或被删除)
+            self._done(task.id, "cancelled")
+            return
+        if db_job.status == "paused":
+            # 领取的同时被暂停了，放回队列等待恢复
+            self._done(task.id, None)
+            return
+        job = jobs.Job(db_job.id, db_job.directory, sid=task.sid, checkpoint=db_job.checkpoint,
+                       status=db_job.status, processed=db_job.processed, total=db_job.total,
+                       profiler=params.get('profiler'))
+        with self._lock:
+            self._running[task.id] = job
+        logging.info(f"领取索引任务 {job.id}: {job.directory} (检查点: {job.checkpoint})")
+        future = self.jobs.adopt(job)
+        future.add_done_callback(lambda _: self._indexing_done(task.id, job))
+
+    def _indexing_done(self, task_id: str, job: jobs.Job):
+        if job.cancelled:
+            self._done(task_id, "cancelled")
+        elif job.interrupted or job.status not in ("completed", "failed"):
+            # 中断或暂停: 放回队列，之后从检查点继续 (暂停的任务恢复后才会被领取)
+            self._done(task_id, None)
+        else:
+            self._done(task_id, job.status, job.error)
+
+    def _start_classification(self, task, params):
+        run = _ClassificationRun()
+        with self._lock:
+            self._running[task.id] = run
+        run.thread = threading.Thread(target=self._run_classification, args=(task, params, run),
+                                      name=f"classification-{task.id[:8]}", daemon=True)
+        logging.info(f"领取季节分类任务 {task.id}: {params}")
+        run.thread.start()
+
+    def _run_classification(self, task, params, run: _ClassificationRun):
+        status, error = "completed", None
+        try:
+            asyncio.run(classify_seasons.classification_task(
+                sio=_SioAdapter(self.emit), sid=task.sid, should_stop=run.cancel.is_set, **params))
+        except Exception as e:
+            logging.error(f"季节分类任务 {task.id} 失败: {e}")
+            status, error = "failed", str(e)
+        if run.interrupted:
+            # 分类任务会从工作队列继续，放回队列即可
+            self._done(task.id, None)
+        else:
+            self._done(task.id, "cancelled" if run.cancel.is_set() else status, error)
+
+    def _done(self, task_id: str, status, error: str = None):
+        """结束任务并释放并发名额；status 为 None 时把任务放回队列。"""
+        with self._lock:
+            self._running.pop(task_id, None)
+        self._slots.release()
+        db = database.SessionLocal()
+        try:
+            if status is None:
+                crud.release_worker_task(db, task_id, self.id)
+            else:
+                crud.finish_worker_task(db, task_id, self.id, status, error)
+        except Exception as e:
+            logging.error(f"更新任务 {task_id} 的状态时出错: {e}")
+        finally:
+            db.close()
+
+    # ---- 心跳与控制 ----
+
+    def _control_loop(self):
+        last_beat = 0.0
+        while not self._stop.wait(POLL_INTERVAL):
+            with self._lock:
+                running = dict(self._running)
+            if not running:
+                continue
+            now = time.monotonic()
+            beat = now - last_beat >= HEARTBEAT_INTERVAL
+            try:
+                self._sync(running, beat)
+                if beat:
+                    last_beat = now
+            except Exception as e:
+                logging.error(f"同步任务状态时出错: {e}")
+
+    def _sync(self, running, beat: bool):
+        db = database.SessionLocal()
+        try:
+            states = crud.heartbeat_worker_tasks(db, self.id, running, touch=beat)
+            index_jobs = [handle for handle in running.values() if isinstance(handle, jobs.Job)]
+            job_statuses = crud.get_indexing_job_statuses(db, [job.id for job in index_jobs])
+        finally:
+            db.close()
+
+        for task_id, handle in running.items():
+            state = states.get(task_id)
+            if state == "lost":
+                # 心跳超时，任务已被其他工作进程接管
+                logging.warning(f"任务 {task_id} 已被其他工作进程接管，停止执行")
+                if isinstance(handle, jobs.Job):
+                    handle.interrupt()
+                else:
+                    handle.stop(interrupted=True)
+            elif isinstance(handle, jobs.Job):
+                status = job_statuses.get(handle.id)
+                if state == "cancelled" or status == "cancelled":
+                    if not handle.cancelled:
+                        handle.cancel()
+                elif status == "paused" and not handle.paused:
+                    handle.pause()
+                    handle.status = "paused"
+                elif status in ("queued", "running") and handle.paused:
+                    handle.resume()
+            elif state == "cancelled":
+                handle.stop(interrupted=False)
+
+    def _shutdown(self):
+        with self._lock:
+            running = dict(self._running)
+        if running:
+            logging.info(f"正在中断 {len(running)} 个任务，未完成的任务会放回队列")
+        for handle in running.values():
+            if isinstance(handle, jobs.Job):
+                handle.interrupt()
+            else:
+                handle.stop(interrupted=True)
+        self.jobs.shutdown()
+        for handle in running.values():
+            if isinstance(handle, _ClassificationRun) and handle.thread is not None:
+                handle.thread.join()
+        logging.info(f"工作进程 {self.id} 已停止")
+
+def main():
+    parser = argparse.ArgumentParser(description="执行任务队列中的索引与季节分类任务")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="同时执行的任务数")
+    parser.add_argument("--kinds", nargs="+", choices=TASK_KINDS, default=list(TASK_KINDS), help="领取的任务类型")
+    parser.add_argument("--watch", action="store_true", help="同时运行文件监视 (PHOTO_INSIGHT_WATCH_DIRS)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if jobs.JOB_QUEUE != "sqlite":
+        raise SystemExit("工作进程需要设置 PHOTO_INSIGHT_JOB_QUEUE=sqlite (Web 进程也需要相同的设置)")
+    models.Base.metadata.create_all(bind=database.engine)
+    migrations.run_migrations()
+
+    worker = Worker(args.concurrency, args.kinds)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+
+    watcher = None
+    if args.watch:
+        from .watcher import watcher
+        jobs.job_manager.set_emitter(worker.emit)
+        if watcher.start(worker.emit):
+            # 补上未运行期间的变化 (作为队列中的索引任务执行)
+            for directory in watcher.roots:
+                if os.path.isdir(directory):
+                    jobs.job_manager.submit(directory)
+        else:
+            logging.warning("没有可监视的目录 (PHOTO_INSIGHT_WATCH_DIRS)")
+            watcher = None
+
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+
+if __name__ == "__main__":
+    main()